@@ -0,0 +1,49 @@
+"""Geração de renditions (thumbnails e previews de texto) fora do event loop.
+
+As funções daqui rodam no ProcessPoolExecutor do servidor: ficam num módulo
+leve, sem FastAPI/Motor, para que cada worker importe só o necessário.
+Recebem o caminho em disco (quando o storage tem um) ou os bytes da origem.
+"""
+import io
+from typing import Optional, Tuple, Union
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow é opcional: sem ele não há thumbnails, só previews de texto
+    Image = None
+
+Source = Union[str, bytes]
+
+THUMBNAIL_FORMAT = "WEBP"
+THUMBNAIL_MIME_TYPE = "image/webp"
+
+
+def thumbnails_available() -> bool:
+    return Image is not None
+
+
+def _open_source(source: Source):
+    return open(source, "rb") if isinstance(source, str) else io.BytesIO(source)
+
+
+def render_thumbnail(source: Source, max_size: Tuple[int, int], quality: int = 80) -> bytes:
+    """Reduz a imagem para caber em max_size (mantendo proporção e orientação EXIF)"""
+    with _open_source(source) as f, Image.open(f) as img:
+        # JPEG: decodifica já em escala reduzida, bem mais barato que abrir em tamanho cheio
+        img.draft("RGB", max_size)
+        img = ImageOps.exif_transpose(img)
+        img.thumbnail(max_size)
+        if img.mode not in ("RGB", "RGBA"):
+            img = img.convert("RGBA" if "A" in img.getbands() or "transparency" in img.info else "RGB")
+        out = io.BytesIO()
+        img.save(out, THUMBNAIL_FORMAT, quality=quality, method=4)
+        return out.getvalue()
+
+
+def render_text_preview(head: bytes, max_bytes: int, total_size: int,
+                        excerpt_chars: int) -> Tuple[bytes, bool, Optional[str]]:
+    """Preview de texto limitado a max_bytes; devolve (utf-8, truncado?, trecho inicial)"""
+    text = head[:max_bytes].decode("utf-8", errors="ignore")
+    truncated = total_size > max_bytes
+    excerpt = " ".join(text[:excerpt_chars * 2].split())[:excerpt_chars] or None
+    return text.encode("utf-8"), truncated, excerpt
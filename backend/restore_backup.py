@@ -0,0 +1,29 @@
+"""Restaura snapshots gerados por /api/admin/backups/incremental.
+
+Uso (a partir de backend/, com as mesmas variáveis de ambiente do servidor):
+    python restore_backup.py snapshot-full.zip snapshot-incr-1.zip snapshot-incr-2.zip
+
+Os arquivos são aplicados na ordem dada: o snapshot full primeiro, depois os incrementais.
+"""
+import argparse
+import asyncio
+from pathlib import Path
+
+from server import client, logger, reconcile_usage_counters, restore_snapshot_archive
+
+
+async def main(paths):
+    try:
+        for path in paths:
+            result = await restore_snapshot_archive(Path(path))
+            logger.info(f"{path}: {result}")
+        # O restore grava direto em files; recalcula os contadores de uso de uma vez no final
+        logger.info(f"Contadores de uso: {await reconcile_usage_counters()}")
+    finally:
+        client.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Restaura snapshots de backup em UPLOAD_DIR e na coleção files")
+    parser.add_argument("snapshots", nargs="+", help="ZIPs de snapshot, em ordem cronológica")
+    asyncio.run(main(parser.parse_args().snapshots))
@@ -1,16 +1,18 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, status, UploadFile, File, WebSocket, WebSocketDisconnect, Form
-from fastapi.responses import StreamingResponse, RedirectResponse, FileResponse
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, status, UploadFile, File, WebSocket, WebSocketDisconnect, Form, Query
+from fastapi.responses import StreamingResponse, RedirectResponse, FileResponse, Response, JSONResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from authlib.integrations.starlette_client import OAuth
 from starlette.requests import Request
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import IndexModel, ASCENDING, DESCENDING, UpdateOne, DeleteOne, CursorType, ReturnDocument
+from pymongo.errors import BulkWriteError, CollectionInvalid, DuplicateKeyError
 import os
 import logging
 from pathlib import Path
 from pydantic import BaseModel, Field, ConfigDict
-from typing import List, Optional, Set
+from typing import List, Optional, Set, Dict, Generic, TypeVar
 import uuid
 from datetime import datetime, timezone, timedelta
 from passlib.context import CryptContext
@@ -21,6 +23,26 @@ import io
 import httpx
 import base64
 import zipfile
+import hashlib
+import re
+import time
+import shutil
+import asyncio
+from abc import ABC, abstractmethod
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import asynccontextmanager
+from email.utils import format_datetime
+
+try:
+    from . import renditions
+except ImportError:  # executado como módulo de topo (uvicorn server:app dentro de backend/)
+    import renditions
+
+try:
+    import msgpack
+except ImportError:  # msgpack é opcional: sem ele os WebSockets ficam só em JSON
+    msgpack = None
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
@@ -63,6 +85,7 @@ mongo_manager = MongoDBManager(client, os.environ['DB_NAME'], max_size_gb=0.5)
 # Security
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 security = HTTPBearer()
+optional_security = HTTPBearer(auto_error=False)
 SECRET_KEY = os.environ.get("SECRET_KEY", "your-secret-key-change-this")
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 60 * 24 * 7
@@ -71,10 +94,22 @@ ACCESS_TOKEN_EXPIRE_MINUTES = 60 * 24 * 7
 STORAGE_MODE = os.environ.get("STORAGE_MODE", "supabase")
 UPLOAD_DIR = Path(os.environ.get("UPLOAD_DIR", "/app/uploads"))
 UPLOAD_DIR.mkdir(exist_ok=True, parents=True)
+UPLOAD_CHUNK_SIZE = int(os.environ.get("UPLOAD_CHUNK_SIZE", 1024 * 1024))
+UPLOAD_SESSIONS_DIR = UPLOAD_DIR / ".sessions"
+UPLOAD_TMP_DIR = UPLOAD_DIR / ".tmp"
+UPLOAD_SESSION_MAX_PART_SIZE = int(os.environ.get("UPLOAD_SESSION_MAX_PART_SIZE", 64 * 1024 * 1024))
+UPLOAD_SESSION_MAX_PARTS = 10000
+UPLOAD_SESSION_TTL_HOURS = int(os.environ.get("UPLOAD_SESSION_TTL_HOURS", 24))
+BULK_STORAGE_CONCURRENCY = int(os.environ.get("BULK_STORAGE_CONCURRENCY", 8))
 
 SUPABASE_URL = os.environ.get("SUPABASE_URL")
 SUPABASE_KEY = os.environ.get("SUPABASE_KEY")
 SUPABASE_BUCKET = os.environ.get("SUPABASE_BUCKET", "uploads")
+try:
+    import h2  # noqa: F401 - habilita HTTP/2 no httpx quando instalado
+    SUPABASE_HTTP2 = os.environ.get("SUPABASE_HTTP2", "true").lower() == "true"
+except ImportError:
+    SUPABASE_HTTP2 = False
 
 GOOGLE_CLIENT_ID = os.environ.get("GOOGLE_CLIENT_ID")
 GOOGLE_CLIENT_SECRET = os.environ.get("GOOGLE_CLIENT_SECRET")
@@ -91,11 +126,9 @@ oauth.register(
     client_kwargs={'scope': 'openid email profile'}
 )
 
-if STORAGE_MODE == "supabase" and (not SUPABASE_URL or not SUPABASE_KEY):
+if STORAGE_MODE in ("supabase", "tiered") and (not SUPABASE_URL or not SUPABASE_KEY):
     STORAGE_MODE = "local"
 
-active_connections: Set[WebSocket] = set()
-
 app = FastAPI()
 
 # ===================================================================
@@ -107,7 +140,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
-    expose_headers=["*"]
+    expose_headers=["*", "X-Next-Cursor", "X-Total-Count"]
 )
 
 @app.get("/", include_in_schema=False)
@@ -230,11 +263,26 @@ class FileMetadata(BaseModel):
     has_password: bool = False
     storage_location: str = "local"
     supabase_path: Optional[str] = None
+    checksum: Optional[str] = None
     uploaded_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
+class UploadSessionCreate(BaseModel):
+    original_name: str
+    file_type: Optional[str] = None
+    total_size: Optional[int] = None
+    team_id: Optional[str] = None
+    password: Optional[str] = None
+
 class FileShare(BaseModel):
     username: str
 
+class FileBulkShare(BaseModel):
+    file_ids: List[str] = Field(..., min_length=1, max_length=1000)
+    usernames: List[str] = Field(..., min_length=1, max_length=100)
+
+class FileBulkDelete(BaseModel):
+    file_ids: List[str] = Field(..., min_length=1, max_length=1000)
+
 class FilePasswordVerify(BaseModel):
     password: str
 
@@ -253,67 +301,1006 @@ class ThemeUpdate(BaseModel):
     theme: str
 
 # Storage functions
-async def upload_to_supabase(file_content: bytes, file_path: str) -> str:
-    url = f"{SUPABASE_URL}/storage/v1/object/{SUPABASE_BUCKET}/{file_path}"
-    headers = {"Authorization": f"Bearer {SUPABASE_KEY}", "Content-Type": "application/octet-stream"}
-    async with httpx.AsyncClient(timeout=30.0) as client:
-        response = await client.post(url, content=file_content, headers=headers)
+class StorageError(Exception):
+    """Falha do backend de storage (rede, bucket indisponível...)"""
+
+class StorageNotFound(StorageError):
+    """Objeto inexistente no backend"""
+
+class SupabaseStorageClient:
+    """Cliente HTTP de longa duração para o Supabase Storage (keep-alive, pool de conexões, streaming)"""
+    def __init__(self, base_url: str, api_key: str, bucket: str, max_connections: int = 20,
+                 max_keepalive_connections: int = 10, keepalive_expiry: float = 30.0, timeout: float = 30.0):
+        self.base_url = base_url
+        self.api_key = api_key
+        self.bucket = bucket
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry,
+        )
+        self.timeout = httpx.Timeout(timeout)
+        self.client: Optional[httpx.AsyncClient] = None
+    
+    async def start(self):
+        if self.client is None:
+            self.client = httpx.AsyncClient(
+                base_url=self.base_url,
+                headers={"Authorization": f"Bearer {self.api_key}"},
+                limits=self.limits,
+                timeout=self.timeout,
+                http2=SUPABASE_HTTP2,
+            )
+    
+    async def close(self):
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+    
+    async def _client(self) -> httpx.AsyncClient:
+        # Inicialização preguiçosa caso seja usado antes do evento de startup
+        if self.client is None:
+            await self.start()
+        return self.client
+    
+    def object_url(self, file_path: str) -> str:
+        return f"/storage/v1/object/{self.bucket}/{file_path}"
+    
+    @staticmethod
+    def check_download(response: httpx.Response, file_path: str, ok_statuses=(200,)):
+        if response.status_code == 404:
+            raise StorageNotFound(file_path)
+        if response.status_code not in ok_statuses:
+            raise StorageError(f"Download failed: {response.status_code}")
+    
+    async def upload(self, file_content, file_path: str) -> str:
+        """Aceita bytes ou um iterador assíncrono de chunks (enviado como corpo em streaming)"""
+        client = await self._client()
+        response = await client.post(
+            self.object_url(file_path), content=file_content,
+            headers={"Content-Type": "application/octet-stream"}
+        )
         if response.status_code not in [200, 201]:
-            raise Exception(f"Upload failed: {response.status_code}")
-    return file_path
-
-async def download_from_supabase(file_path: str) -> bytes:
-    url = f"{SUPABASE_URL}/storage/v1/object/{SUPABASE_BUCKET}/{file_path}"
-    headers = {"Authorization": f"Bearer {SUPABASE_KEY}"}
-    async with httpx.AsyncClient(timeout=30.0) as client:
-        response = await client.get(url, headers=headers)
-        if response.status_code != 200:
-            raise Exception(f"Download failed: {response.status_code}")
-    return response.content
-
-async def delete_from_supabase(file_path: str):
-    url = f"{SUPABASE_URL}/storage/v1/object/{SUPABASE_BUCKET}/{file_path}"
-    headers = {"Authorization": f"Bearer {SUPABASE_KEY}"}
-    async with httpx.AsyncClient(timeout=30.0) as client:
-        await client.delete(url, headers=headers)
-
-async def save_file_to_storage(file_content: bytes, filename: str, original_name: str, uploaded_by: str) -> dict:
-    if STORAGE_MODE == "supabase":
+            raise StorageError(f"Upload failed: {response.status_code}")
+        return file_path
+    
+    async def download(self, file_path: str) -> bytes:
+        client = await self._client()
+        response = await client.get(self.object_url(file_path))
+        self.check_download(response, file_path)
+        return response.content
+    
+    async def open_download(self, file_path: str, headers: Optional[dict] = None) -> httpx.Response:
+        """Abre o download em streaming; quem chama deve consumir/fechar a resposta"""
+        client = await self._client()
+        request = client.build_request("GET", self.object_url(file_path), headers=headers)
+        response = await client.send(request, stream=True)
+        if response.status_code not in [200, 206]:
+            await response.aclose()
+            self.check_download(response, file_path, (200, 206))
+        return response
+    
+    async def exists(self, file_path: str) -> bool:
+        client = await self._client()
+        response = await client.head(self.object_url(file_path))
+        return response.status_code == 200
+    
+    async def delete(self, file_path: str):
+        client = await self._client()
+        await client.delete(self.object_url(file_path))
+
+supabase_storage = SupabaseStorageClient(
+    SUPABASE_URL or "", SUPABASE_KEY or "", SUPABASE_BUCKET,
+    max_connections=int(os.environ.get("SUPABASE_MAX_CONNECTIONS", 20)),
+    max_keepalive_connections=int(os.environ.get("SUPABASE_MAX_KEEPALIVE", 10)),
+    keepalive_expiry=float(os.environ.get("SUPABASE_KEEPALIVE_EXPIRY", 30)),
+    timeout=float(os.environ.get("SUPABASE_TIMEOUT", 30)),
+)
+
+class StorageStream:
+    """Corpo de download em streaming devolvido por StorageBackend.open_stream"""
+    def __init__(self, body, status_code: int = 200, headers: Optional[dict] = None):
+        self.body = body
+        self.status_code = status_code
+        self.headers = headers or {}
+
+class StorageBackend(ABC):
+    """Interface comum dos backends de storage.
+
+    `location` é o valor gravado em FileMetadata.storage_location; as chaves são
+    o `filename` (local/memória) ou o `supabase_path` (bucket remoto).
+    """
+    location = ""
+    
+    def key_for(self, filename: str, uploaded_by: Optional[str] = None) -> str:
+        return filename
+    
+    @abstractmethod
+    async def write_stream(self, key: str, chunks):
+        ...
+    
+    async def write_file(self, key: str, src_path: Path):
+        """Grava a partir de um arquivo temporário local (que pode ser movido/consumido)"""
+        await self.write_stream(key, iter_local_file(src_path))
+    
+    @abstractmethod
+    async def exists(self, key: str) -> bool:
+        ...
+    
+    @abstractmethod
+    async def read(self, key: str) -> bytes:
+        ...
+    
+    @abstractmethod
+    async def open_stream(self, key: str, headers: Optional[dict] = None) -> StorageStream:
+        ...
+    
+    @abstractmethod
+    async def delete(self, key: str):
+        ...
+    
+    async def local_path(self, key: str) -> Optional[Path]:
+        """Caminho em disco, quando existe, para servir via FileResponse/Range"""
+        return None
+    
+    async def start(self):
+        pass
+    
+    async def close(self):
+        pass
+
+async def iter_bytes(content: bytes, chunk_size: int = UPLOAD_CHUNK_SIZE):
+    for i in range(0, len(content), chunk_size):
+        yield content[i:i + chunk_size]
+
+async def iter_local_file(file_path: Path, chunk_size: int = UPLOAD_CHUNK_SIZE):
+    async with aiofiles.open(file_path, 'rb') as f:
+        while True:
+            chunk = await f.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+async def write_chunks_to_path(chunks, file_path: Path) -> int:
+    """Grava os chunks via arquivo temporário + rename atômico; devolve o tamanho"""
+    tmp_path = file_path.with_name(f".{file_path.name}.{uuid.uuid4().hex}.part")
+    size = 0
+    try:
+        async with aiofiles.open(tmp_path, 'wb') as out_file:
+            async for chunk in chunks:
+                size += len(chunk)
+                await out_file.write(chunk)
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+    return size
+
+class LocalStorageBackend(StorageBackend):
+    location = "local"
+    
+    def __init__(self, root: Path):
+        self.root = root
+    
+    def path(self, key: str) -> Path:
+        return self.root / key
+    
+    async def write_stream(self, key: str, chunks):
+        file_path = self.path(key)
+        file_path.parent.mkdir(parents=True, exist_ok=True)
+        await write_chunks_to_path(chunks, file_path)
+    
+    async def write_file(self, key: str, src_path: Path):
+        file_path = self.path(key)
+        file_path.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(src_path, file_path)
+    
+    async def exists(self, key: str) -> bool:
+        return self.path(key).exists()
+    
+    async def read(self, key: str) -> bytes:
+        file_path = self.path(key)
+        if not file_path.exists():
+            raise StorageNotFound(key)
+        async with aiofiles.open(file_path, 'rb') as f:
+            return await f.read()
+    
+    async def open_stream(self, key: str, headers: Optional[dict] = None) -> StorageStream:
+        file_path = self.path(key)
+        if not file_path.exists():
+            raise StorageNotFound(key)
+        return StorageStream(iter_local_file(file_path), headers={"content-length": str(file_path.stat().st_size)})
+    
+    async def delete(self, key: str):
+        self.path(key).unlink(missing_ok=True)
+    
+    async def local_path(self, key: str) -> Optional[Path]:
+        file_path = self.path(key)
+        return file_path if file_path.exists() else None
+
+class MemoryStorageBackend(StorageBackend):
+    """Backend em memória, para testes e desenvolvimento"""
+    location = "memory"
+    
+    def __init__(self):
+        self.objects: Dict[str, bytes] = {}
+    
+    async def write_stream(self, key: str, chunks):
+        self.objects[key] = b"".join([chunk async for chunk in chunks])
+    
+    async def exists(self, key: str) -> bool:
+        return key in self.objects
+    
+    async def read(self, key: str) -> bytes:
+        if key not in self.objects:
+            raise StorageNotFound(key)
+        return self.objects[key]
+    
+    async def open_stream(self, key: str, headers: Optional[dict] = None) -> StorageStream:
+        content = await self.read(key)
+        return StorageStream(iter_bytes(content), headers={"content-length": str(len(content))})
+    
+    async def delete(self, key: str):
+        self.objects.pop(key, None)
+
+class SupabaseStorageBackend(StorageBackend):
+    """Bucket remoto (Supabase Storage, API compatível com S3 via HTTP)"""
+    location = "supabase"
+    
+    def __init__(self, storage_client: SupabaseStorageClient):
+        self.storage_client = storage_client
+    
+    def key_for(self, filename: str, uploaded_by: Optional[str] = None) -> str:
+        # Blobs endereçados por conteúdo são compartilhados, sem prefixo de usuário
+        return f"{uploaded_by}/{filename}" if uploaded_by else filename
+    
+    async def write_stream(self, key: str, chunks):
+        await self.storage_client.upload(chunks, key)
+    
+    async def exists(self, key: str) -> bool:
+        return await self.storage_client.exists(key)
+    
+    async def read(self, key: str) -> bytes:
+        return await self.storage_client.download(key)
+    
+    async def open_stream(self, key: str, headers: Optional[dict] = None) -> StorageStream:
+        upstream = await self.storage_client.open_download(key, headers)
+        relayed = {name: upstream.headers[name]
+                   for name in ("content-length", "content-range", "accept-ranges", "etag", "last-modified")
+                   if name in upstream.headers}
+        return StorageStream(iter_response_body(upstream), upstream.status_code, relayed)
+    
+    async def delete(self, key: str):
+        await self.storage_client.delete(key)
+    
+    async def start(self):
+        await self.storage_client.start()
+    
+    async def close(self):
+        await self.storage_client.close()
+
+class TieredStorageBackend(StorageBackend):
+    """Cache quente em disco local na frente do bucket remoto.
+
+    - leituras servem do disco; um miss baixa o objeto (em streaming) para o cache
+    - LRU por orçamento de bytes; objetos ainda não enviados (dirty) nunca são despejados
+    - escrita write-back: grava no disco e envia ao remoto em background
+    """
+    def __init__(self, remote: StorageBackend, cache_dir: Path, max_bytes: int,
+                 max_object_bytes: Optional[int] = None, write_back: bool = True):
+        self.remote = remote
+        self.location = remote.location
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.max_object_bytes = max_object_bytes if max_object_bytes is not None else max_bytes // 4
+        self.write_back = write_back
+        self.entries: "OrderedDict[str, int]" = OrderedDict()
+        self.cached_bytes = 0
+        self.dirty: Set[str] = set()
+        self.pending: Dict[str, asyncio.Task] = {}
+        self.fills: Dict[str, asyncio.Task] = {}
+        self.hits = 0
+        self.misses = 0
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.journal_path = self.cache_dir / ".writeback.json"
+    
+    def key_for(self, filename: str, uploaded_by: Optional[str] = None) -> str:
+        return self.remote.key_for(filename, uploaded_by)
+    
+    def path(self, key: str) -> Path:
+        # Chave remota pode ter "/" (usuario/arquivo); no cache vira um nome plano
+        return self.cache_dir / hashlib.sha256(key.encode()).hexdigest()
+    
+    async def start(self):
+        await self.remote.start()
+        # Reconstrói o índice LRU a partir do que já está em disco (mais antigo primeiro)
+        self.entries.clear()
+        self.cached_bytes = 0
+        for file_path in sorted(self.cache_dir.iterdir(), key=lambda p: p.stat().st_atime):
+            if file_path == self.journal_path:
+                continue
+            if file_path.name.startswith("."):
+                file_path.unlink(missing_ok=True)
+                continue
+            size = file_path.stat().st_size
+            self.entries[file_path.name] = size
+            self.cached_bytes += size
+        # Reenvia o que ficou pendente de uma execução anterior
+        if self.journal_path.exists():
+            self.dirty = {k for k in json.loads(self.journal_path.read_text()) if self.path(k).exists()}
+            for key in self.dirty:
+                self.pending[key] = asyncio.create_task(self._upload(key))
+        self._evict()
+    
+    async def close(self):
+        await self.flush()
+        await self.remote.close()
+    
+    async def flush(self):
+        """Aguarda todos os envios write-back pendentes"""
+        while self.pending:
+            await asyncio.gather(*list(self.pending.values()), return_exceptions=True)
+    
+    def _save_journal(self):
+        self.journal_path.write_text(json.dumps(sorted(self.dirty)))
+    
+    def _touch(self, key: str):
+        name = self.path(key).name
+        if name in self.entries:
+            self.entries.move_to_end(name)
+    
+    def _admit(self, key: str, size: int):
+        name = self.path(key).name
+        self.cached_bytes -= self.entries.pop(name, 0)
+        self.entries[name] = size
+        self.cached_bytes += size
+        self._evict()
+    
+    def _evict(self):
+        dirty_names = {self.path(k).name for k in self.dirty}
+        for name in list(self.entries):
+            if self.cached_bytes <= self.max_bytes:
+                break
+            if name in dirty_names:
+                continue
+            self.cached_bytes -= self.entries.pop(name)
+            (self.cache_dir / name).unlink(missing_ok=True)
+    
+    def _forget(self, key: str):
+        name = self.path(key).name
+        self.cached_bytes -= self.entries.pop(name, 0)
+        (self.cache_dir / name).unlink(missing_ok=True)
+    
+    async def write_stream(self, key: str, chunks):
+        if not self.write_back:
+            await self.remote.write_stream(key, chunks)
+            return
+        size = await write_chunks_to_path(chunks, self.path(key))
+        self._mark_dirty(key, size)
+    
+    async def write_file(self, key: str, src_path: Path):
+        if not self.write_back:
+            await self.remote.write_file(key, src_path)
+            return
+        size = src_path.stat().st_size
+        os.replace(src_path, self.path(key))
+        self._mark_dirty(key, size)
+    
+    async def exists(self, key: str) -> bool:
+        return self.path(key).exists() or await self.remote.exists(key)
+    
+    def _mark_dirty(self, key: str, size: int):
+        self.dirty.add(key)
+        self._save_journal()
+        self._admit(key, size)
+        self.pending[key] = asyncio.create_task(self._upload(key))
+    
+    async def _upload(self, key: str, attempts: int = 5):
         try:
-            file_path = f"{uploaded_by}/{filename}"
-            await upload_to_supabase(file_content, file_path)
-            return {"storage_location": "supabase", "supabase_path": file_path, "filename": filename}
-        except Exception as e:
-            logger.error(f"Supabase error: {e}")
+            for attempt in range(attempts):
+                try:
+                    await self.remote.write_stream(key, iter_local_file(self.path(key)))
+                    self.dirty.discard(key)
+                    self._save_journal()
+                    self._evict()
+                    return
+                except Exception as e:
+                    logger.error(f"Write-back de {key} falhou (tentativa {attempt + 1}): {e}")
+                    await asyncio.sleep(2 ** attempt)
+            # Continua dirty (fixo no cache) para não perder dados; nova tentativa no próximo start
+            logger.error(f"Write-back de {key} desistiu após {attempts} tentativas")
+        finally:
+            self.pending.pop(key, None)
+    
+    async def _fill(self, key: str) -> Optional[Path]:
+        """Baixa o objeto remoto para o cache; None se for grande demais para cachear"""
+        if key in self.fills:
+            return await self.fills[key]
+        
+        async def fill():
+            stream = await self.remote.open_stream(key)
+            length = stream.headers.get("content-length")
+            if length is not None and int(length) > self.max_object_bytes:
+                await stream.body.aclose()
+                return None
+            size = await write_chunks_to_path(stream.body, self.path(key))
+            self._admit(key, size)
+            return self.path(key)
+        
+        self.fills[key] = asyncio.create_task(fill())
+        try:
+            return await self.fills[key]
+        finally:
+            self.fills.pop(key, None)
+    
+    async def local_path(self, key: str) -> Optional[Path]:
+        file_path = self.path(key)
+        if file_path.exists():
+            self.hits += 1
+            self._touch(key)
+            return file_path
+        self.misses += 1
+        return await self._fill(key)
+    
+    async def read(self, key: str) -> bytes:
+        file_path = await self.local_path(key)
+        if file_path is None:
+            return await self.remote.read(key)
+        async with aiofiles.open(file_path, 'rb') as f:
+            return await f.read()
+    
+    async def open_stream(self, key: str, headers: Optional[dict] = None) -> StorageStream:
+        # Só chega aqui para objetos maiores que o limite do cache
+        return await self.remote.open_stream(key, headers)
+    
+    async def delete(self, key: str):
+        task = self.pending.pop(key, None)
+        if task:
+            task.cancel()
+        if key in self.dirty:
+            self.dirty.discard(key)
+            self._save_journal()
+        self._forget(key)
+        await self.remote.delete(key)
     
-    file_path = UPLOAD_DIR / filename
-    async with aiofiles.open(file_path, 'wb') as out_file:
-        await out_file.write(file_content)
-    return {"storage_location": "local", "supabase_path": None, "filename": filename}
+    def stats(self) -> dict:
+        return {
+            "cached_objects": len(self.entries),
+            "cached_bytes": self.cached_bytes,
+            "max_bytes": self.max_bytes,
+            "dirty_objects": len(self.dirty),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
 
-async def get_file_from_storage(file_metadata: dict) -> bytes:
+def build_storage_backends() -> Dict[str, StorageBackend]:
+    """Backends por storage_location, mais o backend primário (chave "primary") para novas gravações"""
+    local = LocalStorageBackend(UPLOAD_DIR)
+    backends: Dict[str, StorageBackend] = {"local": local, "memory": MemoryStorageBackend()}
+    if SUPABASE_URL and SUPABASE_KEY:
+        remote = SupabaseStorageBackend(supabase_storage)
+        if STORAGE_MODE == "tiered":
+            remote = TieredStorageBackend(
+                remote, UPLOAD_DIR / ".cache",
+                max_bytes=int(os.environ.get("STORAGE_CACHE_MAX_BYTES", 2 * 1024 * 1024 * 1024)),
+                write_back=os.environ.get("STORAGE_WRITE_BACK", "true").lower() == "true",
+            )
+        backends["supabase"] = remote
+    primary = "supabase" if STORAGE_MODE == "tiered" else STORAGE_MODE
+    backends["primary"] = backends.get(primary, local)
+    return backends
+
+storage_backends = build_storage_backends()
+storage_backend = storage_backends["primary"]
+
+def backend_for(file_metadata: dict) -> StorageBackend:
+    location = file_metadata.get("storage_location") or "local"
+    if location not in storage_backends:
+        raise HTTPException(status_code=503, detail=f"Storage '{location}' not configured")
+    return storage_backends[location]
+
+def storage_key(file_metadata: dict) -> str:
     if file_metadata.get("storage_location") == "supabase":
+        return file_metadata["supabase_path"]
+    return file_metadata["filename"]
+
+async def iter_response_body(response: httpx.Response):
+    try:
+        async for chunk in response.aiter_bytes():
+            yield chunk
+    finally:
+        await response.aclose()
+
+class UploadDigest:
+    """Conta bytes e calcula o SHA-256 conforme os chunks passam"""
+    def __init__(self):
+        self.size = 0
+        self._sha256 = hashlib.sha256()
+
+    def update(self, chunk: bytes):
+        self.size += len(chunk)
+        self._sha256.update(chunk)
+
+    def hexdigest(self) -> str:
+        return self._sha256.hexdigest()
+
+async def iter_upload_chunks(file: UploadFile, chunk_size: int = UPLOAD_CHUNK_SIZE):
+    """Lê o UploadFile em blocos de tamanho fixo"""
+    while True:
+        chunk = await file.read(chunk_size)
+        if not chunk:
+            break
+        yield chunk
+
+def blob_filename(checksum: str) -> str:
+    """Nome do blob endereçado por conteúdo (SHA-256), compartilhado entre todos os registros iguais"""
+    return f"blobs/{checksum[:2]}/{checksum}"
+
+def is_content_addressed(file_metadata: dict) -> bool:
+    return bool(file_metadata.get("checksum")) and file_metadata.get("filename") == blob_filename(file_metadata["checksum"])
+
+async def spool_chunks(chunks) -> Path:
+    """Grava o fluxo num arquivo temporário local (memória limitada a um chunk)"""
+    UPLOAD_TMP_DIR.mkdir(parents=True, exist_ok=True)
+    spool_path = UPLOAD_TMP_DIR / uuid.uuid4().hex
+    await write_chunks_to_path(chunks, spool_path)
+    return spool_path
+
+async def save_spooled_to_storage(spool_path: Path, filename: str, uploaded_by: Optional[str] = None) -> dict:
+    """Move o arquivo temporário para o backend primário, com fallback para o disco local"""
+    backends = [storage_backend]
+    if storage_backend.location != "local":
+        backends.append(storage_backends["local"])
+    
+    for backend in backends:
+        key = backend.key_for(filename, uploaded_by)
         try:
-            return await download_from_supabase(file_metadata["supabase_path"])
-        except:
-            pass
+            await backend.write_file(key, spool_path)
+        except Exception as e:
+            if backend is backends[-1]:
+                raise
+            logger.error(f"Storage '{backend.location}' falhou, gravando localmente: {e}")
+            continue
+        return {"storage_location": backend.location,
+                "supabase_path": key if backend.location == "supabase" else None,
+                "filename": filename}
+
+# Uploads deduplicados x exclusão do último registro de um blob: cada blob em uso tem um
+# documento em blob_guards com os uploads em andamento (entre achar/gravar o blob e inserir
+# o registro) e, durante uma exclusão, o instante em que ela começou. Um não avança enquanto
+# o outro está em curso; uma exclusão interrompida expira após BLOB_GUARD_STALE_SECONDS.
+BLOB_GUARD_STALE_SECONDS = 300
+BLOB_GUARD_POLL_SECONDS = 0.2
+
+async def acquire_blob_guard(filename: str):
+    """Registra um upload em andamento para o blob; espera a exclusão dele, se houver uma"""
+    guard = await db.blob_guards.find_one_and_update(
+        {"_id": filename}, {"$inc": {"uploads": 1}}, upsert=True, return_document=ReturnDocument.AFTER
+    )
+    while guard and (guard.get("deleting") or 0) > time.time() - BLOB_GUARD_STALE_SECONDS:
+        await asyncio.sleep(BLOB_GUARD_POLL_SECONDS)
+        guard = await db.blob_guards.find_one({"_id": filename})
+
+async def release_blob_guard(filename: str):
+    await db.blob_guards.update_one({"_id": filename}, {"$inc": {"uploads": -1}})
+    await db.blob_guards.delete_one({"_id": filename, "uploads": {"$lte": 0}, "deleting": None})
+
+async def claim_blob_deletion(filename: str) -> bool:
+    """Marca a exclusão do blob; falha se há upload em andamento ou outra exclusão ativa"""
+    now = time.time()
+    try:
+        await db.blob_guards.update_one(
+            {"_id": filename, "uploads": {"$lte": 0},
+             "$or": [{"deleting": None}, {"deleting": {"$lt": now - BLOB_GUARD_STALE_SECONDS}}]},
+            {"$set": {"deleting": now}, "$setOnInsert": {"uploads": 0}},
+            upsert=True
+        )
+    except DuplicateKeyError:
+        return False
+    return True
+
+async def finish_blob_deletion(filename: str):
+    await db.blob_guards.update_one({"_id": filename}, {"$set": {"deleting": None}})
+    await db.blob_guards.delete_one({"_id": filename, "uploads": {"$lte": 0}, "deleting": None})
+
+@asynccontextmanager
+async def store_content_addressed(chunks):
+    """Grava o conteúdo como blob SHA-256; se o blob já existe, nada é gravado (só metadados).
+
+    Context manager: o registro que referencia o blob deve ser gravado dentro do bloco,
+    para que uma exclusão concorrente não apague o blob antes disso.
+    """
+    digest = UploadDigest()
+    spool_path = await spool_chunks(iter_digested(chunks, digest))
+    try:
+        checksum = digest.hexdigest()
+        filename = blob_filename(checksum)
+        await acquire_blob_guard(filename)
+        try:
+            existing = await db.files.find_one(
+                {"checksum": checksum, "filename": filename},
+                {"_id": 0, "filename": 1, "storage_location": 1, "supabase_path": 1}
+            )
+            if existing and await backend_for(existing).exists(storage_key(existing)):
+                storage_info = {"storage_location": existing["storage_location"],
+                                "supabase_path": existing.get("supabase_path"),
+                                "filename": filename, "deduplicated": True}
+            else:
+                storage_info = await save_spooled_to_storage(spool_path, filename)
+                storage_info["deduplicated"] = False
+        except BaseException:
+            await release_blob_guard(filename)
+            raise
+    finally:
+        spool_path.unlink(missing_ok=True)
     
-    file_path = UPLOAD_DIR / file_metadata["filename"]
-    if not file_path.exists():
+    storage_info.update({"file_size": digest.size, "checksum": checksum})
+    try:
+        yield storage_info
+    finally:
+        await release_blob_guard(filename)
+
+async def iter_digested(chunks, digest: UploadDigest):
+    async for chunk in chunks:
+        digest.update(chunk)
+        yield chunk
+
+def save_upload_to_storage(file: UploadFile):
+    """Grava o UploadFile em streaming (memória limitada a um chunk por request), com deduplicação"""
+    return store_content_addressed(iter_upload_chunks(file))
+
+async def get_file_from_storage(file_metadata: dict) -> bytes:
+    try:
+        return await backend_for(file_metadata).read(storage_key(file_metadata))
+    except StorageNotFound:
         raise HTTPException(status_code=404, detail="File not found")
-    async with aiofiles.open(file_path, 'rb') as f:
-        return await f.read()
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Storage error: {e}")
+        raise HTTPException(status_code=502, detail="Storage unavailable")
 
 async def delete_file_from_storage(file_metadata: dict):
-    if file_metadata.get("storage_location") == "supabase":
-        try:
-            await delete_from_supabase(file_metadata["supabase_path"])
-        except:
-            pass
+    try:
+        await backend_for(file_metadata).delete(storage_key(file_metadata))
+    except Exception as e:
+        logger.error(f"Storage delete error: {e}")
+
+async def release_file_storage(file_metadata: dict):
+    """Chamado depois de remover o registro: apaga o blob só quando era a última referência"""
+    if not is_content_addressed(file_metadata):
+        await delete_file_from_storage(file_metadata)
+        await delete_renditions(file_metadata)
+        return
+    # Com upload deduplicado em andamento o blob fica: o registro novo vai referenciá-lo
+    if not await claim_blob_deletion(file_metadata["filename"]):
+        return
+    try:
+        if await db.files.count_documents(
+            {"checksum": file_metadata["checksum"], "filename": file_metadata["filename"]}, limit=1
+        ):
+            return
+        await delete_file_from_storage(file_metadata)
+        await delete_renditions(file_metadata)
+    finally:
+        await finish_blob_deletion(file_metadata["filename"])
+
+async def release_files_storage(files: List[dict]):
+    """release_file_storage em lote: uma consulta descarta os blobs ainda referenciados; o resto é
+    liberado com concorrência limitada"""
+    blobs = {}
+    for file_metadata in files:
+        blobs.setdefault((file_metadata.get("storage_location"), file_metadata["filename"]), file_metadata)
+    
+    shared = [f for f in blobs.values() if is_content_addressed(f)]
+    still_referenced = set()
+    if shared:
+        still_referenced = set(await db.files.distinct(
+            "filename", {"filename": {"$in": [f["filename"] for f in shared]}}
+        ))
+    
+    semaphore = asyncio.Semaphore(BULK_STORAGE_CONCURRENCY)
+    
+    async def release(file_metadata: dict):
+        # Os candidatos passam pela checagem com trava de release_file_storage (uploads concorrentes)
+        async with semaphore:
+            await release_file_storage(file_metadata)
+    
+    await asyncio.gather(*(
+        release(f) for f in blobs.values()
+        if not (is_content_addressed(f) and f["filename"] in still_referenced)
+    ))
+
+# Downloads locais: resposta baseada em arquivo com Range / ETag
+def file_etag(file_metadata: dict, stat_result: os.stat_result) -> str:
+    if file_metadata.get("checksum"):
+        return f'"{file_metadata["checksum"]}"'
+    return f'"{stat_result.st_size:x}-{stat_result.st_mtime_ns:x}"'
+
+def parse_range_header(range_header: str, file_size: int):
+    """Interpreta um único intervalo 'bytes=início-fim'; devolve (início, fim) inclusivo ou None"""
+    unit, _, ranges = range_header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in ranges:
+        return None
+    start_str, _, end_str = ranges.strip().partition("-")
+    try:
+        if start_str:
+            start = int(start_str)
+            end = int(end_str) if end_str else file_size - 1
+        else:
+            # Sufixo: "bytes=-500" são os últimos 500 bytes
+            start = max(file_size - int(end_str), 0)
+            end = file_size - 1
+    except ValueError:
+        return None
+    end = min(end, file_size - 1)
+    if start > end:
+        raise HTTPException(status_code=416, headers={"Content-Range": f"bytes */{file_size}"})
+    return start, end
+
+async def iter_file_range(file_path: Path, start: int, end: int, chunk_size: int = UPLOAD_CHUNK_SIZE):
+    async with aiofiles.open(file_path, 'rb') as f:
+        await f.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = await f.read(min(chunk_size, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+def local_file_response(request: Request, file_metadata: dict, file_path: Path, headers: Optional[dict] = None):
+    """FileResponse para arquivos em disco, com 304 (If-None-Match) e 206 (Range)"""
+    try:
+        stat_result = file_path.stat()
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="File not found")
+    
+    etag = file_etag(file_metadata, stat_result)
+    headers = {**(headers or {}), "ETag": etag, "Accept-Ranges": "bytes"}
+    media_type = file_metadata["file_type"]
+    
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and (if_none_match.strip() == "*" or etag in [t.strip() for t in if_none_match.split(",")]):
+        return Response(status_code=304, headers=headers)
+    
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    if range_header and (not if_range or if_range.strip() == etag) and stat_result.st_size > 0:
+        byte_range = parse_range_header(range_header, stat_result.st_size)
+        if byte_range:
+            start, end = byte_range
+            headers["Content-Range"] = f"bytes {start}-{end}/{stat_result.st_size}"
+            headers["Content-Length"] = str(end - start + 1)
+            return StreamingResponse(
+                iter_file_range(file_path, start, end), status_code=206, media_type=media_type, headers=headers
+            )
+    
+    return FileResponse(file_path, media_type=media_type, headers=headers, stat_result=stat_result)
+
+async def storage_file_response(request: Request, file_metadata: dict, headers: Optional[dict] = None):
+    """Resposta de download sem bufferizar: do disco quando possível (local ou cache), senão em streaming"""
+    backend = backend_for(file_metadata)
+    key = storage_key(file_metadata)
+    try:
+        file_path = await backend.local_path(key)
+        if file_path is not None:
+            return local_file_response(request, file_metadata, file_path, headers)
+        upstream_headers = {k: v for k, v in request.headers.items() if k.lower() in ("range", "if-range")}
+        stream = await backend.open_stream(key, upstream_headers)
+    except StorageNotFound:
+        raise HTTPException(status_code=404, detail="File not found")
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Storage error: {e}")
+        raise HTTPException(status_code=502, detail="Storage unavailable")
+    return StreamingResponse(
+        stream.body, status_code=stream.status_code,
+        media_type=file_metadata["file_type"], headers={**(headers or {}), **stream.headers}
+    )
+
+# ===================================================================
+# RENDITIONS - thumbnails e previews de texto gerados em background
+# ===================================================================
+RENDITION_WORKERS = int(os.environ.get("RENDITION_WORKERS", 2))
+RENDITION_THUMBNAIL_SIZE = int(os.environ.get("RENDITION_THUMBNAIL_SIZE", 480))
+RENDITION_TEXT_MAX_BYTES = int(os.environ.get("RENDITION_TEXT_MAX_BYTES", 64 * 1024))
+RENDITION_EXCERPT_CHARS = 280
+RENDITION_MAX_SOURCE_BYTES = int(os.environ.get("RENDITION_MAX_SOURCE_BYTES", 40 * 1024 * 1024))
+RENDITION_CACHE_CONTROL = "private, max-age=31536000, immutable"
+TEXT_PREVIEW_MIME_TYPES = ("application/json", "application/xml", "application/javascript", "application/x-yaml")
+
+rendition_pool: Optional[ProcessPoolExecutor] = None
+rendition_semaphore = asyncio.Semaphore(max(1, RENDITION_WORKERS))
+rendition_jobs: Dict[str, asyncio.Task] = {}
+
+def start_rendition_pool():
+    global rendition_pool
+    if RENDITION_WORKERS > 0 and renditions.thumbnails_available():
+        rendition_pool = ProcessPoolExecutor(max_workers=RENDITION_WORKERS)
+
+def stop_rendition_pool():
+    global rendition_pool
+    if rendition_pool is not None:
+        rendition_pool.shutdown(wait=False, cancel_futures=True)
+        rendition_pool = None
+
+def rendition_kinds(file_metadata: dict) -> List[str]:
+    file_type = file_metadata.get("file_type", "")
+    if file_type.startswith("text/") or file_type in TEXT_PREVIEW_MIME_TYPES:
+        return ["text"]
+    if file_type.startswith("image/") and file_type != "image/svg+xml" and renditions.thumbnails_available():
+        return ["thumbnail"]
+    return []
+
+def rendition_filename(file_metadata: dict, kind: str) -> str:
+    # Renditions de blobs endereçados por conteúdo são compartilhadas entre as cópias deduplicadas
+    if is_content_addressed(file_metadata):
+        checksum = file_metadata["checksum"]
+        return f"renditions/{checksum[:2]}/{checksum}.{kind}"
+    return f"renditions/{file_metadata['id']}.{kind}"
+
+async def read_source_head(file_metadata: dict, limit: int) -> bytes:
+    """Lê só os primeiros `limit` bytes do arquivo (Range no storage remoto)"""
+    backend = backend_for(file_metadata)
+    key = storage_key(file_metadata)
+    file_path = await backend.local_path(key)
+    if file_path is not None:
+        async with aiofiles.open(file_path, 'rb') as f:
+            return await f.read(limit)
+    stream = await backend.open_stream(key, {"range": f"bytes=0-{limit - 1}"})
+    head = bytearray()
+    try:
+        async for chunk in stream.body:
+            head += chunk
+            if len(head) >= limit:
+                break
+    finally:
+        await stream.body.aclose()
+    return bytes(head[:limit])
+
+async def render_rendition(file_metadata: dict, kind: str) -> Optional[tuple]:
+    """Gera uma rendition; devolve (conteúdo, mime_type, extras) ou None quando não se aplica"""
+    if kind == "text":
+        head = await read_source_head(file_metadata, RENDITION_TEXT_MAX_BYTES)
+        content, truncated, excerpt = renditions.render_text_preview(
+            head, RENDITION_TEXT_MAX_BYTES, file_metadata["file_size"], RENDITION_EXCERPT_CHARS
+        )
+        return content, "text/plain; charset=utf-8", {"truncated": truncated, "excerpt": excerpt}
+    
+    if file_metadata["file_size"] > RENDITION_MAX_SOURCE_BYTES:
+        return None
+    # O worker lê direto do disco quando possível; senão recebe os bytes (só storage remoto)
+    backend = backend_for(file_metadata)
+    file_path = await backend.local_path(storage_key(file_metadata))
+    source = str(file_path) if file_path is not None else await backend.read(storage_key(file_metadata))
+    size = (RENDITION_THUMBNAIL_SIZE, RENDITION_THUMBNAIL_SIZE)
+    content = await asyncio.get_running_loop().run_in_executor(
+        rendition_pool, renditions.render_thumbnail, source, size
+    )
+    return content, renditions.THUMBNAIL_MIME_TYPE, {}
+
+async def generate_renditions(file_metadata: dict) -> dict:
+    """Gera e grava no storage as renditions do arquivo; o resultado fica em files.renditions"""
+    if file_metadata.get("checksum") and is_content_addressed(file_metadata):
+        match = {"checksum": file_metadata["checksum"], "filename": file_metadata["filename"]}
+        existing = await db.files.find_one({**match, "renditions": {"$exists": True}}, {"_id": 0, "renditions": 1})
+        if existing:
+            await db.files.update_many({**match, "renditions": {"$exists": False}},
+                                       {"$set": {"renditions": existing["renditions"]}})
+            return existing["renditions"]
     else:
-        file_path = UPLOAD_DIR / file_metadata["filename"]
-        if file_path.exists():
-            file_path.unlink()
+        match = {"id": file_metadata["id"]}
+    
+    result = {}
+    backend = backend_for(file_metadata)
+    async with rendition_semaphore:
+        for kind in rendition_kinds(file_metadata):
+            try:
+                rendered = await render_rendition(file_metadata, kind)
+                if rendered is None:
+                    continue
+                content, mime_type, extras = rendered
+                key = backend.key_for(rendition_filename(file_metadata, kind))
+                await backend.write_stream(key, iter_bytes(content))
+                result[kind] = {"key": key, "location": backend.location, "mime_type": mime_type,
+                                "size": len(content), **extras}
+            except Exception as e:
+                logger.warning(f"Rendition '{kind}' de {file_metadata['id']} falhou: {e}")
+    
+    # Mesmo vazio, marca como processado para não tentar de novo a cada preview
+    await db.files.update_many(match, {"$set": {"renditions": result}})
+    return result
+
+async def ensure_renditions(file_metadata: dict) -> dict:
+    """Renditions do arquivo, gerando sob demanda (uma única tarefa por blob) se ainda não existem"""
+    if "renditions" in file_metadata:
+        return file_metadata["renditions"]
+    if not rendition_kinds(file_metadata):
+        return {}
+    job_key = file_metadata.get("checksum") or file_metadata["id"]
+    job = rendition_jobs.get(job_key)
+    if job is None:
+        job = asyncio.create_task(generate_renditions(file_metadata))
+        rendition_jobs[job_key] = job
+        job.add_done_callback(lambda _: rendition_jobs.pop(job_key, None))
+    return await asyncio.shield(job)
+
+def schedule_renditions(file_metadata: dict):
+    """Chamado no upload: gera as renditions em background, sem atrasar a resposta"""
+    if rendition_kinds(file_metadata):
+        start_background_task(ensure_renditions(file_metadata))
+
+async def read_rendition(rendition: dict) -> bytes:
+    return await storage_backends[rendition["location"]].read(rendition["key"])
+
+async def delete_renditions(file_metadata: dict):
+    for rendition in (file_metadata.get("renditions") or {}).values():
+        try:
+            await storage_backends[rendition["location"]].delete(rendition["key"])
+        except Exception as e:
+            logger.error(f"Storage delete error: {e}")
+
+class PreviewCache:
+    """LRU limitado em bytes dos payloads de /preview já serializados.
+
+    A chave inclui a versão do conteúdo (checksum ou filename), então uma entrada
+    nunca fica desatualizada; invalidate() só libera memória de arquivos removidos.
+    """
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.entries: "OrderedDict[tuple, tuple]" = OrderedDict()
+        self.cached_bytes = 0
+        self.hits = 0
+        self.misses = 0
+    
+    def get(self, key: tuple) -> Optional[tuple]:
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry
+    
+    def set(self, key: tuple, payload: bytes, etag: str):
+        if len(payload) > self.max_bytes:
+            return
+        self.invalidate(key[0])
+        self.entries[key] = (payload, etag)
+        self.cached_bytes += len(payload)
+        while self.cached_bytes > self.max_bytes:
+            _, (evicted, _) = self.entries.popitem(last=False)
+            self.cached_bytes -= len(evicted)
+    
+    def invalidate(self, file_id: str):
+        for key in [k for k in self.entries if k[0] == file_id]:
+            payload, _ = self.entries.pop(key)
+            self.cached_bytes -= len(payload)
+    
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "cached_bytes": self.cached_bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 3) if total else None,
+        }
+
+preview_cache = PreviewCache(max_bytes=int(os.environ.get("PREVIEW_CACHE_MAX_BYTES", 64 * 1024 * 1024)))
+
+def preview_version(file_metadata: dict) -> str:
+    return file_metadata.get("checksum") or file_metadata["filename"]
+
+def http_date(value) -> str:
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return format_datetime(value.astimezone(timezone.utc), usegmt=True)
 
 # Auth helpers
 def verify_password(plain_password, hashed_password):
@@ -329,38 +1316,413 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
 
 async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    return await get_user_from_token(credentials.credentials)
+
+async def get_current_user_or_query_token(request: Request, credentials: Optional[HTTPAuthorizationCredentials] = Depends(optional_security)):
+    """Como get_current_user, mas aceita ?token= (tags <video>/<iframe> não enviam Authorization)"""
+    token = credentials.credentials if credentials else request.query_params.get("token")
+    if not token:
+        raise HTTPException(status_code=401)
+    return await get_user_from_token(token)
+
+CacheValue = TypeVar("CacheValue")
+
+class TTLCache(Generic[CacheValue]):
+    """Cache em memória TTL + LRU por chave (string).
+
+    Quem altera os dados de origem chama invalidate(); o TTL limita a defasagem entre workers.
+    """
+    def __init__(self, max_entries: int = 1024, ttl_seconds: float = 60.0):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+    
+    def get(self, key: str) -> Optional[CacheValue]:
+        entry = self.entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self.entries[key]
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+    
+    def set(self, key: str, value: CacheValue):
+        self.entries[key] = (time.monotonic() + self.ttl_seconds, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+    
+    def invalidate(self, *keys: Optional[str]):
+        for key in keys:
+            if key:
+                self.entries.pop(key, None)
+    
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 3) if total else None,
+        }
+
+# Usuários autenticados por username: evita um find_one em users a cada request autenticado
+user_cache: TTLCache[User] = TTLCache(
+    max_entries=int(os.environ.get("USER_CACHE_MAX_ENTRIES", 1024)),
+    ttl_seconds=float(os.environ.get("USER_CACHE_TTL_SECONDS", 60)),
+)
+
+def token_username(token: str) -> str:
+    """Valida o JWT de acesso e devolve o username (tokens com "typ", como tickets, não valem aqui)"""
     try:
-        token = credentials.credentials
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        username = payload.get("sub")
-        if not username:
-            raise HTTPException(status_code=401)
     except JWTError:
         raise HTTPException(status_code=401)
-    
+    username = payload.get("sub")
+    if not username or payload.get("typ"):
+        raise HTTPException(status_code=401)
+    return username
+
+async def get_user_from_token(token: str) -> User:
+    return await get_user_by_username(token_username(token))
+
+async def get_user_by_username(username: str) -> User:
+    cached = user_cache.get(username)
+    if cached:
+        return cached
     user = await db.users.find_one({"username": username}, {"_id": 0})
     if not user:
         raise HTTPException(status_code=401)
-    return User(**user)
+    user = User(**user)
+    user_cache.set(username, user)
+    return user
 
 async def get_admin_user(current_user: User = Depends(get_current_user)):
     if current_user.role != "admin":
         raise HTTPException(status_code=403)
     return current_user
 
-# Startup
-@app.on_event("startup")
-async def startup_event():
-    admin = await db.users.find_one({"username": "Masterotaku"})
-    if not admin:
-        admin_user = User(username="Masterotaku", role="admin")
-        admin_doc = admin_user.model_dump()
-        admin_doc["password_hash"] = get_password_hash("adm123")
-        admin_doc["created_at"] = admin_doc["created_at"].isoformat()
+# ===================================================================
+# ACCESS CONTROL - permissões de leitura de arquivos e times
+# ===================================================================
+# Ids dos times de cada usuário; as rotas que mudam membros de um time invalidam os afetados
+team_membership_cache: TTLCache[frozenset] = TTLCache(
+    max_entries=int(os.environ.get("TEAM_CACHE_MAX_ENTRIES", 4096)),
+    ttl_seconds=float(os.environ.get("TEAM_CACHE_TTL_SECONDS", 30)),
+)
+
+async def load_team_ids(username: str) -> frozenset:
+    team_ids = team_membership_cache.get(username)
+    if team_ids is None:
+        teams = await db.teams.find({"members": username}, {"_id": 0, "id": 1}).to_list(None)
+        team_ids = frozenset(team["id"] for team in teams)
+        team_membership_cache.set(username, team_ids)
+    return team_ids
+
+class FileAccess:
+    """Resolve permissões de um usuário; os times são carregados uma vez por instância (request).
+
+    Leitura de um arquivo: dono, membro do time do arquivo ou usuário em shared_with.
+    """
+    def __init__(self, user: User):
+        self.user = user
+        self._team_ids: Optional[frozenset] = None
+    
+    async def team_ids(self) -> frozenset:
+        if self._team_ids is None:
+            self._team_ids = await load_team_ids(self.user.username)
+        return self._team_ids
+    
+    async def is_team_member(self, team_id: Optional[str]) -> bool:
+        return bool(team_id) and team_id in await self.team_ids()
+    
+    async def require_team_member(self, team_id: str):
+        if not await self.is_team_member(team_id):
+            raise HTTPException(status_code=403)
+    
+    async def can_read(self, file_metadata: dict) -> bool:
+        return (
+            file_metadata["uploaded_by"] == self.user.username
+            or self.user.username in file_metadata.get("shared_with", [])
+            or await self.is_team_member(file_metadata.get("team_id"))
+        )
+    
+    async def require_read(self, file_metadata: dict):
+        if not await self.can_read(file_metadata):
+            raise HTTPException(status_code=403)
+    
+    async def files_query(self) -> dict:
+        """Filtro Mongo equivalente a can_read, para listagens e checagens em lote"""
+        return {"$or": [
+            {"uploaded_by": self.user.username},
+            {"team_id": {"$in": list(await self.team_ids())}},
+            {"shared_with": self.user.username}
+        ]}
+    
+    async def readable_files(self, file_ids: List[str], projection: Optional[dict] = None) -> Dict[str, dict]:
+        """Checa muitos arquivos numa única consulta; devolve só os legíveis, por id"""
+        if not file_ids:
+            return {}
+        query = {"$and": [{"id": {"$in": list(file_ids)}}, await self.files_query()]}
+        files = await db.files.find(query, {"_id": 0, **(projection or {})}).to_list(None)
+        return {f["id"]: f for f in files}
+
+async def get_file_access(current_user: User = Depends(get_current_user)) -> FileAccess:
+    return FileAccess(current_user)
+
+async def get_readable_file(file_id: str, access: FileAccess) -> dict:
+    file_metadata = await db.files.find_one({"id": file_id}, {"_id": 0})
+    if not file_metadata:
+        raise HTTPException(status_code=404)
+    await access.require_read(file_metadata)
+    return file_metadata
+
+# ===================================================================
+# MONGODB INDEXES - declarados por coleção, garantidos no startup
+# ===================================================================
+def index(keys, unique: bool = False, partial: Optional[dict] = None) -> IndexModel:
+    options = {"unique": unique}
+    if partial:
+        options["partialFilterExpression"] = partial
+    return IndexModel(keys, **options)
+
+MONGO_INDEXES: Dict[str, List[IndexModel]] = {
+    "users": [
+        index([("username", ASCENDING)], unique=True),
+        index([("id", ASCENDING)], unique=True),
+        index([("email", ASCENDING)], unique=True, partial={"email": {"$type": "string"}}),
+        index([("google_id", ASCENDING)], unique=True, partial={"google_id": {"$type": "string"}}),
+        index([("discord_id", ASCENDING)], unique=True, partial={"discord_id": {"$type": "string"}}),
+    ],
+    "files": [
+        index([("id", ASCENDING)], unique=True),
+        index([("uploaded_by", ASCENDING), ("uploaded_at", DESCENDING)]),
+        index([("team_id", ASCENDING), ("uploaded_at", DESCENDING)]),
+        index([("shared_with", ASCENDING)]),
+        index([("checksum", ASCENDING), ("filename", ASCENDING)]),
+        index([("uploaded_at", ASCENDING), ("id", ASCENDING)]),
+        # Ordenação por nome e name_prefix (regex ancorada e sensível a maiúsculas usa o índice)
+        index([("original_name", ASCENDING), ("id", ASCENDING)]),
+        index([("updated_at", ASCENDING)], partial={"updated_at": {"$exists": True}}),
+    ],
+    "teams": [
+        index([("id", ASCENDING)], unique=True),
+        index([("members", ASCENDING)]),
+    ],
+    "team_invites": [
+        index([("id", ASCENDING)], unique=True),
+        index([("invitee_username", ASCENDING), ("status", ASCENDING)]),
+        index([("team_id", ASCENDING), ("invitee_username", ASCENDING), ("status", ASCENDING)]),
+    ],
+    "chat_messages": [
+        index([("timestamp", DESCENDING), ("id", DESCENDING)]),
+        index([("id", ASCENDING)], unique=True),
+    ],
+    "settings": [
+        index([("key", ASCENDING)], unique=True),
+    ],
+    "upload_sessions": [
+        index([("id", ASCENDING)], unique=True),
+        index([("status", ASCENDING), ("expires_at", ASCENDING)]),
+    ],
+    "backup_snapshots": [
+        index([("created_at", DESCENDING)]),
+    ],
+    "file_tombstones": [
+        index([("deleted_at", ASCENDING)]),
+    ],
+    "usage_counters": [
+        index([("scope", ASCENDING), ("key", ASCENDING)], unique=True),
+    ],
+}
+
+index_errors: Dict[str, str] = {}
+
+async def ensure_indexes():
+    """Cria os índices declarados (idempotente). Um índice que falha, p.ex. por duplicatas
+    já existentes num índice único, é registrado em index_errors sem impedir o startup."""
+    for collection_name, models in MONGO_INDEXES.items():
+        for model in models:
+            name = model.document["name"]
+            try:
+                await db[collection_name].create_indexes([model])
+                index_errors.pop(f"{collection_name}.{name}", None)
+            except Exception as e:
+                index_errors[f"{collection_name}.{name}"] = str(e)
+                logger.error(f"Índice {collection_name}.{name} não pôde ser criado: {e}")
+
+async def index_report() -> dict:
+    """Índices faltando (declarados e ausentes), sem uso ($indexStats) e não declarados, por coleção"""
+    report = {}
+    for collection_name, models in MONGO_INDEXES.items():
+        collection = db[collection_name]
+        declared = {model.document["name"] for model in models}
+        existing = {idx["name"] async for idx in collection.list_indexes()}
+        
+        usage = {}
+        try:
+            async for stat in collection.aggregate([{"$indexStats": {}}]):
+                usage[stat["name"]] = {"ops": stat["accesses"]["ops"], "since": stat["accesses"]["since"]}
+        except Exception as e:
+            logger.warning(f"$indexStats indisponível para {collection_name}: {e}")
+        
+        report[collection_name] = {
+            "missing": sorted(declared - existing),
+            "unused": sorted(name for name, u in usage.items() if name != "_id_" and u["ops"] == 0),
+            "undeclared": sorted(existing - declared - {"_id_"}),
+            "usage": usage,
+            "errors": {k.split(".", 1)[1]: v for k, v in index_errors.items() if k.split(".", 1)[0] == collection_name},
+        }
+    return report
+
+# ===================================================================
+# USAGE COUNTERS - arquivos/bytes por usuário, time e global
+# ===================================================================
+USAGE_RECONCILE_INTERVAL_SECONDS = int(os.environ.get("USAGE_RECONCILE_INTERVAL_SECONDS", 6 * 60 * 60))
+background_tasks: Set[asyncio.Task] = set()
+
+def usage_scopes(file_metadata: dict) -> List[tuple]:
+    scopes = [("global", "all"), ("user", file_metadata["uploaded_by"])]
+    if file_metadata.get("team_id"):
+        scopes.append(("team", file_metadata["team_id"]))
+    return scopes
+
+async def record_usage(file_metadata: dict, file_delta: int):
+    """Atualiza atomicamente ($inc) os contadores afetados por um upload (+1) ou exclusão (-1)"""
+    await record_usage_many([file_metadata], file_delta)
+
+async def record_usage_many(files: List[dict], file_delta: int):
+    """Como record_usage para vários arquivos: soma os deltas por contador e aplica num só bulk_write"""
+    deltas: Dict[tuple, List[int]] = {}
+    for file_metadata in files:
+        for scope in usage_scopes(file_metadata):
+            delta = deltas.setdefault(scope, [0, 0])
+            delta[0] += file_delta
+            delta[1] += file_delta * file_metadata.get("file_size", 0)
+    if not deltas:
+        return
+    now = datetime.now(timezone.utc).isoformat()
+    await db.usage_counters.bulk_write([
+        UpdateOne(
+            {"scope": scope, "key": key},
+            {"$inc": {"file_count": count, "storage_bytes": size}, "$set": {"updated_at": now}},
+            upsert=True
+        )
+        for (scope, key), (count, size) in deltas.items()
+    ], ordered=False)
+
+async def get_usage(scope: str, key: str) -> dict:
+    counter = await db.usage_counters.find_one({"scope": scope, "key": key}, {"_id": 0})
+    return counter or {"scope": scope, "key": key, "file_count": 0, "storage_bytes": 0}
+
+async def reconcile_usage_counters() -> dict:
+    """Recalcula todos os contadores a partir de files (pipeline de agregação) e corrige desvios.
+
+    Os contadores são lidos antes da agregação e cada correção é um compare-and-set sobre os
+    valores lidos: se um $inc chegou no meio (o registro em files é gravado antes do $inc),
+    a correção daquele contador é descartada ("conflicts") e fica para a próxima execução.
+    """
+    groupings = {
+        "global": [{"$group": {"_id": "all", "file_count": {"$sum": 1}, "storage_bytes": {"$sum": "$file_size"}}}],
+        "user": [{"$group": {"_id": "$uploaded_by", "file_count": {"$sum": 1}, "storage_bytes": {"$sum": "$file_size"}}}],
+        "team": [
+            {"$match": {"team_id": {"$type": "string"}}},
+            {"$group": {"_id": "$team_id", "file_count": {"$sum": 1}, "storage_bytes": {"$sum": "$file_size"}}},
+        ],
+    }
+    now = datetime.now(timezone.utc).isoformat()
+    summary = {}
+    for scope, pipeline in groupings.items():
+        current = {c["key"]: c async for c in db.usage_counters.find({"scope": scope}, {"_id": 0})}
+        totals = {row["_id"]: row async for row in db.files.aggregate(pipeline)}
+        if scope == "global" and not totals:
+            totals = {"all": {"file_count": 0, "storage_bytes": 0}}
+        
+        operations = []
+        for key, row in totals.items():
+            counter = current.get(key)
+            values = {"file_count": row["file_count"], "storage_bytes": row["storage_bytes"]}
+            if counter is None:
+                # Se um $inc criar o contador antes, $setOnInsert não faz nada
+                operations.append(UpdateOne(
+                    {"scope": scope, "key": key}, {"$setOnInsert": {**values, "updated_at": now}}, upsert=True
+                ))
+            elif counter.get("file_count") != row["file_count"] or counter.get("storage_bytes") != row["storage_bytes"]:
+                operations.append(UpdateOne(
+                    {"scope": scope, "key": key,
+                     "file_count": counter.get("file_count"), "storage_bytes": counter.get("storage_bytes")},
+                    {"$set": {**values, "updated_at": now}}
+                ))
+        for key, counter in current.items():
+            if key not in totals:
+                operations.append(DeleteOne({"scope": scope, "key": key, "file_count": counter.get("file_count"),
+                                             "storage_bytes": counter.get("storage_bytes")}))
+        corrected = 0
+        if operations:
+            result = await db.usage_counters.bulk_write(operations, ordered=False)
+            corrected = result.modified_count + result.upserted_count + result.deleted_count
+        summary[scope] = {"counters": len(totals), "corrected": corrected, "conflicts": len(operations) - corrected}
+    return summary
+
+async def acquire_task_lease(name: str, seconds: float) -> bool:
+    """Lease de uma tarefa periódica em task_leases: com vários workers, só o dono a executa"""
+    now = time.time()
+    try:
+        await db.task_leases.update_one(
+            {"_id": name, "$or": [{"worker": WORKER_ID}, {"expires_at": {"$lt": now}}]},
+            {"$set": {"worker": WORKER_ID, "expires_at": now + seconds}},
+            upsert=True
+        )
+    except DuplicateKeyError:
+        return False
+    return True
+
+async def usage_reconcile_loop():
+    while True:
+        try:
+            if await acquire_task_lease("usage_reconcile", USAGE_RECONCILE_INTERVAL_SECONDS):
+                summary = await reconcile_usage_counters()
+                logger.info(f"Contadores de uso reconciliados: {summary}")
+        except Exception as e:
+            logger.error(f"Falha ao reconciliar contadores de uso: {e}")
+        await asyncio.sleep(USAGE_RECONCILE_INTERVAL_SECONDS)
+
+def start_background_task(coro):
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+# Startup
+@app.on_event("startup")
+async def startup_event():
+    await ensure_indexes()
+    
+    admin = await db.users.find_one({"username": "Masterotaku"})
+    if not admin:
+        admin_user = User(username="Masterotaku", role="admin")
+        admin_doc = admin_user.model_dump()
+        admin_doc["password_hash"] = get_password_hash("adm123")
+        admin_doc["created_at"] = admin_doc["created_at"].isoformat()
         await db.users.insert_one(admin_doc)
     
     if not await db.settings.find_one({"key": "chat_enabled"}):
         await db.settings.insert_one({"key": "chat_enabled", "value": False})
+    
+    await cleanup_expired_upload_sessions()
+    
+    for backend in set(storage_backends.values()):
+        await backend.start()
+    
+    start_rendition_pool()
+    await pubsub.start()
+    start_background_task(usage_reconcile_loop())
+    start_background_task(chat_writer.run())
+    start_background_task(live_editor_manager.lease_loop())
 
 # Auth routes
 @api_router.post("/auth/register", response_model=Token)
@@ -399,6 +1761,7 @@ async def get_me(current_user: User = Depends(get_current_user)):
 @api_router.put("/user/theme")
 async def update_theme(data: ThemeUpdate, current_user: User = Depends(get_current_user)):
     await db.users.update_one({"username": current_user.username}, {"$set": {"theme": data.theme}})
+    user_cache.invalidate(current_user.username)
     return {"theme": data.theme}
 
 # Google OAuth
@@ -425,6 +1788,7 @@ async def google_callback(request: Request):
         if existing_user:
             if not existing_user.get("google_id"):
                 await db.users.update_one({"email": email}, {"$set": {"google_id": google_id, "avatar_url": avatar_url}})
+                user_cache.invalidate(existing_user.get("username"))
             user_data = existing_user
         else:
             username = email.split('@')[0]
@@ -460,6 +1824,7 @@ async def discord_auth(data: DiscordAuthRequest):
                 {"discord_id": data.discordId},
                 {"$set": {"username": data.username, "avatar_url": data.avatar, "email": data.email}}
             )
+            user_cache.invalidate(existing_user.get("username"), data.username)
             user_data = existing_user
         else:
             username = data.username
@@ -523,6 +1888,7 @@ async def create_team(team_data: TeamCreate, current_user: User = Depends(get_cu
     team_doc = team.model_dump()
     team_doc["created_at"] = team_doc["created_at"].isoformat()
     await db.teams.insert_one(team_doc)
+    team_membership_cache.invalidate(current_user.username)
     return team
 
 @api_router.post("/teams/{team_id}/members")
@@ -538,6 +1904,7 @@ async def add_team_member(team_id: str, data: TeamAddMember, current_user: User
         raise HTTPException(status_code=400, detail="User already in team")
     
     await db.teams.update_one({"id": team_id}, {"$push": {"members": data.username}})
+    team_membership_cache.invalidate(data.username)
     return {"message": f"{data.username} added to team"}
 
 @api_router.delete("/teams/{team_id}/members/{username}")
@@ -550,6 +1917,7 @@ async def remove_team_member(team_id: str, username: str, current_user: User = D
         raise HTTPException(status_code=403)
     
     await db.teams.update_one({"id": team_id}, {"$pull": {"members": username}})
+    team_membership_cache.invalidate(username)
     return {"message": "Member removed"}
 
 @api_router.delete("/teams/{team_id}")
@@ -562,7 +1930,9 @@ async def delete_team(team_id: str, current_user: User = Depends(get_current_use
         raise HTTPException(status_code=403)
     
     await db.teams.delete_one({"id": team_id})
-    await db.files.update_many({"team_id": team_id}, {"$set": {"team_id": None}})
+    team_membership_cache.invalidate(*team.get("members", []))
+    await db.files.update_many({"team_id": team_id}, {"$set": {"team_id": None, "updated_at": datetime.now(timezone.utc).isoformat()}})
+    await db.usage_counters.delete_one({"scope": "team", "key": team_id})
     return {"message": "Team deleted"}      
 
 # File routes
@@ -574,51 +1944,363 @@ async def upload_file(
     current_user: User = Depends(get_current_user)
 ):
     if team_id:
-        team = await db.teams.find_one({"id": team_id})
-        if not team or current_user.username not in team["members"]:
-            raise HTTPException(status_code=403)
-    
-    file_id = str(uuid.uuid4())
-    file_extension = Path(file.filename).suffix
-    filename = f"{file_id}{file_extension}"
-    
-    content = await file.read()
-    file_size = len(content)
-    storage_info = await save_file_to_storage(content, filename, file.filename, current_user.username)
+        await FileAccess(current_user).require_team_member(team_id)
     
+    async with save_upload_to_storage(file) as storage_info:
+        return await create_file_record(
+            str(uuid.uuid4()), file.filename, file.content_type, current_user.username, team_id,
+            get_password_hash(password) if password else None, storage_info
+        )
+
+async def create_file_record(file_id: str, original_name: str, file_type: Optional[str], uploaded_by: str,
+                             team_id: Optional[str], password_hash: Optional[str], storage_info: dict) -> FileMetadata:
+    """Insere o FileMetadata de um arquivo já gravado no storage"""
     file_metadata = FileMetadata(
-        id=file_id, filename=filename, original_name=file.filename,
-        file_type=file.content_type or "application/octet-stream",
-        file_size=file_size, uploaded_by=current_user.username,
+        id=file_id, filename=storage_info["filename"], original_name=original_name,
+        file_type=file_type or "application/octet-stream",
+        file_size=storage_info["file_size"], uploaded_by=uploaded_by,
         team_id=team_id, is_private=(team_id is None),
-        has_password=password is not None,
+        has_password=password_hash is not None,
         storage_location=storage_info["storage_location"],
-        supabase_path=storage_info.get("supabase_path")
+        supabase_path=storage_info.get("supabase_path"),
+        checksum=storage_info["checksum"]
     )
     
     metadata_doc = file_metadata.model_dump()
     metadata_doc["uploaded_at"] = metadata_doc["uploaded_at"].isoformat()
-    if password:
-        metadata_doc["password_hash"] = get_password_hash(password)
+    if password_hash:
+        metadata_doc["password_hash"] = password_hash
     
     await db.files.insert_one(metadata_doc)
+    await record_usage(metadata_doc, 1)
+    schedule_renditions(metadata_doc)
     return file_metadata
 
-@api_router.get("/files", response_model=List[FileMetadata])
-async def get_files(current_user: User = Depends(get_current_user)):
-    user_teams = await db.teams.find({"members": current_user.username}, {"id": 1}).to_list(1000)
-    team_ids = [team["id"] for team in user_teams]
-    query = {"$or": [
-        {"uploaded_by": current_user.username},
-        {"team_id": {"$in": team_ids}},
-        {"shared_with": current_user.username}
-    ]}
+# Upload sessions (resumable): cria sessão -> PUT das partes numeradas -> complete
+def upload_session_dir(session_id: str) -> Path:
+    return UPLOAD_SESSIONS_DIR / session_id
+
+def upload_session_status(session: dict) -> dict:
+    """Resumo da sessão para o cliente retomar a partir da última parte confirmada"""
+    parts = sorted(int(n) for n in session.get("parts", {}))
+    last_contiguous = 0
+    for n in parts:
+        if n != last_contiguous + 1:
+            break
+        last_contiguous = n
+    return {
+        "id": session["id"],
+        "original_name": session["original_name"],
+        "file_type": session.get("file_type"),
+        "total_size": session.get("total_size"),
+        "team_id": session.get("team_id"),
+        "status": session["status"],
+        "file_id": session.get("file_id"),
+        "parts": [{"part_number": n, **session["parts"][str(n)]} for n in parts],
+        "received_bytes": sum(p["size"] for p in session.get("parts", {}).values()),
+        "next_part": last_contiguous + 1,
+        "max_part_size": UPLOAD_SESSION_MAX_PART_SIZE,
+        "expires_at": session["expires_at"],
+    }
+
+async def get_open_upload_session(session_id: str, current_user: User) -> dict:
+    session = await db.upload_sessions.find_one({"id": session_id}, {"_id": 0})
+    if not session or session["uploaded_by"] != current_user.username:
+        raise HTTPException(status_code=404, detail="Upload session not found")
+    if session["status"] != "open":
+        raise HTTPException(status_code=409, detail=f"Upload session is {session['status']}")
+    return session
+
+async def iter_upload_parts(part_paths: List[Path]):
+    """Lê as partes em ordem, como um único fluxo contínuo"""
+    for part_path in part_paths:
+        async for chunk in iter_local_file(part_path):
+            yield chunk
+
+async def cleanup_expired_upload_sessions():
+    """Remove sessões abertas vencidas e suas partes em staging"""
+    now = datetime.now(timezone.utc).isoformat()
+    expired = await db.upload_sessions.find({"status": "open", "expires_at": {"$lt": now}}, {"id": 1}).to_list(1000)
+    for session in expired:
+        shutil.rmtree(upload_session_dir(session["id"]), ignore_errors=True)
+        await db.upload_sessions.update_one({"id": session["id"]}, {"$set": {"status": "expired"}})
+
+@api_router.post("/files/uploads")
+async def create_upload_session(data: UploadSessionCreate, current_user: User = Depends(get_current_user)):
+    if data.team_id:
+        await FileAccess(current_user).require_team_member(data.team_id)
+    
+    now = datetime.now(timezone.utc)
+    session_doc = {
+        "id": str(uuid.uuid4()),
+        "uploaded_by": current_user.username,
+        "original_name": data.original_name,
+        "file_type": data.file_type,
+        "total_size": data.total_size,
+        "team_id": data.team_id,
+        "password_hash": get_password_hash(data.password) if data.password else None,
+        "status": "open",
+        "parts": {},
+        "created_at": now.isoformat(),
+        "expires_at": (now + timedelta(hours=UPLOAD_SESSION_TTL_HOURS)).isoformat(),
+    }
+    upload_session_dir(session_doc["id"]).mkdir(parents=True, exist_ok=True)
+    await db.upload_sessions.insert_one(session_doc)
+    return upload_session_status(session_doc)
+
+@api_router.get("/files/uploads/{session_id}")
+async def get_upload_session(session_id: str, current_user: User = Depends(get_current_user)):
+    session = await db.upload_sessions.find_one({"id": session_id}, {"_id": 0})
+    if not session or session["uploaded_by"] != current_user.username:
+        raise HTTPException(status_code=404, detail="Upload session not found")
+    return upload_session_status(session)
+
+@api_router.put("/files/uploads/{session_id}/parts/{part_number}")
+async def upload_session_part(session_id: str, part_number: int, request: Request,
+                              current_user: User = Depends(get_current_user)):
+    if part_number < 1 or part_number > UPLOAD_SESSION_MAX_PARTS:
+        raise HTTPException(status_code=400, detail="Invalid part number")
+    await get_open_upload_session(session_id, current_user)
+    
+    session_dir = upload_session_dir(session_id)
+    session_dir.mkdir(parents=True, exist_ok=True)
+    part_path = session_dir / f"{part_number:05d}.part"
+    tmp_path = session_dir / f".{part_number:05d}.{uuid.uuid4().hex}.tmp"
+    digest = UploadDigest()
+    try:
+        async with aiofiles.open(tmp_path, 'wb') as out_file:
+            async for chunk in request.stream():
+                digest.update(chunk)
+                if digest.size > UPLOAD_SESSION_MAX_PART_SIZE:
+                    raise HTTPException(status_code=413, detail="Part too large")
+                await out_file.write(chunk)
+        # Re-enviar a mesma parte substitui a anterior (idempotente)
+        os.replace(tmp_path, part_path)
+    finally:
+        tmp_path.unlink(missing_ok=True)
+    
+    part_info = {"size": digest.size, "checksum": digest.hexdigest()}
+    await db.upload_sessions.update_one(
+        {"id": session_id, "status": "open"}, {"$set": {f"parts.{part_number}": part_info}}
+    )
+    return {"part_number": part_number, **part_info}
+
+@api_router.post("/files/uploads/{session_id}/complete", response_model=FileMetadata)
+async def complete_upload_session(session_id: str, current_user: User = Depends(get_current_user)):
+    session = await get_open_upload_session(session_id, current_user)
+    part_numbers = sorted(int(n) for n in session["parts"])
+    if not part_numbers or part_numbers != list(range(1, len(part_numbers) + 1)):
+        raise HTTPException(status_code=400, detail="Missing parts")
+    received = sum(p["size"] for p in session["parts"].values())
+    if session.get("total_size") is not None and received != session["total_size"]:
+        raise HTTPException(status_code=400, detail=f"Expected {session['total_size']} bytes, received {received}")
+    
+    # Trava a sessão para que dois "complete" concorrentes não montem o arquivo duas vezes
+    locked = await db.upload_sessions.update_one({"id": session_id, "status": "open"}, {"$set": {"status": "assembling"}})
+    if locked.modified_count == 0:
+        raise HTTPException(status_code=409, detail="Upload session is not open")
+    
+    session_dir = upload_session_dir(session_id)
+    part_paths = [session_dir / f"{n:05d}.part" for n in part_numbers]
+    file_id = str(uuid.uuid4())
+    try:
+        async with store_content_addressed(iter_upload_parts(part_paths)) as storage_info:
+            file_metadata = await create_file_record(
+                file_id, session["original_name"], session.get("file_type"), current_user.username,
+                session.get("team_id"), session.get("password_hash"), storage_info
+            )
+    except Exception:
+        await db.upload_sessions.update_one({"id": session_id}, {"$set": {"status": "open"}})
+        raise
+    
+    await db.upload_sessions.update_one({"id": session_id}, {"$set": {"status": "completed", "file_id": file_id}})
+    shutil.rmtree(session_dir, ignore_errors=True)
+    return file_metadata
+
+@api_router.delete("/files/uploads/{session_id}")
+async def abort_upload_session(session_id: str, current_user: User = Depends(get_current_user)):
+    await get_open_upload_session(session_id, current_user)
+    await db.upload_sessions.update_one({"id": session_id}, {"$set": {"status": "aborted"}})
+    shutil.rmtree(upload_session_dir(session_id), ignore_errors=True)
+    return {"message": "Upload session aborted"}
+
+# Listagem paginada por keyset: o cursor guarda (valor do campo de ordenação, id) do último item
+FILES_PAGE_DEFAULT = int(os.environ.get("FILES_PAGE_DEFAULT", 100))
+FILES_PAGE_MAX = 500
+FILES_COUNT_CAP = 10000
+FILE_SORTS = {
+    "newest": ("uploaded_at", DESCENDING),
+    "oldest": ("uploaded_at", ASCENDING),
+    "name": ("original_name", ASCENDING),
+    "largest": ("file_size", DESCENDING),
+    "smallest": ("file_size", ASCENDING),
+}
+
+def encode_cursor(data: dict) -> str:
+    return base64.urlsafe_b64encode(json.dumps(data, default=str).encode()).decode().rstrip("=")
+
+def decode_cursor(cursor: str) -> dict:
+    try:
+        return json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def keyset_query(field: str, direction: int, last_value, last_id: str) -> dict:
+    op = "$lt" if direction == DESCENDING else "$gt"
+    return {"$or": [{field: {op: last_value}}, {field: last_value, "id": {op: last_id}}]}
+
+@api_router.get("/files", response_model=None)
+async def get_files(
+    cursor: Optional[str] = None,
+    limit: int = Query(FILES_PAGE_DEFAULT, ge=1, le=FILES_PAGE_MAX),
+    sort: str = Query("newest", pattern=f"^({'|'.join(FILE_SORTS)})$"),
+    file_type: Optional[str] = None,
+    team_id: Optional[str] = None,
+    owner: Optional[str] = None,
+    name_prefix: Optional[str] = None,
+    search: Optional[str] = None,
+    fields: Optional[str] = None,
+    current_user: User = Depends(get_current_user)
+):
+    """Lista os arquivos acessíveis, uma página por vez.
+
+    Próxima página no header X-Next-Cursor (ausente na última); na primeira página,
+    X-Total-Count traz o total (limitado a FILES_COUNT_CAP). `file_type` terminado em "/"
+    filtra por prefixo (ex.: "image/"); `fields` é uma lista separada por vírgulas.
+    `name_prefix` é um prefixo exato (sensível a maiúsculas, coberto pelo índice de original_name);
+    `search` procura o texto em qualquer parte do nome, sem diferenciar maiúsculas (não usa índice).
+    """
+    sort_field, direction = FILE_SORTS[sort]
+    conditions = [await FileAccess(current_user).files_query()]
+    if file_type:
+        conditions.append({"file_type": {"$regex": f"^{re.escape(file_type)}"}} if file_type.endswith("/") else {"file_type": file_type})
+    if team_id:
+        conditions.append({"team_id": team_id})
+    if owner:
+        conditions.append({"uploaded_by": owner})
+    if name_prefix:
+        conditions.append({"original_name": {"$regex": f"^{re.escape(name_prefix)}"}})
+    if search:
+        conditions.append({"original_name": {"$regex": re.escape(search), "$options": "i"}})
+    filters = {"$and": conditions}
+    
+    query = filters
+    if cursor:
+        position = decode_cursor(cursor)
+        if position.get("sort") != sort:
+            raise HTTPException(status_code=400, detail="Cursor does not match sort")
+        query = {"$and": conditions + [keyset_query(sort_field, direction, position["value"], position["id"])]}
+    
+    if fields:
+        requested = {f.strip() for f in fields.split(",")} & set(FileMetadata.model_fields)
+        projection = {"_id": 0, **{f: 1 for f in requested | {"id", sort_field}}}
+    else:
+        projection = {"_id": 0, "password_hash": 0}
+    
+    files = await db.files.find(query, projection).sort([(sort_field, direction), ("id", direction)]).limit(limit + 1).to_list(limit + 1)
+    
+    headers = {}
+    if len(files) > limit:
+        files = files[:limit]
+        headers["X-Next-Cursor"] = encode_cursor({"sort": sort, "value": files[-1].get(sort_field), "id": files[-1]["id"]})
+    if not cursor:
+        headers["X-Total-Count"] = str(await db.files.count_documents(filters, limit=FILES_COUNT_CAP))
+    # Documentos já estão no formato JSON (datas em ISO): sem revalidar cada item com pydantic
+    return JSONResponse(content=[serialize_document(f) for f in files], headers=headers)
+
+# Operações em lote: validação numa consulta, bulk_write e resultado por arquivo
+def bulk_summary(results: List[dict]) -> dict:
+    summary: Dict[str, int] = {}
+    for result in results:
+        summary[result["status"]] = summary.get(result["status"], 0) + 1
+    return {"results": results, "summary": summary}
+
+async def load_owned_files(file_ids: List[str], current_user: User) -> tuple:
+    """Carrega os arquivos numa só consulta; devolve (gerenciáveis por id, resultados de erro)"""
+    file_ids = list(dict.fromkeys(file_ids))
+    files = await db.files.find(
+        {"id": {"$in": file_ids}}, {"_id": 0, "id": 1, "uploaded_by": 1, "shared_with": 1}
+    ).to_list(None)
+    found = {f["id"]: f for f in files}
+    
+    owned, errors = {}, []
+    for file_id in file_ids:
+        file_metadata = found.get(file_id)
+        if not file_metadata:
+            errors.append({"file_id": file_id, "status": "not_found"})
+        elif file_metadata["uploaded_by"] != current_user.username and current_user.role != "admin":
+            errors.append({"file_id": file_id, "status": "forbidden"})
+        else:
+            owned[file_id] = file_metadata
+    return owned, errors
+
+@api_router.post("/files/bulk/share")
+async def bulk_share_files(data: FileBulkShare, current_user: User = Depends(get_current_user)):
+    usernames = list(dict.fromkeys(data.usernames))
+    existing_users = {u["username"] for u in await db.users.find(
+        {"username": {"$in": usernames}}, {"_id": 0, "username": 1}
+    ).to_list(None)}
+    valid_usernames = [u for u in usernames if u in existing_users]
+    owned, results = await load_owned_files(data.file_ids, current_user)
+    
+    now = datetime.now(timezone.utc).isoformat()
+    operations = []
+    for file_id, file_metadata in owned.items():
+        added = [u for u in valid_usernames if u not in file_metadata.get("shared_with", [])]
+        if not added:
+            results.append({"file_id": file_id, "status": "unchanged", "added": []})
+            continue
+        operations.append(UpdateOne({"id": file_id}, {
+            "$addToSet": {"shared_with": {"$each": added}},
+            "$set": {"updated_at": now}
+        }))
+        results.append({"file_id": file_id, "status": "shared", "added": added})
+    
+    if operations:
+        await db.files.bulk_write(operations, ordered=False)
+    response = bulk_summary(results)
+    response["unknown_users"] = [u for u in usernames if u not in existing_users]
+    return response
+
+@api_router.post("/files/bulk/unshare")
+async def bulk_unshare_files(data: FileBulkShare, current_user: User = Depends(get_current_user)):
+    usernames = list(dict.fromkeys(data.usernames))
+    owned, results = await load_owned_files(data.file_ids, current_user)
+    
+    now = datetime.now(timezone.utc).isoformat()
+    operations = []
+    for file_id, file_metadata in owned.items():
+        removed = [u for u in usernames if u in file_metadata.get("shared_with", [])]
+        if not removed:
+            results.append({"file_id": file_id, "status": "unchanged", "removed": []})
+            continue
+        operations.append(UpdateOne({"id": file_id}, {
+            "$pull": {"shared_with": {"$in": removed}},
+            "$set": {"updated_at": now}
+        }))
+        results.append({"file_id": file_id, "status": "unshared", "removed": removed})
+    
+    if operations:
+        await db.files.bulk_write(operations, ordered=False)
+    return bulk_summary(results)
+
+@api_router.post("/files/bulk/delete")
+async def bulk_delete_files(data: FileBulkDelete, current_user: User = Depends(get_admin_user)):
+    file_ids = list(dict.fromkeys(data.file_ids))
+    files = await db.files.find({"id": {"$in": file_ids}}, {"_id": 0}).to_list(None)
+    found = {f["id"]: f for f in files}
+    results = [{"file_id": file_id, "status": "deleted" if file_id in found else "not_found"} for file_id in file_ids]
+    if not files:
+        return bulk_summary(results)
     
-    files = await db.files.find(query, {"_id": 0, "password_hash": 0}).to_list(10000)
-    for file in files:
-        if isinstance(file['uploaded_at'], str):
-            file['uploaded_at'] = datetime.fromisoformat(file['uploaded_at'])
-    return files
+    now = datetime.now(timezone.utc).isoformat()
+    await db.files.bulk_write([DeleteOne({"id": file_id}) for file_id in found], ordered=False)
+    await db.file_tombstones.insert_many([{"file_id": file_id, "deleted_at": now} for file_id in found])
+    await record_usage_many(files, -1)
+    for file_id in found:
+        preview_cache.invalidate(file_id)
+    await release_files_storage(files)
+    return bulk_summary(results)
 
 @api_router.post("/files/{file_id}/share")
 async def share_file(file_id: str, data: FileShare, current_user: User = Depends(get_current_user)):
@@ -635,7 +2317,10 @@ async def share_file(file_id: str, data: FileShare, current_user: User = Depends
     if data.username in file_metadata.get("shared_with", []):
         raise HTTPException(status_code=400, detail="Already shared")
     
-    await db.files.update_one({"id": file_id}, {"$push": {"shared_with": data.username}})
+    await db.files.update_one({"id": file_id}, {
+        "$push": {"shared_with": data.username},
+        "$set": {"updated_at": datetime.now(timezone.utc).isoformat()}
+    })
     return {"message": f"File shared with {data.username}"}
 
 @api_router.delete("/files/{file_id}/share/{username}")
@@ -647,47 +2332,79 @@ async def unshare_file(file_id: str, username: str, current_user: User = Depends
     if file_metadata["uploaded_by"] != current_user.username and current_user.role != "admin":
         raise HTTPException(status_code=403)
     
-    await db.files.update_one({"id": file_id}, {"$pull": {"shared_with": username}})
+    await db.files.update_one({"id": file_id}, {
+        "$pull": {"shared_with": username},
+        "$set": {"updated_at": datetime.now(timezone.utc).isoformat()}
+    })
     return {"message": "File unshared"}
 
 @api_router.get("/files/{file_id}/preview")
-async def preview_file(file_id: str, current_user: User = Depends(get_current_user)):
-    file_metadata = await db.files.find_one({"id": file_id}, {"_id": 0})
-    if not file_metadata:
-        raise HTTPException(status_code=404)
+async def preview_file(file_id: str, request: Request, access: FileAccess = Depends(get_file_access)):
+    file_metadata = await get_readable_file(file_id, access)
     
-    has_access = False
-    if file_metadata["uploaded_by"] == current_user.username:
-        has_access = True
-    elif file_metadata.get("team_id"):
-        team = await db.teams.find_one({"id": file_metadata["team_id"]})
-        if team and current_user.username in team["members"]:
-            has_access = True
-    elif current_user.username in file_metadata.get("shared_with", []):
-        has_access = True
-    
-    if not has_access:
-        raise HTTPException(status_code=403)
-    
-    file_type = file_metadata["file_type"]
+    cache_key = (file_id, preview_version(file_metadata))
+    cached = preview_cache.get(cache_key)
+    if cached is None:
+        preview = await build_preview(file_metadata)
+        payload = json.dumps(preview, ensure_ascii=False).encode("utf-8")
+        etag = f'"{hashlib.sha256(payload).hexdigest()[:32]}"'
+        preview_cache.set(cache_key, payload, etag)
+    else:
+        payload, etag = cached
     
-    if file_type.startswith(('image/', 'text/')) or file_metadata["file_size"] < 5 * 1024 * 1024:
-        content = await get_file_from_storage(file_metadata)
-        if file_type.startswith('text/'):
-            return {"type": "text", "content": content.decode('utf-8', errors='ignore')}
-        else:
-            return {"type": "base64", "content": base64.b64encode(content).decode(), "mime_type": file_type}
+    # no-cache: o navegador guarda a resposta mas revalida (If-None-Match) a cada abertura.
+    # Edições ao vivo trocam o conteúdo e só atualizam updated_at
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache",
+               "Last-Modified": http_date(file_metadata.get("updated_at") or file_metadata["uploaded_at"])}
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and etag in [t.strip() for t in if_none_match.split(",")]:
+        return Response(status_code=304, headers=headers)
+    return Response(content=payload, media_type="application/json", headers=headers)
+
+async def build_preview(file_metadata: dict) -> dict:
+    """Payload de /preview. Nada de base64: texto vem da rendition limitada, imagens como URL do thumbnail"""
+    file_id = file_metadata["id"]
+    file_renditions = await ensure_renditions(file_metadata)
+    if "text" in file_renditions:
+        text = file_renditions["text"]
+        try:
+            content = await read_rendition(text)
+        except StorageNotFound:
+            await db.files.update_one({"id": file_id}, {"$unset": {"renditions": ""}})
+            raise HTTPException(status_code=404, detail="Preview not found")
+        return {"type": "text", "content": content.decode("utf-8"), "truncated": text.get("truncated", False)}
+    if "thumbnail" in file_renditions:
+        return {"type": "image", "url": f"/files/{file_id}/renditions/thumbnail",
+                "mime_type": file_renditions["thumbnail"]["mime_type"], "file_id": file_id}
     
     return {"type": "stream", "file_id": file_id}
 
-@api_router.get("/files/{file_id}/stream")
-async def stream_file(file_id: str, current_user: User = Depends(get_current_user)):
-    file_metadata = await db.files.find_one({"id": file_id}, {"_id": 0})
-    if not file_metadata:
-        raise HTTPException(status_code=404)
+@api_router.get("/files/{file_id}/renditions/{kind}")
+async def get_file_rendition(file_id: str, kind: str, request: Request,
+                             current_user: User = Depends(get_current_user_or_query_token)):
+    """Rendition em binário, com cache longo: o conteúdo nunca muda para o mesmo blob"""
+    file_metadata = await get_readable_file(file_id, FileAccess(current_user))
+    
+    rendition = (await ensure_renditions(file_metadata)).get(kind)
+    if not rendition:
+        raise HTTPException(status_code=404, detail="Rendition not available")
+    
+    etag = f'"{file_metadata.get("checksum") or file_id}-{kind}"'
+    headers = {"ETag": etag, "Cache-Control": RENDITION_CACHE_CONTROL}
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and etag in [t.strip() for t in if_none_match.split(",")]:
+        return Response(status_code=304, headers=headers)
     
-    file_content = await get_file_from_storage(file_metadata)
-    return StreamingResponse(io.BytesIO(file_content), media_type=file_metadata["file_type"])
+    try:
+        content = await read_rendition(rendition)
+    except StorageNotFound:
+        raise HTTPException(status_code=404, detail="Rendition not found")
+    return Response(content=content, media_type=rendition["mime_type"], headers=headers)
+
+@api_router.get("/files/{file_id}/stream")
+async def stream_file(file_id: str, request: Request, current_user: User = Depends(get_current_user_or_query_token)):
+    file_metadata = await get_readable_file(file_id, FileAccess(current_user))
+    return await storage_file_response(request, file_metadata)
 
 @api_router.post("/files/{file_id}/verify-password")
 async def verify_file_password(file_id: str, data: FilePasswordVerify, current_user: User = Depends(get_current_user)):
@@ -704,30 +2421,11 @@ async def verify_file_password(file_id: str, data: FilePasswordVerify, current_u
     return {"valid": verify_password(data.password, file_metadata["password_hash"])}
 
 @api_router.get("/files/{file_id}/download")
-async def download_file(file_id: str, current_user: User = Depends(get_current_user)):
-    file_metadata = await db.files.find_one({"id": file_id}, {"_id": 0})
-    if not file_metadata:
-        raise HTTPException(status_code=404)
-    
-    has_access = False
-    if file_metadata["uploaded_by"] == current_user.username:
-        has_access = True
-    elif file_metadata.get("team_id"):
-        team = await db.teams.find_one({"id": file_metadata["team_id"]})
-        if team and current_user.username in team["members"]:
-            has_access = True
-    elif current_user.username in file_metadata.get("shared_with", []):
-        has_access = True
-    
-    if not has_access:
-        raise HTTPException(status_code=403)
+async def download_file(file_id: str, request: Request, access: FileAccess = Depends(get_file_access)):
+    file_metadata = await get_readable_file(file_id, access)
     
-    file_content = await get_file_from_storage(file_metadata)
-    return StreamingResponse(
-        io.BytesIO(file_content),
-        media_type=file_metadata["file_type"],
-        headers={"Content-Disposition": f"attachment; filename={file_metadata['original_name']}"}
-    )
+    disposition = {"Content-Disposition": f"attachment; filename={file_metadata['original_name']}"}
+    return await storage_file_response(request, file_metadata, disposition)
 
 @api_router.delete("/files/{file_id}")
 async def delete_file(file_id: str, current_user: User = Depends(get_admin_user)):
@@ -735,159 +2433,1020 @@ async def delete_file(file_id: str, current_user: User = Depends(get_admin_user)
     if not file_metadata:
         raise HTTPException(status_code=404)
     
-    await delete_file_from_storage(file_metadata)
     await db.files.delete_one({"id": file_id})
+    await db.file_tombstones.insert_one({"file_id": file_id, "deleted_at": datetime.now(timezone.utc).isoformat()})
+    await record_usage(file_metadata, -1)
+    preview_cache.invalidate(file_id)
+    await release_file_storage(file_metadata)
     return {"message": "File deleted"}
 
 # User stats
 @api_router.get("/user/stats")
 async def get_user_stats(current_user: User = Depends(get_current_user)):
-    files = await db.files.find({"uploaded_by": current_user.username}, {"file_size": 1}).to_list(10000)
-    total_storage = sum(f.get("file_size", 0) for f in files)
-    teams = await db.teams.find({"members": current_user.username}).to_list(1000)
+    usage = await get_usage("user", current_user.username)
+    total_storage = usage["storage_bytes"]
+    total_teams = await db.teams.count_documents({"members": current_user.username})
     
     return {
-        "total_files": len(files),
+        "total_files": usage["file_count"],
         "total_storage_bytes": total_storage,
         "total_storage_mb": round(total_storage / (1024 * 1024), 2),
-        "total_teams": len(teams)
+        "total_teams": total_teams
     }
 
-# Chat routes
-@api_router.get("/chat/enabled")
-async def get_chat_enabled(current_user: User = Depends(get_current_user)):
-    settings = await db.settings.find_one({"key": "chat_enabled"})
-    return {"enabled": settings.get("value", False) if settings else False}
+# ===================================================================
+# PUB/SUB - eventos de chat entre workers/nós
+# ===================================================================
+PUBSUB_BACKEND = os.environ.get("PUBSUB_BACKEND", "memory")
+PUBSUB_COLLECTION_BYTES = int(os.environ.get("PUBSUB_COLLECTION_BYTES", 64 * 1024 * 1024))
+PUBSUB_RETRY_SECONDS = float(os.environ.get("PUBSUB_RETRY_SECONDS", 0.5))
+WORKER_ID = uuid.uuid4().hex
 
-@api_router.get("/chat/messages", response_model=List[ChatMessage])
-async def get_chat_messages(current_user: User = Depends(get_current_user)):
-    settings = await db.settings.find_one({"key": "chat_enabled"})
-    if not settings or not settings.get("value", False):
-        if current_user.role != "admin":
-            raise HTTPException(status_code=403)
+class PubSubError(Exception):
+    """O evento não pôde ser repassado aos outros workers (e não foi entregue a ninguém)"""
+
+class PubSubBus:
+    """Barramento publish/subscribe por canal.
+
+    publish() entrega aos assinantes deste processo; backends distribuídos antes repassam
+    o evento aos outros workers (que o entregam aos seus assinantes) e, se isso falhar,
+    levantam PubSubError sem entregar a ninguém.
+    """
+    def __init__(self):
+        self.handlers: Dict[str, list] = {}
+        self.published = 0
+        self.received = 0
+    
+    def subscribe(self, channel: str, handler):
+        self.handlers.setdefault(channel, []).append(handler)
+    
+    async def dispatch(self, channel: str, message: dict):
+        for handler in self.handlers.get(channel, []):
+            try:
+                await handler(message)
+            except Exception as e:
+                logger.error(f"Pub/sub handler error ({channel}): {e}")
+    
+    async def publish(self, channel: str, message: dict):
+        self.published += 1
+        await self.dispatch(channel, message)
+    
+    async def start(self):
+        pass
+    
+    async def close(self):
+        pass
     
-    messages = await db.chat_messages.find({}, {"_id": 0}).sort("timestamp", -1).limit(100).to_list(100)
-    for msg in messages:
-        if isinstance(msg['timestamp'], str):
-            msg['timestamp'] = datetime.fromisoformat(msg['timestamp'])
-    return list(reversed(messages))
+    def stats(self) -> dict:
+        return {"backend": PUBSUB_BACKEND, "worker_id": WORKER_ID,
+                "published": self.published, "received": self.received}
 
-@api_router.post("/admin/chat/toggle")
-async def toggle_chat(data: ChatToggle, current_user: User = Depends(get_admin_user)):
-    await db.settings.update_one({"key": "chat_enabled"}, {"$set": {"value": data.enabled}}, upsert=True)
-    return {"enabled": data.enabled}
+class InMemoryPubSubBus(PubSubBus):
+    """Um único processo: publish() já entrega a todos os assinantes"""
 
-@api_router.delete("/admin/chat/messages/{message_id}")
-async def delete_chat_message(message_id: str, current_user: User = Depends(get_admin_user)):
-    result = await db.chat_messages.delete_one({"id": message_id})
-    if result.deleted_count == 0:
-        raise HTTPException(status_code=404)
+class MongoPubSubBus(PubSubBus):
+    """Eventos numa capped collection lida por cursor tailable (funciona sem replica set).
+
+    Cada worker grava os eventos que publica e acompanha a coleção, ignorando os próprios.
+    """
+    def __init__(self, collection_name: str = "pubsub_events", size_bytes: int = PUBSUB_COLLECTION_BYTES):
+        super().__init__()
+        self.collection_name = collection_name
+        self.size_bytes = size_bytes
+        self.tail_task: Optional[asyncio.Task] = None
+        self.last_id = None
+    
+    @property
+    def collection(self):
+        return db[self.collection_name]
     
-    for connection in active_connections:
+    async def start(self):
         try:
-            await connection.send_json({"type": "message_deleted", "message_id": message_id})
-        except:
+            await db.create_collection(self.collection_name, capped=True, size=self.size_bytes)
+        except CollectionInvalid:
             pass
-    return {"message": "Message deleted"}
-
-# WebSocket Chat
-@app.websocket("/api/ws/chat")
-async def websocket_chat(websocket: WebSocket):
-    await websocket.accept()
-    active_connections.add(websocket)
+        latest = await self.collection.find_one({}, sort=[("$natural", -1)])
+        if latest is None:
+            # Cursor tailable numa coleção vazia morre na hora; grava um marcador inicial
+            await self.collection.insert_one({"channel": None, "origin": WORKER_ID})
+            latest = await self.collection.find_one({}, sort=[("$natural", -1)])
+        self.last_id = latest["_id"]
+        self.tail_task = asyncio.create_task(self._tail())
     
-    try:
-        while True:
-            data = await websocket.receive_text()
-            message_data = json.loads(data)
-            
-            user = await db.users.find_one({"username": message_data.get("username")}, {"_id": 0})
-            if not user:
-                continue
-            
-            chat_message = ChatMessage(
-                username=message_data.get("username"),
-                message=message_data.get("message"),
-                role=user.get("role", "user")
-            )
-            
-            message_doc = chat_message.model_dump()
-            message_doc["timestamp"] = message_doc["timestamp"].isoformat()
-            await db.chat_messages.insert_one(message_doc)
-            
-            broadcast_data = chat_message.model_dump()
-            broadcast_data["timestamp"] = broadcast_data["timestamp"].isoformat()
-            
-            for connection in active_connections:
-                try:
-                    await connection.send_json(broadcast_data)
-                except:
-                    pass
+    async def close(self):
+        if self.tail_task:
+            self.tail_task.cancel()
     
-    except WebSocketDisconnect:
-        active_connections.discard(websocket)
-    except Exception as e:
-        logger.error(f"WebSocket error: {e}")
-        active_connections.discard(websocket)
+    async def publish(self, channel: str, message: dict):
+        # Grava antes de entregar localmente: um evento que não chega aos outros workers
+        # não deve chegar só aos clientes deste
+        try:
+            await self.collection.insert_one({"channel": channel, "origin": WORKER_ID, "message": message})
+        except Exception as e:
+            logger.error(f"Pub/sub publish error ({channel}): {e}")
+            raise PubSubError(str(e)) from e
+        await super().publish(channel, message)
+    
+    async def _resume_point(self):
+        """_id a partir do qual retomar, ou None se ele já saiu da capped collection"""
+        if self.last_id is None or await self.collection.find_one({"_id": self.last_id}, {"_id": 1}):
+            return self.last_id
+        # Tudo o que sobrou na coleção é posterior ao último evento visto; o que saiu antes de ser lido se perdeu
+        logger.warning("Pub/sub: último evento lido já foi descartado da capped collection; eventos podem ter se perdido")
+        return None
+    
+    async def _tail(self):
+        while True:
+            try:
+                # Sem filtro por _id: ObjectIds vêm de workers diferentes (timestamp, valor aleatório
+                # por processo, contador) e não seguem a ordem de inserção. A ordem $natural segue,
+                # então o cursor lê a coleção desde o início e pula até o último evento já visto.
+                skip_until = await self._resume_point()
+                cursor = self.collection.find(
+                    {}, cursor_type=CursorType.TAILABLE_AWAIT, sort=[("$natural", 1)]
+                )
+                async for event in cursor:
+                    if skip_until is not None:
+                        if event["_id"] == skip_until:
+                            skip_until = None
+                        continue
+                    self.last_id = event["_id"]
+                    if event.get("origin") == WORKER_ID or not event.get("channel"):
+                        continue
+                    self.received += 1
+                    await self.dispatch(event["channel"], event["message"])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Pub/sub tail error: {e}")
+            # Cursor encerrado (coleção reciclada, failover...): reabre a partir do último evento
+            await asyncio.sleep(PUBSUB_RETRY_SECONDS)
 
-# Admin routes
-@api_router.get("/admin/users", response_model=List[User])
-async def get_all_users(current_user: User = Depends(get_admin_user)):
-    users = await db.users.find({}, {"_id": 0, "password_hash": 0}).to_list(1000)
-    for user in users:
-        if isinstance(user['created_at'], str):
-            user['created_at'] = datetime.fromisoformat(user['created_at'])
-    return users
+def build_pubsub_bus() -> PubSubBus:
+    if PUBSUB_BACKEND == "mongo":
+        return MongoPubSubBus()
+    return InMemoryPubSubBus()
 
-@api_router.delete("/admin/users/{user_id}")
-async def delete_user(user_id: str, current_user: User = Depends(get_admin_user)):
-    user = await db.users.find_one({"id": user_id}, {"_id": 0})
-    if not user or user["role"] == "admin":
-        raise HTTPException(status_code=403)
-    await db.users.delete_one({"id": user_id})
-    return {"message": "User deleted"}
+pubsub = build_pubsub_bus()
 
-@api_router.get("/admin/stats")
-async def get_stats(current_user: User = Depends(get_admin_user)):
-    total_users = await db.users.count_documents({})
-    total_files = await db.files.count_documents({})
-    total_teams = await db.teams.count_documents({})
-    files = await db.files.find({}, {"file_size": 1}).to_list(10000)
-    total_storage = sum(f.get("file_size", 0) for f in files)
-    settings = await db.settings.find_one({"key": "chat_enabled"})
-    
-    return {
-        "total_users": total_users,
-        "total_files": total_files,
-        "total_teams": total_teams,
-        "total_storage_bytes": total_storage,
-        "total_storage_mb": round(total_storage / (1024 * 1024), 2),
-        "chat_enabled": settings.get("value", False) if settings else False,
-        "storage_mode": STORAGE_MODE
-    }
+# ===================================================================
+# BROADCAST HUB - fan-out de WebSocket com fila de envio por conexão
+# ===================================================================
+WS_SEND_QUEUE_SIZE = int(os.environ.get("WS_SEND_QUEUE_SIZE", 256))
+# "disconnect" derruba o cliente lento; "drop" descarta as mensagens mais antigas da fila dele
+WS_SLOW_CONSUMER_POLICY = os.environ.get("WS_SLOW_CONSUMER_POLICY", "disconnect")
+WS_SEND_TIMEOUT_SECONDS = float(os.environ.get("WS_SEND_TIMEOUT_SECONDS", 10))
 
-@api_router.get("/admin/download-all")
-async def download_all_files(current_user: User = Depends(get_admin_user)):
-    zip_buffer = io.BytesIO()
-    with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-        files = await db.files.find({}, {"_id": 0}).to_list(10000)
-        for file_metadata in files:
-            try:
-                content = await get_file_from_storage(file_metadata)
-                arcname = f"{file_metadata['uploaded_by']}/{file_metadata['original_name']}"
-                zip_file.writestr(arcname, content)
-            except:
-                pass
-    zip_buffer.seek(0)
-    return StreamingResponse(iter([zip_buffer.getvalue()]), media_type="application/zip", headers={"Content-Disposition": "attachment; filename=backup.zip"})
+# Codificação negociada por subprotocolo no handshake: o cliente oferece os que entende e o
+# servidor escolhe msgpack (frames binários) quando disponível. Sem subprotocolo: JSON em texto.
+# A compressão (permessage-deflate) é negociada pelo uvicorn e vale para os dois formatos.
+WS_SUBPROTOCOL_MSGPACK = "biblioteca.msgpack"
+WS_SUBPROTOCOL_JSON = "biblioteca.json"
 
-@api_router.get("/admin/download-source-code")
-async def download_source_code(current_user: User = Depends(get_admin_user)):
-    zip_buffer = io.BytesIO()
-    with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-        for dir_path in [Path("/app/backend"), Path("/app/frontend")]:
-            for file_path in dir_path.rglob("*"):
-                if file_path.is_file() and 'node_modules' not in str(file_path) and '__pycache__' not in str(file_path):
+def negotiate_ws_subprotocol(websocket: WebSocket) -> Optional[str]:
+    offered = websocket.scope.get("subprotocols") or []
+    if msgpack is not None and WS_SUBPROTOCOL_MSGPACK in offered:
+        return WS_SUBPROTOCOL_MSGPACK
+    if WS_SUBPROTOCOL_JSON in offered:
+        return WS_SUBPROTOCOL_JSON
+    return None
+
+async def accept_websocket(websocket: WebSocket):
+    """accept() com a negociação de codificação; a escolha fica no scope da conexão"""
+    subprotocol = negotiate_ws_subprotocol(websocket)
+    websocket.scope["ws_encoding"] = "msgpack" if subprotocol == WS_SUBPROTOCOL_MSGPACK else "json"
+    await websocket.accept(subprotocol=subprotocol)
+
+def ws_encoding(websocket: WebSocket) -> str:
+    return websocket.scope.get("ws_encoding", "json")
+
+def encode_ws_message(message: dict, encoding: str):
+    if encoding == "msgpack":
+        return msgpack.packb(message, default=str)
+    return json.dumps(message, default=str)
+
+async def send_ws_message(websocket: WebSocket, message: dict):
+    """Envio direto (fora do hub) na codificação da conexão"""
+    payload = encode_ws_message(message, ws_encoding(websocket))
+    if isinstance(payload, bytes):
+        await websocket.send_bytes(payload)
+    else:
+        await websocket.send_text(payload)
+
+async def receive_ws_message(websocket: WebSocket) -> dict:
+    """Lê um frame do cliente: texto é JSON, binário é msgpack (independe do que foi negociado)"""
+    frame = await websocket.receive()
+    if frame["type"] == "websocket.disconnect":
+        raise WebSocketDisconnect(frame.get("code", 1000), frame.get("reason"))
+    if frame.get("bytes") is not None:
+        if msgpack is None:
+            raise ValueError("Frames binários exigem msgpack")
+        try:
+            message = msgpack.unpackb(frame["bytes"])
+        except Exception as e:
+            raise ValueError(f"msgpack inválido: {e}")
+    else:
+        message = json.loads(frame.get("text") or "")
+    if not isinstance(message, dict):
+        raise ValueError("Mensagem deve ser um objeto")
+    return message
+
+class HubConnection:
+    """Um WebSocket registrado no hub, com sua fila de saída e a tarefa que a esvazia"""
+    def __init__(self, websocket: WebSocket, queue_size: int):
+        self.websocket = websocket
+        self.encoding = ws_encoding(websocket)
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self.task: Optional[asyncio.Task] = None
+        self.dropped = 0
+
+class BroadcastHub:
+    """Distribui mensagens para muitos WebSockets sem que um cliente lento atrase os outros.
+
+    Cada mensagem é serializada uma única vez por codificação em uso (JSON/msgpack);
+    broadcast() só enfileira (nunca espera rede) e cada conexão tem uma tarefa própria
+    enviando da sua fila.
+    """
+    def __init__(self, name: str, queue_size: int = WS_SEND_QUEUE_SIZE,
+                 slow_consumer_policy: str = WS_SLOW_CONSUMER_POLICY):
+        self.name = name
+        self.queue_size = queue_size
+        self.slow_consumer_policy = slow_consumer_policy
+        self.connections: Dict[WebSocket, HubConnection] = {}
+        self.messages_broadcast = 0
+        self.messages_dropped = 0
+        self.slow_disconnects = 0
+        self.send_failures = 0
+    
+    def register(self, websocket: WebSocket) -> HubConnection:
+        connection = HubConnection(websocket, self.queue_size)
+        connection.task = asyncio.create_task(self._drain(connection))
+        self.connections[websocket] = connection
+        return connection
+    
+    def unregister(self, websocket: WebSocket):
+        connection = self.connections.pop(websocket, None)
+        if connection and connection.task and connection.task is not asyncio.current_task():
+            connection.task.cancel()
+    
+    async def _drain(self, connection: HubConnection):
+        try:
+            while True:
+                payload = await connection.queue.get()
+                if isinstance(payload, bytes):
+                    await asyncio.wait_for(connection.websocket.send_bytes(payload), WS_SEND_TIMEOUT_SECONDS)
+                else:
+                    await asyncio.wait_for(connection.websocket.send_text(payload), WS_SEND_TIMEOUT_SECONDS)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            self.send_failures += 1
+            self.unregister(connection.websocket)
+    
+    def _enqueue(self, connection: HubConnection, payload):
+        try:
+            connection.queue.put_nowait(payload)
+            return
+        except asyncio.QueueFull:
+            pass
+        if self.slow_consumer_policy == "drop":
+            connection.queue.get_nowait()
+            connection.queue.put_nowait(payload)
+            connection.dropped += 1
+            self.messages_dropped += 1
+        else:
+            self.slow_disconnects += 1
+            self.unregister(connection.websocket)
+            start_background_task(self._close_slow(connection.websocket))
+    
+    async def _close_slow(self, websocket: WebSocket):
+        try:
+            await websocket.close(code=1013)
+        except Exception:
+            pass
+    
+    def broadcast(self, message: dict, exclude: Optional[WebSocket] = None) -> int:
+        """Enfileira a mensagem para todas as conexões; devolve quantas a receberam"""
+        return self.send([ws for ws in self.connections if ws is not exclude], message)
+    
+    def send(self, websockets, message: dict) -> int:
+        """Enfileira a mensagem (serializada uma vez por codificação) para as conexões dadas que estão registradas"""
+        payloads = {}
+        self.messages_broadcast += 1
+        delivered = 0
+        for websocket in list(websockets):
+            connection = self.connections.get(websocket)
+            if connection is None:
+                continue
+            payload = payloads.get(connection.encoding)
+            if payload is None:
+                payload = payloads[connection.encoding] = encode_ws_message(message, connection.encoding)
+            self._enqueue(connection, payload)
+            delivered += 1
+        return delivered
+    
+    def stats(self) -> dict:
+        depths = [c.queue.qsize() for c in self.connections.values()]
+        encodings: Dict[str, int] = {}
+        for connection in self.connections.values():
+            encodings[connection.encoding] = encodings.get(connection.encoding, 0) + 1
+        return {
+            "connections": len(self.connections),
+            "encodings": encodings,
+            "queued_messages": sum(depths),
+            "max_queue_depth": max(depths, default=0),
+            "queue_size": self.queue_size,
+            "slow_consumer_policy": self.slow_consumer_policy,
+            "messages_broadcast": self.messages_broadcast,
+            "messages_dropped": self.messages_dropped,
+            "slow_disconnects": self.slow_disconnects,
+            "send_failures": self.send_failures,
+        }
+
+chat_hub = BroadcastHub("chat")
+
+CHAT_HISTORY_SIZE = int(os.environ.get("CHAT_HISTORY_SIZE", 200))
+CHAT_PAGE_DEFAULT = 50
+
+class ChatHistory:
+    """Ring buffer das mensagens mais recentes, em ordem cronológica.
+
+    Carregado do MongoDB uma vez e mantido pelos eventos do pub/sub (novas mensagens e
+    exclusões), então vale para todos os workers. Os eventos entram no buffer mesmo antes
+    da carga e são mesclados por id com o que vier do banco. `complete` indica que o
+    buffer contém todo o histórico (havia menos que `size` mensagens ao carregar).
+    """
+    def __init__(self, size: int = CHAT_HISTORY_SIZE):
+        self.size = size
+        self.messages: deque = deque(maxlen=size)
+        self.loaded = False
+        self.complete = False
+        self.lock = asyncio.Lock()
+    
+    async def ensure_loaded(self):
+        if self.loaded:
+            return
+        async with self.lock:
+            if self.loaded:
+                return
+            # O que este worker ainda não gravou precisa estar no banco (ou no buffer) antes da consulta
+            await chat_writer.flush()
+            docs = await db.chat_messages.find({}, {"_id": 0}).sort(
+                [("timestamp", DESCENDING), ("id", DESCENDING)]
+            ).limit(self.size).to_list(self.size)
+            # Mescla com o que chegou pelo pub/sub antes/durante a consulta (pode não estar gravado ainda)
+            merged = {m["id"]: m for m in docs}
+            merged.update({m["id"]: m for m in self.messages})
+            ordered = sorted(merged.values(), key=lambda m: (m["timestamp"], m["id"]))
+            self.messages = deque(ordered[-self.size:], maxlen=self.size)
+            self.complete = len(docs) < self.size
+            self.loaded = True
+    
+    def append(self, message: dict):
+        if len(self.messages) == self.size:
+            self.complete = False
+        self.messages.append(message)
+    
+    def remove(self, message_id: str):
+        for message in self.messages:
+            if message["id"] == message_id:
+                self.messages.remove(message)
+                return
+    
+    def contains(self, message_id: str) -> bool:
+        return any(message["id"] == message_id for message in self.messages)
+    
+    def recent(self, limit: int) -> Optional[List[dict]]:
+        """Últimas `limit` mensagens, ou None se o buffer não consegue responder sozinho"""
+        if not self.loaded or (len(self.messages) < limit and not self.complete):
+            return None
+        return list(self.messages)[-limit:]
+
+chat_history = ChatHistory()
+
+async def deliver_chat_event(message: dict):
+    if message.get("type") == "message_deleted":
+        chat_history.remove(message["message_id"])
+        # O worker que recebeu a mensagem é quem ainda pode tê-la no buffer de escrita
+        await chat_writer.remove(message["message_id"])
+    else:
+        chat_history.append(message)
+    chat_hub.broadcast(message)
+
+pubsub.subscribe("chat", deliver_chat_event)
+
+# Persistência do chat: write-behind com insert_many por tamanho/tempo
+CHAT_FLUSH_BATCH_SIZE = int(os.environ.get("CHAT_FLUSH_BATCH_SIZE", 100))
+CHAT_FLUSH_INTERVAL_SECONDS = float(os.environ.get("CHAT_FLUSH_INTERVAL_SECONDS", 0.5))
+CHAT_BUFFER_MAX_PENDING = int(os.environ.get("CHAT_BUFFER_MAX_PENDING", 10000))
+
+class ChatWriteBuffer:
+    """Acumula mensagens já transmitidas e grava em lote (insert_many).
+
+    O flush acontece ao atingir CHAT_FLUSH_BATCH_SIZE ou a cada CHAT_FLUSH_INTERVAL_SECONDS;
+    o shutdown chama flush() para não perder o que estiver pendente.
+    """
+    def __init__(self, batch_size: int = CHAT_FLUSH_BATCH_SIZE, interval: float = CHAT_FLUSH_INTERVAL_SECONDS):
+        self.batch_size = batch_size
+        self.interval = interval
+        self.pending: List[dict] = []
+        # Ids recebidos por este worker que ainda podem estar pendentes ou em gravação
+        self.recent_ids: "OrderedDict[str, None]" = OrderedDict()
+        self.lock = asyncio.Lock()
+        self.wakeup = asyncio.Event()
+        self.flushed = 0
+        self.flushes = 0
+        self.failures = 0
+    
+    def add(self, message_doc: dict):
+        self.pending.append(message_doc)
+        self.recent_ids[message_doc["id"]] = None
+        while len(self.recent_ids) > CHAT_BUFFER_MAX_PENDING:
+            self.recent_ids.popitem(last=False)
+        if len(self.pending) >= self.batch_size:
+            self.wakeup.set()
+    
+    async def wait_flushed(self):
+        """Espera o flush em andamento (se houver) terminar"""
+        async with self.lock:
+            pass
+    
+    def discard(self, message_id: str) -> bool:
+        """Remove uma mensagem ainda não gravada; devolve True se ela estava pendente"""
+        for i, message_doc in enumerate(self.pending):
+            if message_doc["id"] == message_id:
+                del self.pending[i]
+                return True
+        return False
+    
+    def owns(self, message_id: str) -> bool:
+        return message_id in self.recent_ids
+    
+    async def remove(self, message_id: str):
+        """Apaga uma mensagem recebida por este worker: pendente, em gravação ou já gravada"""
+        if message_id not in self.recent_ids:
+            return
+        del self.recent_ids[message_id]
+        if self.discard(message_id):
+            return
+        # Pode estar no lote que o flush está gravando: espera ele terminar (ou devolver o lote à fila)
+        await self.wait_flushed()
+        if not self.discard(message_id):
+            await db.chat_messages.delete_one({"id": message_id})
+    
+    async def flush(self):
+        async with self.lock:
+            if not self.pending:
+                return
+            batch, self.pending = self.pending, []
+            try:
+                await db.chat_messages.insert_many(batch, ordered=False)
+                self.flushed += len(batch)
+                self.flushes += 1
+                return
+            except BulkWriteError as e:
+                # Só as que falharam por outro motivo que não chave duplicada (já gravadas)
+                failed = {err["index"] for err in e.details.get("writeErrors", []) if err.get("code") != 11000}
+                retry = [doc for i, doc in enumerate(batch) if i in failed]
+                self.flushed += e.details.get("nInserted", 0)
+                logger.error(f"Chat flush error ({len(retry)} mensagens): {e}")
+            except Exception as e:
+                retry = batch
+                logger.error(f"Chat flush error ({len(batch)} mensagens): {e}")
+            self.failures += 1
+            # Devolve à fila para a próxima tentativa, sem crescer sem limite
+            self.pending = (retry + self.pending)[-CHAT_BUFFER_MAX_PENDING:]
+    
+    async def run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            await self.flush()
+    
+    def stats(self) -> dict:
+        return {"pending": len(self.pending), "flushed": self.flushed,
+                "flushes": self.flushes, "failures": self.failures}
+
+chat_writer = ChatWriteBuffer()
+
+# Chat routes
+@api_router.get("/chat/enabled")
+async def get_chat_enabled(current_user: User = Depends(get_current_user)):
+    settings = await db.settings.find_one({"key": "chat_enabled"})
+    return {"enabled": settings.get("value", False) if settings else False}
+
+def chat_page_response(messages: List[dict], has_more: bool) -> JSONResponse:
+    """Página em ordem cronológica; X-Next-Cursor aponta para a mensagem mais antiga da página"""
+    headers = {}
+    if has_more and messages:
+        headers["X-Next-Cursor"] = encode_cursor({"timestamp": messages[0]["timestamp"], "id": messages[0]["id"]})
+    return JSONResponse(content=[serialize_document(m) for m in messages], headers=headers)
+
+@api_router.get("/chat/messages", response_model=List[ChatMessage])
+async def get_chat_messages(
+    before: Optional[str] = None,
+    limit: int = Query(CHAT_PAGE_DEFAULT, ge=1, le=CHAT_HISTORY_SIZE),
+    current_user: User = Depends(get_current_user)
+):
+    settings = await db.settings.find_one({"key": "chat_enabled"})
+    if not settings or not settings.get("value", False):
+        if current_user.role != "admin":
+            raise HTTPException(status_code=403)
+    
+    # Carga inicial: direto do ring buffer, sem consultar o banco
+    if not before:
+        await chat_history.ensure_loaded()
+        recent = chat_history.recent(limit)
+        if recent is not None:
+            has_more = len(recent) < len(chat_history.messages) or not chat_history.complete
+            return chat_page_response(recent, has_more)
+    
+    # "Carregar anteriores": keyset em (timestamp, id), coberto pelo índice de chat_messages.
+    # Grava antes o que está no buffer de escrita, senão as mensagens recentes faltariam aqui
+    await chat_writer.flush()
+    query = {}
+    if before:
+        position = decode_cursor(before)
+        query = keyset_query("timestamp", DESCENDING, position.get("timestamp"), position.get("id"))
+    messages = await db.chat_messages.find(query, {"_id": 0}).sort(
+        [("timestamp", DESCENDING), ("id", DESCENDING)]
+    ).limit(limit + 1).to_list(limit + 1)
+    has_more = len(messages) > limit
+    return chat_page_response(list(reversed(messages[:limit])), has_more)
+
+@api_router.get("/admin/chat/metrics")
+async def get_chat_metrics(current_user: User = Depends(get_admin_user)):
+    return {**chat_hub.stats(), "writer": chat_writer.stats()}
+
+@api_router.post("/admin/chat/toggle")
+async def toggle_chat(data: ChatToggle, current_user: User = Depends(get_admin_user)):
+    await db.settings.update_one({"key": "chat_enabled"}, {"$set": {"value": data.enabled}}, upsert=True)
+    return {"enabled": data.enabled}
+
+@api_router.delete("/admin/chat/messages/{message_id}")
+async def delete_chat_message(message_id: str, current_user: User = Depends(get_admin_user)):
+    # Mensagens recentes podem estar só no buffer de escrita de outro worker; o histórico
+    # em memória recebe as de todos os workers pelo pub/sub
+    exists = (chat_writer.owns(message_id) or chat_history.contains(message_id)
+              or await db.chat_messages.find_one({"id": message_id}, {"_id": 1}))
+    if not exists:
+        raise HTTPException(status_code=404)
+    
+    # Cada worker remove a mensagem do seu buffer de escrita (ou do banco, se ela foi gravada por ele)
+    try:
+        await pubsub.publish("chat", {"type": "message_deleted", "message_id": message_id})
+    except PubSubError:
+        raise HTTPException(status_code=503, detail="Chat unavailable")
+    # Mensagens antigas, que já saíram dos buffers de escrita
+    await db.chat_messages.delete_one({"id": message_id})
+    return {"message": "Message deleted"}
+
+# WebSocket Chat
+@app.websocket("/api/ws/chat")
+async def websocket_chat(websocket: WebSocket):
+    await accept_websocket(websocket)
+    
+    # Remetente resolvido uma vez por conexão, pelo ?token= (obrigatório); o username das mensagens é ignorado
+    token = websocket.query_params.get("token")
+    try:
+        if not token:
+            raise HTTPException(status_code=401)
+        user = await get_user_from_token(token)
+    except HTTPException:
+        await websocket.close(code=1008)
+        return
+    chat_hub.register(websocket)
+    
+    try:
+        while True:
+            message_data = await receive_ws_message(websocket)
+            
+            if not message_data.get("message"):
+                continue
+            
+            chat_message = ChatMessage(username=user.username, message=message_data["message"], role=user.role)
+            message_doc = chat_message.model_dump()
+            message_doc["timestamp"] = message_doc["timestamp"].isoformat()
+            
+            # Transmite antes de gravar: o banco fica fora do caminho de latência
+            try:
+                await pubsub.publish("chat", dict(message_doc))
+            except PubSubError:
+                chat_hub.send([websocket], {"type": "error", "message": "Mensagem não enviada, tente novamente"})
+                continue
+            chat_writer.add(message_doc)
+    
+    except WebSocketDisconnect:
+        chat_hub.unregister(websocket)
+    except Exception as e:
+        logger.error(f"WebSocket error: {e}")
+        chat_hub.unregister(websocket)
+
+# Admin routes
+@api_router.get("/admin/users", response_model=List[User])
+async def get_all_users(current_user: User = Depends(get_admin_user)):
+    users = await db.users.find({}, {"_id": 0, "password_hash": 0}).to_list(1000)
+    for user in users:
+        if isinstance(user['created_at'], str):
+            user['created_at'] = datetime.fromisoformat(user['created_at'])
+    return users
+
+@api_router.delete("/admin/users/{user_id}")
+async def delete_user(user_id: str, current_user: User = Depends(get_admin_user)):
+    user = await db.users.find_one({"id": user_id}, {"_id": 0})
+    if not user or user["role"] == "admin":
+        raise HTTPException(status_code=403)
+    await db.users.delete_one({"id": user_id})
+    user_cache.invalidate(user["username"])
+    return {"message": "User deleted"}
+
+@api_router.get("/admin/stats")
+async def get_stats(current_user: User = Depends(get_admin_user)):
+    # Contagens via metadados da coleção (O(1)) e totais de arquivos/bytes via contadores
+    total_users, total_teams, usage, settings = await asyncio.gather(
+        db.users.estimated_document_count(),
+        db.teams.estimated_document_count(),
+        get_usage("global", "all"),
+        db.settings.find_one({"key": "chat_enabled"}),
+    )
+    total_files = usage["file_count"]
+    total_storage = usage["storage_bytes"]
+    
+    return {
+        "total_users": total_users,
+        "total_files": total_files,
+        "total_teams": total_teams,
+        "total_storage_bytes": total_storage,
+        "total_storage_mb": round(total_storage / (1024 * 1024), 2),
+        "chat_enabled": settings.get("value", False) if settings else False,
+        "storage_mode": STORAGE_MODE,
+        "storage_cache": storage_backend.stats() if isinstance(storage_backend, TieredStorageBackend) else None,
+        "user_cache": user_cache.stats(),
+        "preview_cache": preview_cache.stats(),
+        "team_cache": team_membership_cache.stats(),
+        "chat_hub": chat_hub.stats(),
+        "pubsub": pubsub.stats(),
+        "chat_writer": chat_writer.stats(),
+        "live_edit_hub": live_editor_manager.hub.stats(),
+        "live_edit_presence": live_editor_manager.presence.stats(),
+        "live_edit_documents": {
+            "open": len(live_editor_manager.documents),
+            "dirty": sum(1 for d in live_editor_manager.documents.values() if d.dirty),
+            "snapshots_saved": live_editor_manager.snapshots_saved
+        }
+    }
+
+# ===================================================================
+# EXPORT ZIP EM STREAMING
+# ===================================================================
+# Tipos que já vêm comprimidos: gravados como ZIP_STORED, sem gastar CPU recomprimindo
+ZIP_STORED_MIME_PREFIXES = (
+    "image/jpeg", "image/png", "image/gif", "image/webp", "image/avif", "image/heic",
+    "video/", "audio/", "application/pdf", "application/zip", "application/gzip",
+    "application/x-gzip", "application/x-7z-compressed", "application/x-rar-compressed",
+    "application/vnd.rar", "application/x-bzip2", "application/x-xz", "application/zstd",
+    "application/epub+zip", "application/vnd.openxmlformats-officedocument.",
+    "application/vnd.oasis.opendocument.",
+)
+ZIP_EXPORT_PREFETCH = int(os.environ.get("ZIP_EXPORT_PREFETCH", 4))
+ZIP_EXPORT_PREFETCH_MAX_BYTES = int(os.environ.get("ZIP_EXPORT_PREFETCH_MAX_BYTES", 16 * 1024 * 1024))
+
+class ZipStreamBuffer:
+    """Destino write-only do ZipFile: acumula bytes até serem drenados para a resposta"""
+    def __init__(self):
+        self._chunks = []
+        self.size = 0
+    
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        self.size += len(data)
+        return len(data)
+    
+    def flush(self):
+        pass
+    
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks = []
+        self.size = 0
+        return data
+
+def zip_compress_type(file_type: str) -> int:
+    return zipfile.ZIP_STORED if (file_type or "").startswith(ZIP_STORED_MIME_PREFIXES) else zipfile.ZIP_DEFLATED
+
+def zip_date_time(value) -> tuple:
+    try:
+        dt = value if isinstance(value, datetime) else datetime.fromisoformat(value)
+        return max(dt.timetuple()[:6], (1980, 1, 1, 0, 0, 0))
+    except (TypeError, ValueError):
+        return (1980, 1, 1, 0, 0, 0)
+
+async def fetch_export_source(file_metadata: dict):
+    """Arquivos pequenos são lidos inteiros (prefetch); os grandes ficam para streaming na hora de gravar"""
+    if file_metadata.get("file_size", 0) <= ZIP_EXPORT_PREFETCH_MAX_BYTES:
+        return await get_file_from_storage(file_metadata)
+    return None
+
+async def open_export_stream(file_metadata: dict):
+    backend = backend_for(file_metadata)
+    key = storage_key(file_metadata)
+    file_path = await backend.local_path(key)
+    if file_path is not None:
+        return iter_local_file(file_path)
+    return (await backend.open_stream(key)).body
+
+def human_zip_layout():
+    """Layout do backup "legível": usuario/nome_original, desambiguando nomes repetidos com o id"""
+    used_names = set()
+    
+    def layout(file_metadata: dict):
+        arcname = f"{file_metadata['uploaded_by']}/{file_metadata['original_name']}"
+        if arcname in used_names:
+            stem, suffix = os.path.splitext(arcname)
+            arcname = f"{stem} ({file_metadata['id']}){suffix}"
+        used_names.add(arcname)
+        return arcname, {}
+    return layout
+
+async def stream_zip_export(files_cursor, manifest: dict, extra_entries: Optional[dict] = None, layout=None,
+                            failures: Optional[list] = None):
+    """Gera o ZIP entrada por entrada enquanto os próximos arquivos são buscados em paralelo.
+
+    A memória fica limitada a ZIP_EXPORT_PREFETCH arquivos pequenos + um chunk do arquivo atual.
+    Falhas não interrompem o export: vão para `failures` no _manifest.json (última entrada).
+    `layout(file_metadata)` devolve (arcname do conteúdo ou None para não gravá-lo, entradas extras).
+    Se `failures` for passada, as falhas também são acumuladas nela (para quem chama).
+    """
+    buffer = ZipStreamBuffer()
+    zip_file = zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED)
+    layout = layout or human_zip_layout()
+    failures = failures if failures is not None else []
+    exported = 0
+    exported_bytes = 0
+    pending = deque()
+    cursor_iter = files_cursor.__aiter__()
+    cursor_done = False
+    
+    async def fill_window():
+        nonlocal cursor_done
+        while not cursor_done and len(pending) < ZIP_EXPORT_PREFETCH:
+            try:
+                file_metadata = await cursor_iter.__anext__()
+            except StopAsyncIteration:
+                cursor_done = True
+                break
+            arcname, side_entries = layout(file_metadata)
+            fetch_task = asyncio.create_task(fetch_export_source(file_metadata)) if arcname else None
+            pending.append((file_metadata, arcname, side_entries, fetch_task))
+    
+    try:
+        await fill_window()
+        while pending:
+            file_metadata, arcname, side_entries, fetch_task = pending.popleft()
+            await fill_window()
+            
+            for name, data in side_entries.items():
+                zip_file.writestr(name, data)
+            if arcname is None:
+                exported += 1
+                continue
+            
+            written = False
+            try:
+                content = await fetch_task
+                chunks = iter_bytes(content) if content is not None else await open_export_stream(file_metadata)
+                zinfo = zipfile.ZipInfo(arcname, zip_date_time(file_metadata.get("uploaded_at")))
+                zinfo.compress_type = zip_compress_type(file_metadata.get("file_type"))
+                with zip_file.open(zinfo, 'w', force_zip64=True) as dest:
+                    written = True
+                    async for chunk in chunks:
+                        if zinfo.compress_type == zipfile.ZIP_DEFLATED:
+                            await asyncio.to_thread(dest.write, chunk)
+                        else:
+                            dest.write(chunk)
+                        if buffer.size >= UPLOAD_CHUNK_SIZE:
+                            yield buffer.drain()
+                exported += 1
+                exported_bytes += file_metadata.get("file_size", 0)
+            except Exception as e:
+                detail = e.detail if isinstance(e, HTTPException) else str(e)
+                logger.error(f"Export: falha em {file_metadata.get('id')}: {detail}")
+                failures.append({
+                    "id": file_metadata.get("id"),
+                    "name": arcname,
+                    "error": str(detail),
+                    "truncated_entry": written,
+                })
+            if buffer.size:
+                yield buffer.drain()
+        
+        for name, data in (extra_entries or {}).items():
+            zip_file.writestr(name, data)
+        manifest = {
+            **manifest,
+            "generated_at": datetime.now(timezone.utc).isoformat(),
+            "exported_files": exported,
+            "exported_bytes": exported_bytes,
+            "failures": failures,
+        }
+        zip_file.writestr("_manifest.json", json.dumps(manifest, indent=2, default=str))
+        zip_file.close()
+        yield buffer.drain()
+    finally:
+        for *_, task in pending:
+            if task:
+                task.cancel()
+
+def export_filters_query(username: Optional[str], team_id: Optional[str],
+                         date_from: Optional[datetime], date_to: Optional[datetime]) -> dict:
+    query = {}
+    if username:
+        query["uploaded_by"] = username
+    if team_id:
+        query["team_id"] = team_id
+    date_range = {}
+    if date_from:
+        date_range["$gte"] = (date_from if date_from.tzinfo else date_from.replace(tzinfo=timezone.utc)).isoformat()
+    if date_to:
+        date_range["$lte"] = (date_to if date_to.tzinfo else date_to.replace(tzinfo=timezone.utc)).isoformat()
+    if date_range:
+        query["uploaded_at"] = date_range
+    return query
+
+@api_router.post("/admin/usage/reconcile")
+async def reconcile_usage(current_user: User = Depends(get_admin_user)):
+    return await reconcile_usage_counters()
+
+@api_router.get("/admin/indexes")
+async def get_index_report(current_user: User = Depends(get_admin_user)):
+    return await index_report()
+
+@api_router.get("/admin/download-all")
+async def download_all_files(
+    username: Optional[str] = None,
+    team_id: Optional[str] = None,
+    date_from: Optional[datetime] = None,
+    date_to: Optional[datetime] = None,
+    current_user: User = Depends(get_admin_user)
+):
+    query = export_filters_query(username, team_id, date_from, date_to)
+    files_cursor = db.files.find(query, {"_id": 0, "password_hash": 0}).sort([("uploaded_at", 1), ("id", 1)])
+    manifest = {"type": "full", "filters": {"username": username, "team_id": team_id,
+                                            "date_from": date_from, "date_to": date_to}}
+    return StreamingResponse(
+        stream_zip_export(files_cursor, manifest),
+        media_type="application/zip",
+        headers={"Content-Disposition": "attachment; filename=backup.zip"}
+    )
+
+# Backups incrementais: cada snapshot guarda o cursor (uploaded_at, id) do último arquivo exportado
+# e o instante em que começou; o próximo exporta só o que entrou/mudou depois disso + as exclusões.
+def snapshot_zip_layout():
+    """Layout restaurável: conteúdo em blobs/<checksum> (uma vez por conteúdo) e metadados em meta/<id>.json"""
+    written_blobs = set()
+    
+    def layout(file_metadata: dict):
+        content_key = file_metadata.get("checksum") or file_metadata["id"]
+        arcname = f"blobs/{content_key}"
+        doc = {**file_metadata, "archive_path": arcname}
+        side_entries = {f"meta/{file_metadata['id']}.json": json.dumps(doc, default=str)}
+        if content_key in written_blobs:
+            return None, side_entries
+        written_blobs.add(content_key)
+        return arcname, side_entries
+    return layout
+
+def after_cursor_query(cursor: dict) -> dict:
+    return {"$or": [
+        {"uploaded_at": {"$gt": cursor["uploaded_at"]}},
+        {"uploaded_at": cursor["uploaded_at"], "id": {"$gt": cursor["id"]}},
+    ]}
+
+def up_to_cursor_query(cursor: dict) -> dict:
+    return {"$or": [
+        {"uploaded_at": {"$lt": cursor["uploaded_at"]}},
+        {"uploaded_at": cursor["uploaded_at"], "id": {"$lte": cursor["id"]}},
+    ]}
+
+async def stream_snapshot(snapshot: dict, files_query: dict, deletions: list, manifest: dict):
+    """Streaming do snapshot; só é registrado em backup_snapshots se o ZIP for entregue inteiro.
+
+    Arquivos que falharam no export ficam em `failed_ids` e entram de novo no próximo
+    incremental, mesmo estando antes do cursor.
+    """
+    files_cursor = db.files.find(files_query, {"_id": 0}).sort([("uploaded_at", 1), ("id", 1)])
+    extra_entries = {"deleted.json": json.dumps(deletions, default=str)}
+    failures = []
+    async for chunk in stream_zip_export(files_cursor, manifest, extra_entries, layout=snapshot_zip_layout(),
+                                         failures=failures):
+        yield chunk
+    await db.backup_snapshots.insert_one({**snapshot, "failed_ids": [f["id"] for f in failures if f.get("id")]})
+
+@api_router.get("/admin/backups")
+async def list_backup_snapshots(current_user: User = Depends(get_admin_user)):
+    return await db.backup_snapshots.find({}, {"_id": 0}).sort("created_at", -1).to_list(100)
+
+@api_router.get("/admin/backups/incremental")
+async def download_incremental_backup(full: bool = False, current_user: User = Depends(get_admin_user)):
+    """Exporta o que mudou desde o último snapshot concluído (ou tudo, se não houver/full=true)"""
+    started_at = datetime.now(timezone.utc).isoformat()
+    parent = None if full else await db.backup_snapshots.find_one({}, {"_id": 0}, sort=[("created_at", -1)])
+    
+    last_file = await db.files.find_one({}, {"_id": 0, "uploaded_at": 1, "id": 1},
+                                        sort=[("uploaded_at", -1), ("id", -1)])
+    cursor = {"uploaded_at": last_file["uploaded_at"], "id": last_file["id"]} if last_file else None
+    if parent and parent.get("cursor") and not cursor:
+        cursor = parent["cursor"]
+    
+    if parent is None:
+        files_query = up_to_cursor_query(cursor) if cursor else {"id": {"$exists": False}}
+        deletions = []
+    else:
+        changed = {"updated_at": {"$gt": parent["started_at"], "$lte": started_at}}
+        added = after_cursor_query(parent["cursor"]) if parent.get("cursor") else {}
+        if cursor:
+            added = {"$and": [added, up_to_cursor_query(cursor)]} if added else up_to_cursor_query(cursor)
+        files_query = {"$or": [added, changed]}
+        if parent.get("failed_ids"):
+            files_query["$or"].append({"id": {"$in": parent["failed_ids"]}})
+        deletions = await db.file_tombstones.find(
+            {"deleted_at": {"$gt": parent["started_at"], "$lte": started_at}}, {"_id": 0}
+        ).to_list(None)
+    
+    snapshot = {
+        "id": str(uuid.uuid4()),
+        "type": "full" if parent is None else "incremental",
+        "parent_id": parent["id"] if parent else None,
+        "started_at": started_at,
+        "cursor": cursor,
+        "deleted_count": len(deletions),
+        "created_at": datetime.now(timezone.utc).isoformat(),
+    }
+    manifest = {**snapshot, "format": "biblioteca-snapshot-v1"}
+    filename = f"snapshot-{started_at[:19].replace(':', '')}-{snapshot['type']}.zip"
+    return StreamingResponse(
+        stream_snapshot(snapshot, files_query, deletions, manifest),
+        media_type="application/zip",
+        headers={"Content-Disposition": f"attachment; filename={filename}"}
+    )
+
+async def restore_snapshot_archive(zip_path: Path) -> dict:
+    """Reaplica um snapshot (full ou incremental) em UPLOAD_DIR e na coleção files.
+
+    Snapshots devem ser aplicados em ordem: o full primeiro, depois cada incremental.
+    """
+    local = storage_backends["local"]
+    restored = 0
+    with zipfile.ZipFile(zip_path) as archive:
+        manifest = json.loads(archive.read("_manifest.json"))
+        if manifest.get("format") != "biblioteca-snapshot-v1":
+            raise ValueError(f"{zip_path} não é um snapshot de backup")
+        failed_ids = {f["id"] for f in manifest.get("failures", [])}
+        
+        for name in archive.namelist():
+            if not (name.startswith("meta/") and name.endswith(".json")):
+                continue
+            doc = json.loads(archive.read(name))
+            if doc["id"] in failed_ids:
+                logger.warning(f"Restore: {doc['id']} falhou no export, mantendo o estado atual")
+                continue
+            archive_path = doc.pop("archive_path")
+            
+            async def chunks(archive_path=archive_path):
+                with archive.open(archive_path) as src:
+                    while True:
+                        chunk = src.read(UPLOAD_CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        yield chunk
+            
+            if not await local.exists(doc["filename"]):
+                await local.write_stream(doc["filename"], chunks())
+            doc.update({"storage_location": "local", "supabase_path": None})
+            # Renditions não vão no snapshot: são regeradas sob demanda no primeiro preview
+            doc.pop("renditions", None)
+            await db.files.replace_one({"id": doc["id"]}, doc, upsert=True)
+            restored += 1
+        
+        deleted = 0
+        for tombstone in json.loads(archive.read("deleted.json")):
+            file_metadata = await db.files.find_one({"id": tombstone["file_id"]}, {"_id": 0})
+            if file_metadata:
+                await db.files.delete_one({"id": tombstone["file_id"]})
+                await release_file_storage(file_metadata)
+                deleted += 1
+    return {"snapshot_id": manifest["id"], "type": manifest["type"], "restored": restored, "deleted": deleted}
+
+@api_router.get("/admin/download-source-code")
+async def download_source_code(current_user: User = Depends(get_admin_user)):
+    zip_buffer = io.BytesIO()
+    with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+        for dir_path in [Path("/app/backend"), Path("/app/frontend")]:
+            for file_path in dir_path.rglob("*"):
+                if file_path.is_file() and 'node_modules' not in str(file_path) and '__pycache__' not in str(file_path):
                     try:
                         arcname = f"{dir_path.name}/{file_path.relative_to(dir_path)}"
                         zip_file.write(file_path, arcname)
@@ -896,29 +3455,390 @@ async def download_source_code(current_user: User = Depends(get_admin_user)):
     zip_buffer.seek(0)
     return StreamingResponse(iter([zip_buffer.getvalue()]), media_type="application/zip", headers={"Content-Disposition": "attachment; filename=source_code.zip"})
 
-app.include_router(api_router)
-
 # ===================================================================
-# LIVE EDITING WEBSOCKET
+# LIVE EDITING - documento autoritativo e operações de texto (OT)
 # ===================================================================
+LIVE_EDIT_HISTORY_SIZE = int(os.environ.get("LIVE_EDIT_HISTORY_SIZE", 1000))
+LIVE_EDIT_MAX_BYTES = int(os.environ.get("LIVE_EDIT_MAX_BYTES", 2 * 1024 * 1024))
+# Snapshot gravado após LIVE_EDIT_SAVE_DELAY s sem edições, ou no máximo LIVE_EDIT_SAVE_MAX_DELAY s após a primeira
+LIVE_EDIT_SAVE_DELAY = float(os.environ.get("LIVE_EDIT_SAVE_DELAY", 2))
+LIVE_EDIT_SAVE_MAX_DELAY = float(os.environ.get("LIVE_EDIT_SAVE_MAX_DELAY", 15))
+# Tentativas de trocar o blob do registro quando outra escrita o alterou no meio tempo
+LIVE_EDIT_SAVE_ATTEMPTS = 3
+# Intervalo (ms) em que as posições de cursor de uma sessão são agrupadas num só frame
+LIVE_EDIT_PRESENCE_TICK_MS = int(os.environ.get("LIVE_EDIT_PRESENCE_TICK_MS", 40))
+# Validade do ticket de sessão: reconexões dentro dela não consultam users/teams
+LIVE_EDIT_TICKET_TTL_SECONDS = int(os.environ.get("LIVE_EDIT_TICKET_TTL_SECONDS", 300))
+# Lease de uma sessão em live_edit_leases: só o worker dono mantém o documento e aceita joins
+LIVE_EDIT_LEASE_SECONDS = float(os.environ.get("LIVE_EDIT_LEASE_SECONDS", 30))
+
+class LiveSessionElsewhere(Exception):
+    """A sessão deste arquivo pertence a outro worker (lease ativo)"""
+
+# Uma operação é [posição, quantos caracteres remover, texto inserido], em code points.
+# O cliente (LiveEditor.jsx) implementa as mesmas apply/transform.
+def apply_text_op(text: str, op: list) -> str:
+    pos, delete, insert = op
+    if pos < 0 or delete < 0 or pos + delete > len(text):
+        raise ValueError("Operação fora do documento")
+    return text[:pos] + insert + text[pos + delete:]
+
+def transform_text_op(op: list, other: list, op_first: bool) -> list:
+    """Reescreve `op` para ser aplicada depois de `other` (concorrentes, mesma revisão base).
+
+    op_first decide o empate (inserções no mesmo ponto) e a ordem dos textos quando os
+    intervalos se sobrepõem; o servidor dá prioridade a quem foi sequenciado antes.
+    """
+    pos, delete, insert = op
+    other_pos, other_delete, other_insert = other
+    shift = len(other_insert) - other_delete
+    
+    same_point = delete == 0 and other_delete == 0 and pos == other_pos
+    if same_point:
+        return [pos, 0, insert] if op_first else [pos + len(other_insert), 0, insert]
+    if pos + delete <= other_pos:
+        return [pos, delete, insert]
+    if pos >= other_pos + other_delete:
+        return [pos + shift, delete, insert]
+    
+    # Intervalos sobrepostos: a união é substituída pelos dois textos inseridos
+    start = min(pos, other_pos)
+    end = max(pos + delete, other_pos + other_delete) + shift
+    merged = insert + other_insert if op_first else other_insert + insert
+    return [start, end - start, merged]
+
+def parse_text_op(raw) -> list:
+    if (not isinstance(raw, list) or len(raw) != 3 or not isinstance(raw[0], int)
+            or not isinstance(raw[1], int) or not isinstance(raw[2], str)):
+        raise ValueError("Operação inválida")
+    return list(raw)
+
+class LiveDocument:
+    """Documento autoritativo de uma sessão: texto, revisão e operações recentes.
+
+    Operações chegam com a revisão em que o cliente as gerou; são transformadas contra
+    as que o servidor aplicou depois disso e ganham a próxima revisão. `saved_rev` é a
+    última revisão gravada no storage (ver LiveEditorManager.save).
+    """
+    def __init__(self, content: str, file_metadata: Optional[dict] = None, rev: int = 0,
+                 history_size: int = LIVE_EDIT_HISTORY_SIZE):
+        self.content = content
+        self.file_metadata = file_metadata
+        self.rev = rev
+        self.saved_rev = rev
+        self.history: deque = deque(maxlen=history_size)
+        self.dirty_since: Optional[float] = None
+        self.last_change = 0.0
+        self.save_lock = asyncio.Lock()
+    
+    @property
+    def dirty(self) -> bool:
+        return self.rev != self.saved_rev
+    
+    def apply_client_op(self, base_rev: int, op: list) -> list:
+        """Aplica a operação; devolve a versão transformada. ValueError => o cliente deve ressincronizar"""
+        oldest = self.rev - len(self.history)
+        if base_rev > self.rev or base_rev < oldest:
+            raise ValueError("Revisão desconhecida")
+        for applied in list(self.history)[base_rev - oldest:]:
+            op = transform_text_op(op, applied, op_first=False)
+        self.content = apply_text_op(self.content, op)
+        self.rev += 1
+        self.history.append(op)
+        self.last_change = time.monotonic()
+        if self.dirty_since is None:
+            self.dirty_since = self.last_change
+        return op
+    
+    def snapshot(self) -> dict:
+        return {"type": "doc", "content": self.content, "rev": self.rev}
+
 # ===================================================================
 # LIVE EDITOR MANAGER - Sistema de Edição Colaborativa
 # ===================================================================
+async def persist_live_document(file_metadata: dict, content: str) -> Optional[dict]:
+    """Grava o texto como novo blob e aponta o registro para ele; devolve o metadado novo.
+
+    A troca é condicional ao blob que o registro tinha (checksum/filename): se outra escrita o
+    alterou, o registro é relido e a troca refeita sobre ele, para que contadores e o blob
+    liberado sejam os do registro real. Devolve None se o arquivo foi removido enquanto a
+    sessão estava aberta.
+    """
+    updated = False
+    async with store_content_addressed(iter_bytes(content.encode("utf-8"))) as storage_info:
+        update = {
+            "filename": storage_info["filename"],
+            "storage_location": storage_info["storage_location"],
+            "supabase_path": storage_info.get("supabase_path"),
+            "checksum": storage_info["checksum"],
+            "file_size": storage_info["file_size"],
+            "updated_at": datetime.now(timezone.utc).isoformat(),
+        }
+        current = file_metadata
+        for _ in range(LIVE_EDIT_SAVE_ATTEMPTS):
+            if storage_info["checksum"] == current.get("checksum") and storage_info["filename"] == current["filename"]:
+                return current
+            result = await db.files.update_one(
+                {"id": current["id"], "checksum": current.get("checksum"), "filename": current["filename"]},
+                {"$set": update, "$unset": {"renditions": ""}}
+            )
+            if result.matched_count:
+                updated = True
+                break
+            current = await db.files.find_one({"id": file_metadata["id"]}, {"_id": 0})
+            if current is None:
+                break
+    new_metadata = {k: v for k, v in (current or file_metadata).items() if k != "renditions"}
+    new_metadata.update(update)
+    if not updated:
+        # Nenhum registro passou a referenciar o blob novo
+        await release_file_storage(new_metadata)
+        if current is None:
+            return None
+        raise RuntimeError("Registro do arquivo alterado durante a gravação")
+    
+    # Contadores, caches e renditions passam a refletir a nova versão; o blob antigo sai se ninguém mais o usa
+    await record_usage(current, -1)
+    await record_usage(new_metadata, 1)
+    preview_cache.invalidate(current["id"])
+    await release_file_storage(current)
+    schedule_renditions(new_metadata)
+    return new_metadata
+
+class PresenceAggregator:
+    """Agrupa cursores/seleções por sessão e os envia num único frame "cursor_batch" por tick.
+
+    Só a última posição de cada usuário no intervalo sobrevive; sessões sem movimento não
+    geram frames. `publish` recebe (team_id, file_id, mensagem).
+    """
+    def __init__(self, publish, tick_ms: int = LIVE_EDIT_PRESENCE_TICK_MS):
+        self.publish = publish
+        self.tick = tick_ms / 1000
+        self.pending: Dict[tuple, Dict[str, dict]] = {}
+        self.flush_task: Optional[asyncio.Task] = None
+        self.received = 0
+        self.batches_sent = 0
+    
+    def update(self, team_id: str, file_id: str, username: str, cursor: dict):
+        self.received += 1
+        self.pending.setdefault((team_id, file_id), {})[username] = cursor
+        if self.flush_task is None:
+            self.flush_task = asyncio.create_task(self._flush_after_tick())
+    
+    def discard(self, team_id: str, file_id: str, username: str):
+        """Usuário saiu: a posição pendente dele não deve chegar depois do user_left"""
+        session = self.pending.get((team_id, file_id))
+        if session is not None:
+            session.pop(username, None)
+    
+    async def _flush_after_tick(self):
+        try:
+            await asyncio.sleep(self.tick)
+        finally:
+            self.flush_task = None
+        pending, self.pending = self.pending, {}
+        timestamp = datetime.now(timezone.utc).isoformat()
+        for (team_id, file_id), cursors in pending.items():
+            if not cursors:
+                continue
+            try:
+                await self.publish(team_id, file_id, {
+                    "type": "cursor_batch",
+                    "cursors": [{"username": username, **cursor} for username, cursor in cursors.items()],
+                    "timestamp": timestamp
+                })
+                self.batches_sent += 1
+            except Exception as e:
+                logger.error(f"Live-edit: falha ao enviar cursores: {e}")
+    
+    def stats(self) -> dict:
+        return {"tick_ms": int(self.tick * 1000), "pending_sessions": len(self.pending),
+                "received": self.received, "batches_sent": self.batches_sent}
+
 class LiveEditorManager:
-    """Gerencia WebSockets para edição colaborativa de arquivos"""
+    """Gerencia WebSockets e documentos das sessões de edição colaborativa.
+
+    Os envios passam pelas filas do BroadcastHub: nenhum cliente lento atrasa os outros e
+    cada conexão recebe as operações na ordem das revisões. O documento autoritativo de uma
+    sessão vive num único worker, dono do lease dela em live_edit_leases; todo o tráfego da
+    sessão é local a ele. Joins em outro worker são recusados (close 1013) e o cliente tenta
+    de novo; com vários workers, rotear por file_id no balanceador evita as recusas.
+    """
     def __init__(self):
         self.active_connections = {}
+        self.documents: Dict[tuple, LiveDocument] = {}
+        self.loading: Dict[tuple, asyncio.Task] = {}
+        self.save_tasks: Dict[tuple, asyncio.Task] = {}
+        self.close_retries: Set[tuple] = set()
+        self.hub = BroadcastHub("live-edit")
+        self.presence = PresenceAggregator(self.broadcast_to_session)
+        self.snapshots_saved = 0
+    
+    async def get_document(self, file_metadata: dict, team_id: str) -> LiveDocument:
+        """Documento da sessão, carregado do storage na primeira entrada (uma carga por sessão)"""
+        key = (team_id, file_metadata["id"])
+        if key in self.documents:
+            return self.documents[key]
+        task = self.loading.get(key)
+        if task is None:
+            task = asyncio.create_task(self._load_document(file_metadata, team_id))
+            self.loading[key] = task
+            task.add_done_callback(lambda _: self.loading.pop(key, None))
+        document = await asyncio.shield(task)
+        return self.documents.setdefault(key, document)
+    
+    async def _load_document(self, file_metadata: dict, team_id: str) -> LiveDocument:
+        if "text" not in rendition_kinds(file_metadata):
+            raise ValueError("Edição ao vivo disponível só para arquivos de texto")
+        if file_metadata["file_size"] > LIVE_EDIT_MAX_BYTES:
+            raise ValueError("Arquivo grande demais para edição ao vivo")
+        key = (team_id, file_metadata["id"])
+        if not await self.acquire_lease(key):
+            raise LiveSessionElsewhere()
+        try:
+            # Relido depois do lease: o dono anterior pode ter gravado um snapshot
+            current = await db.files.find_one({"id": file_metadata["id"]}, {"_id": 0}) or file_metadata
+            content = await get_file_from_storage(current)
+        except BaseException:
+            await self.release_lease(key)
+            raise
+        return LiveDocument(content.decode("utf-8", errors="replace"), current)
+    
+    @staticmethod
+    def lease_id(key: tuple) -> str:
+        return f"{key[0]}:{key[1]}"
+    
+    async def acquire_lease(self, key: tuple) -> bool:
+        """Toma (ou renova) o lease da sessão; False se outro worker o detém e ele não expirou"""
+        now = time.time()
+        try:
+            await db.live_edit_leases.update_one(
+                {"_id": self.lease_id(key), "$or": [{"worker": WORKER_ID}, {"expires_at": {"$lt": now}}]},
+                {"$set": {"worker": WORKER_ID, "expires_at": now + LIVE_EDIT_LEASE_SECONDS}},
+                upsert=True
+            )
+        except DuplicateKeyError:
+            return False
+        return True
+    
+    async def release_lease(self, key: tuple):
+        await db.live_edit_leases.delete_one({"_id": self.lease_id(key), "worker": WORKER_ID})
+    
+    async def lease_loop(self):
+        """Renova os leases das sessões abertas; uma sessão cujo lease se perdeu é encerrada aqui"""
+        while True:
+            await asyncio.sleep(LIVE_EDIT_LEASE_SECONDS / 3)
+            for key in list(self.documents):
+                try:
+                    renewed = await self.acquire_lease(key)
+                except Exception as e:
+                    logger.error(f"Live-edit: falha ao renovar lease de {key[1]}: {e}")
+                    continue
+                if not renewed:
+                    await self.evict(key)
+    
+    async def evict(self, key: tuple):
+        """Outro worker assumiu a sessão: descarta o documento local (sem gravar) e desconecta todos"""
+        logger.warning(f"Live-edit: lease de {key[1]} perdido, encerrando a sessão local")
+        self.documents.pop(key, None)
+        task = self.save_tasks.pop(key, None)
+        if task:
+            task.cancel()
+        session = dict(self.active_connections.get(key[0], {}).get(key[1], {}))
+        for websocket in session.values():
+            try:
+                await send_ws_message(websocket, {"type": "error", "message": "Sessão transferida, reconectando"})
+                await websocket.close(code=1013)
+            except Exception:
+                pass
+    
+    def schedule_save(self, key: tuple):
+        """Agenda a gravação do documento (uma tarefa por sessão, que junta várias edições)"""
+        if key not in self.save_tasks:
+            task = asyncio.create_task(self._debounced_save(key))
+            self.save_tasks[key] = task
+            task.add_done_callback(lambda _: self.save_tasks.pop(key, None))
+    
+    async def _debounced_save(self, key: tuple):
+        while True:
+            document = self.documents.get(key)
+            if document is None or not document.dirty:
+                return
+            due = min(document.last_change + LIVE_EDIT_SAVE_DELAY, document.dirty_since + LIVE_EDIT_SAVE_MAX_DELAY)
+            wait = due - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            elif not await self.save(key):
+                await asyncio.sleep(LIVE_EDIT_SAVE_MAX_DELAY)
+    
+    async def save(self, key: tuple) -> bool:
+        """Grava o snapshot atual se houver alterações; avisa a sessão com a revisão gravada"""
+        document = self.documents.get(key)
+        if document is None:
+            return False
+        async with document.save_lock:
+            if not document.dirty or document.file_metadata is None:
+                return True
+            rev, content = document.rev, document.content
+            try:
+                new_metadata = await persist_live_document(document.file_metadata, content)
+            except Exception as e:
+                logger.error(f"Live-edit: falha ao gravar {key[1]}: {e}")
+                return False
+            document.file_metadata = new_metadata
+            document.saved_rev = rev
+            # Edições que chegaram durante a gravação contam a partir de agora
+            document.dirty_since = time.monotonic() if document.dirty else None
+            self.snapshots_saved += 1
+        await self.broadcast_to_session(key[0], key[1], {
+            "type": "snapshot_saved", "rev": rev, "timestamp": datetime.now(timezone.utc).isoformat()
+        })
+        return True
+    
+    async def close_session_if_idle(self, team_id: str, file_id: str):
+        """Depois que o último participante sai: grava o que falta e libera o documento"""
+        key = (team_id, file_id)
+        if self.active_connections.get(team_id, {}).get(file_id) or key not in self.documents:
+            return
+        if not await self.save(key):
+            # Mantém o documento (e o lease) para não descartar as edições; tenta de novo mais tarde
+            if key not in self.close_retries:
+                self.close_retries.add(key)
+                start_background_task(self._retry_close(key))
+            return
+        # Alguém pode ter entrado durante a gravação
+        if not self.active_connections.get(team_id, {}).get(file_id) and key in self.documents:
+            self.documents.pop(key)
+            await self.release_lease(key)
+    
+    async def _retry_close(self, key: tuple):
+        try:
+            await asyncio.sleep(LIVE_EDIT_SAVE_MAX_DELAY)
+        finally:
+            self.close_retries.discard(key)
+        await self.close_session_if_idle(*key)
+    
+    async def flush_all(self):
+        """Shutdown: grava todos os documentos com alterações pendentes e libera os leases"""
+        for task in list(self.save_tasks.values()):
+            task.cancel()
+        for key in list(self.documents):
+            if not await self.save(key):
+                logger.error(f"Live-edit: edições de {key[1]} não gravadas no shutdown")
+            await self.release_lease(key)
     
     async def connect(self, websocket: WebSocket, team_id: str, file_id: str, username: str):
-        """Conecta um usuário a uma sessão de edição"""
-        await websocket.accept()
-        
+        """Conecta um usuário (WebSocket já aceito pelo endpoint) a uma sessão de edição"""
         if team_id not in self.active_connections:
             self.active_connections[team_id] = {}
         if file_id not in self.active_connections[team_id]:
             self.active_connections[team_id][file_id] = {}
         
+        previous = self.active_connections[team_id][file_id].get(username)
+        if previous is not None and previous is not websocket:
+            self.hub.unregister(previous)
         self.active_connections[team_id][file_id][username] = websocket
+        self.hub.register(websocket)
         
         # Notificar outros usuários
         await self.broadcast_to_session(team_id, file_id, {
@@ -927,41 +3847,59 @@ class LiveEditorManager:
             "timestamp": datetime.now(timezone.utc).isoformat()
         }, exclude_username=username)
         
-        # Enviar lista de usuários ativos
+        # Enviar lista de usuários ativos e o estado atual do documento
         active_users = list(self.active_connections[team_id][file_id].keys())
-        await websocket.send_json({
-            "type": "users_list",
-            "users": active_users
-        })
+        self.send(websocket, {"type": "users_list", "users": active_users})
+        document = self.documents.get((team_id, file_id))
+        if document:
+            self.send(websocket, document.snapshot())
     
-    def disconnect(self, team_id: str, file_id: str, username: str):
-        """Desconecta um usuário"""
-        try:
-            if (team_id in self.active_connections and 
-                file_id in self.active_connections[team_id] and 
-                username in self.active_connections[team_id][file_id]):
-                
-                del self.active_connections[team_id][file_id][username]
-                
-                if not self.active_connections[team_id][file_id]:
-                    del self.active_connections[team_id][file_id]
-                if not self.active_connections[team_id]:
-                    del self.active_connections[team_id]
-        except:
-            pass
+    def disconnect(self, team_id: str, file_id: str, username: str, websocket: Optional[WebSocket] = None):
+        """Desconecta um usuário (só se `websocket` ainda for a conexão dele, quando informado)"""
+        session = self.active_connections.get(team_id, {}).get(file_id, {})
+        current = session.get(username)
+        if current is None or (websocket is not None and current is not websocket):
+            if websocket is not None:
+                self.hub.unregister(websocket)
+            return
+        
+        self.hub.unregister(current)
+        self.presence.discard(team_id, file_id, username)
+        del session[username]
+        if not session:
+            del self.active_connections[team_id][file_id]
+        if not self.active_connections[team_id]:
+            del self.active_connections[team_id]
+    
+    def send(self, websocket: WebSocket, message: dict):
+        self.hub.send([websocket], message)
     
     async def broadcast_to_session(self, team_id: str, file_id: str, message: dict, exclude_username: str = None):
-        """Envia mensagem para todos na sessão (broadcast)"""
-        if team_id not in self.active_connections or file_id not in self.active_connections[team_id]:
+        """Envia mensagem para todos na sessão (serializa uma vez, enfileira para cada um).
+
+        Local de propósito: todos os participantes estão no worker dono do lease.
+        """
+        session = self.active_connections.get(team_id, {}).get(file_id)
+        if not session:
             return
-        
-        for username, connection in list(self.active_connections[team_id][file_id].items()):
-            if exclude_username and username == exclude_username:
-                continue
-            try:
-                await connection.send_json(message)
-            except:
-                self.disconnect(team_id, file_id, username)
+        self.hub.send([ws for username, ws in session.items() if username != exclude_username], message)
+    
+    async def apply_operation(self, team_id: str, file_id: str, username: str, websocket: WebSocket,
+                              base_rev: int, op: list):
+        """Aplica a operação do cliente, confirma para ele (ack) e repassa a versão transformada aos outros"""
+        document = self.documents.get((team_id, file_id))
+        if document is None:
+            return
+        try:
+            op = document.apply_client_op(base_rev, op)
+        except ValueError as e:
+            self.send(websocket, {**document.snapshot(), "type": "resync", "reason": str(e)})
+            return
+        self.send(websocket, {"type": "ack", "rev": document.rev})
+        self.schedule_save((team_id, file_id))
+        await self.broadcast_to_session(team_id, file_id, {
+            "type": "op", "username": username, "rev": document.rev, "op": op
+        }, exclude_username=username)
     
     def get_active_users(self, team_id: str, file_id: str) -> list:
         """Retorna lista de usuários ativos em uma sessão"""
@@ -971,167 +3909,200 @@ class LiveEditorManager:
 
 live_editor_manager = LiveEditorManager()
 
-# ===================================================================
-# WEBSOCKET ENDPOINTS - Live Editing
-# ===================================================================
+def create_live_edit_ticket(username: str, team_id: str, file_id: str) -> str:
+    return create_access_token(
+        {"sub": username, "typ": "live-edit", "team": team_id, "file": file_id},
+        timedelta(seconds=LIVE_EDIT_TICKET_TTL_SECONDS)
+    )
 
-@app.websocket("/api/ws/live-edit/{file_id}")
-async def websocket_live_edit_simple(websocket: WebSocket, file_id: str):
-    """
-    Endpoint simplificado para Live Editing (sem team_id na URL)
-    Extrai team_id do arquivo automaticamente
+def read_live_edit_ticket(ticket: str, file_id: str) -> Optional[tuple]:
+    """(username, team_id) de um ticket válido para este arquivo, senão None"""
+    try:
+        payload = jwt.decode(ticket, SECRET_KEY, algorithms=[ALGORITHM])
+    except JWTError:
+        return None
+    if payload.get("typ") != "live-edit" or payload.get("file") != file_id:
+        return None
+    if not payload.get("sub") or not payload.get("team"):
+        return None
+    return payload["sub"], payload["team"]
+
+async def authorize_live_edit(websocket: WebSocket, join_data: dict, file_id: str,
+                              team_id: Optional[str] = None) -> Optional[tuple]:
+    """Autoriza o join e devolve (username, team_id, file_metadata), ou None.
+
+    Com ticket válido não há consulta a users/teams (nem a files, se o documento já está
+    aberto); uma remoção do time só vale para reconexões depois que o ticket expira.
+    Sem ticket, o JWT de acesso (join ou ?token=) é validado uma vez e usuário, times e
+    arquivo são resolvidos em paralelo.
     """
-    username = None
-    team_id = None
+    ticket = join_data.get("ticket")
+    claims = read_live_edit_ticket(ticket, file_id) if isinstance(ticket, str) else None
+    if claims and team_id in (None, claims[1]):
+        username, team_id = claims
+        document = live_editor_manager.documents.get((team_id, file_id))
+        file_metadata = document.file_metadata if document else None
+        if file_metadata is None:
+            file_metadata = await db.files.find_one({"id": file_id}, {"_id": 0})
+        if file_metadata and file_metadata.get("team_id") == team_id:
+            return username, team_id, file_metadata
+        return None
+    
+    token = join_data.get("token") or websocket.query_params.get("token")
+    if not isinstance(token, str):
+        return None
+    try:
+        username = token_username(token)
+        user, team_ids, file_metadata = await asyncio.gather(
+            get_user_by_username(username),
+            load_team_ids(username),
+            db.files.find_one({"id": file_id}, {"_id": 0}),
+        )
+    except HTTPException:
+        return None
+    if not file_metadata or not file_metadata.get("team_id"):
+        return None
+    if team_id is not None and file_metadata["team_id"] != team_id:
+        return None
+    if file_metadata["team_id"] not in team_ids:
+        return None
+    return user.username, file_metadata["team_id"], file_metadata
+
+async def run_live_edit_session(websocket: WebSocket, file_metadata: dict, team_id: str, username: str):
+    """Loop de mensagens comum aos dois endpoints de live-edit, depois da autorização"""
+    file_id = file_metadata["id"]
+    try:
+        await live_editor_manager.get_document(file_metadata, team_id)
+    except LiveSessionElsewhere:
+        # 1013 (try again later): o cliente reconecta; com roteamento por file_id cai no dono
+        await send_ws_message(websocket, {"type": "error", "message": "Sessão aberta em outro servidor, tentando novamente"})
+        await websocket.close(code=1013)
+        return
+    except Exception as e:
+        await send_ws_message(websocket, {"type": "error", "message": str(e) if isinstance(e, ValueError) else "Erro ao abrir o arquivo"})
+        await websocket.close()
+        return
+    await live_editor_manager.connect(websocket, team_id, file_id, username)
+    live_editor_manager.send(websocket, {
+        "type": "session_ticket",
+        "ticket": create_live_edit_ticket(username, team_id, file_id),
+        "expires_in": LIVE_EDIT_TICKET_TTL_SECONDS
+    })
     
     try:
-        await websocket.accept()
-        data = await websocket.receive_text()
-        join_data = json.loads(data)
-        
-        if join_data.get("type") != "join":
-            await websocket.close()
-            return
-        
-        username = join_data.get("username")
-        if not username:
-            await websocket.close()
-            return
-        
-        # Buscar informações do arquivo e time
-        file_metadata = await db.files.find_one({"id": file_id}, {"_id": 0})
-        if not file_metadata:
-            await websocket.close()
-            return
-        
-        team_id = file_metadata.get("team_id")
-        if not team_id:
-            await websocket.close()
-            return
-        
-        # Verificar permissões
-        user = await db.users.find_one({"username": username}, {"_id": 0})
-        team = await db.teams.find_one({"id": team_id}, {"_id": 0})
-        
-        if not user or not team or username not in team.get("members", []):
-            await websocket.close()
-            return
-        
-        # Conectar à sessão
-        await live_editor_manager.connect(websocket, team_id, file_id, username)
-        
-        # Loop de mensagens
         while True:
-            data = await websocket.receive_text()
-            message = json.loads(data)
+            message = await receive_ws_message(websocket)
             message_type = message.get("type")
             
-            timestamp = datetime.now(timezone.utc).isoformat()
+            if message_type == "op":
+                try:
+                    op = parse_text_op(message.get("op"))
+                    base_rev = int(message.get("rev"))
+                except (TypeError, ValueError):
+                    continue
+                await live_editor_manager.apply_operation(team_id, file_id, username, websocket, base_rev, op)
             
-            if message_type == "content_update":
-                await live_editor_manager.broadcast_to_session(team_id, file_id, {
-                    "type": "content_update",
-                    "username": username,
-                    "content": message.get("content", ""),
-                    "timestamp": timestamp
-                }, exclude_username=username)
+            elif message_type == "content_update":
+                # Protocolo antigo (documento inteiro): vira uma substituição total na revisão atual
+                document = live_editor_manager.documents.get((team_id, file_id))
+                if document is not None:
+                    op = [0, len(document.content), str(message.get("content", ""))]
+                    await live_editor_manager.apply_operation(team_id, file_id, username, websocket, document.rev, op)
+            
+            elif message_type == "resync":
+                document = live_editor_manager.documents.get((team_id, file_id))
+                if document is not None:
+                    live_editor_manager.send(websocket, document.snapshot())
             
             elif message_type == "cursor_position":
-                await live_editor_manager.broadcast_to_session(team_id, file_id, {
-                    "type": "cursor_position",
-                    "username": username,
-                    "position": message.get("position", 0),
-                    "timestamp": timestamp
-                }, exclude_username=username)
+                # Não vai direto para a sessão: entra no próximo cursor_batch (ver PresenceAggregator)
+                try:
+                    position = int(message.get("position", 0))
+                    selection_end = int(message.get("selection_end", position))
+                except (TypeError, ValueError):
+                    continue
+                live_editor_manager.presence.update(team_id, file_id, username, {
+                    "position": position, "selection_end": selection_end
+                })
             
             elif message_type == "file_saved":
+                # Salvar explícito: grava já, sem esperar o debounce
+                if not await live_editor_manager.save((team_id, file_id)):
+                    live_editor_manager.send(websocket, {"type": "error", "message": "Erro ao salvar o arquivo"})
+                    continue
+                document = live_editor_manager.documents.get((team_id, file_id))
                 await live_editor_manager.broadcast_to_session(team_id, file_id, {
                     "type": "file_saved",
                     "username": username,
-                    "timestamp": timestamp
-                }, exclude_username=username)
-    
-    except WebSocketDisconnect:
-        if username and team_id:
-            live_editor_manager.disconnect(team_id, file_id, username)
-            try:
-                await live_editor_manager.broadcast_to_session(team_id, file_id, {
-                    "type": "user_left",
-                    "username": username,
+                    "rev": document.saved_rev if document else None,
                     "timestamp": datetime.now(timezone.utc).isoformat()
                 })
-            except:
-                pass
+    
+    except WebSocketDisconnect:
+        pass
     except Exception as e:
         logger.error(f"WebSocket error: {e}")
-        if username and team_id:
-            live_editor_manager.disconnect(team_id, file_id, username)
+    finally:
+        live_editor_manager.disconnect(team_id, file_id, username, websocket)
+        try:
+            await live_editor_manager.broadcast_to_session(team_id, file_id, {
+                "type": "user_left",
+                "username": username,
+                "timestamp": datetime.now(timezone.utc).isoformat()
+            })
+        except Exception:
+            pass
+        # Em tarefa própria: a gravação final não pode depender do handler do socket que já fechou
+        start_background_task(live_editor_manager.close_session_if_idle(team_id, file_id))
+
+# ===================================================================
+# WEBSOCKET ENDPOINTS - Live Editing
+# ===================================================================
+
+@app.websocket("/api/ws/live-edit/{file_id}")
+async def websocket_live_edit_simple(websocket: WebSocket, file_id: str):
+    """
+    Endpoint simplificado para Live Editing (sem team_id na URL)
+    Extrai team_id do arquivo automaticamente
+    """
+    await accept_websocket(websocket)
+    try:
+        join_data = await receive_ws_message(websocket)
+    except (WebSocketDisconnect, ValueError):
+        return
+    
+    if join_data.get("type") != "join":
+        await websocket.close()
+        return
+    
+    # team_id vem do próprio arquivo
+    authorized = await authorize_live_edit(websocket, join_data, file_id)
+    if not authorized:
+        await websocket.close(code=1008)
+        return
+    username, team_id, file_metadata = authorized
+    
+    await run_live_edit_session(websocket, file_metadata, team_id, username)
 
 @app.websocket("/api/ws/live/{team_id}/{file_id}")
 async def websocket_live_editing(websocket: WebSocket, team_id: str, file_id: str):
-    username = None
+    await accept_websocket(websocket)
     try:
-        await websocket.accept()
-        data = await websocket.receive_text()
-        join_data = json.loads(data)
-        
-        if join_data.get("type") != "join":
-            await websocket.close()
-            return
-        
-        username = join_data.get("username")
-        if not username:
-            await websocket.close()
-            return
-        
-        user = await db.users.find_one({"username": username}, {"_id": 0})
-        team = await db.teams.find_one({"id": team_id}, {"_id": 0})
-        file_metadata = await db.files.find_one({"id": file_id}, {"_id": 0})
-        
-        if not user or not team or username not in team.get("members", []) or not file_metadata or file_metadata.get("team_id") != team_id:
-            await websocket.close()
-            return
-        
-        await live_editor_manager.connect(websocket, team_id, file_id, username)
-        
-        while True:
-            data = await websocket.receive_text()
-            message = json.loads(data)
-            message_type = message.get("type")
-            
-            if message_type == "content_update":
-                await live_editor_manager.broadcast_to_session(team_id, file_id, {
-                    "type": "content_update", "username": username,
-                    "content": message.get("content", ""),
-                    "timestamp": datetime.now(timezone.utc).isoformat()
-                }, exclude_username=username)
-            
-            elif message_type == "cursor_position":
-                await live_editor_manager.broadcast_to_session(team_id, file_id, {
-                    "type": "cursor_position", "username": username,
-                    "position": message.get("position", 0),
-                    "timestamp": datetime.now(timezone.utc).isoformat()
-                }, exclude_username=username)
-            
-            elif message_type == "file_saved":
-                await live_editor_manager.broadcast_to_session(team_id, file_id, {
-                    "type": "file_saved", "username": username,
-                    "timestamp": datetime.now(timezone.utc).isoformat()
-                }, exclude_username=username)
+        join_data = await receive_ws_message(websocket)
+    except (WebSocketDisconnect, ValueError):
+        return
     
-    except WebSocketDisconnect:
-        if username:
-            live_editor_manager.disconnect(team_id, file_id, username)
-            try:
-                await live_editor_manager.broadcast_to_session(team_id, file_id, {
-                    "type": "user_left", "username": username,
-                    "timestamp": datetime.now(timezone.utc).isoformat()
-                })
-            except:
-                pass
-    except:
-        if username:
-            live_editor_manager.disconnect(team_id, file_id, username)
+    if join_data.get("type") != "join":
+        await websocket.close()
+        return
+    
+    authorized = await authorize_live_edit(websocket, join_data, file_id, team_id)
+    if not authorized:
+        await websocket.close(code=1008)
+        return
+    username, team_id, file_metadata = authorized
+    
+    await run_live_edit_session(websocket, file_metadata, team_id, username)
 
 @api_router.get("/teams/{team_id}/live-sessions")
 async def get_team_live_sessions(team_id: str, current_user: User = Depends(get_current_user)):
@@ -1139,15 +4110,16 @@ async def get_team_live_sessions(team_id: str, current_user: User = Depends(get_
     if not team or current_user.username not in team.get("members", []):
         raise HTTPException(status_code=403)
     
+    # Uma única consulta para todos os arquivos com sessão ativa
+    active = dict(live_editor_manager.active_connections.get(team_id, {}))
+    files = await FileAccess(current_user).readable_files(list(active), {"id": 1, "original_name": 1})
     sessions = []
-    if team_id in live_editor_manager.active_connections:
-        for file_id, users in live_editor_manager.active_connections[team_id].items():
-            file_metadata = await db.files.find_one({"id": file_id}, {"_id": 0})
-            if file_metadata:
-                sessions.append({
-                    "file_id": file_id, "file_name": file_metadata.get("original_name"),
-                    "active_users": list(users.keys()), "user_count": len(users)
-                })
+    for file_id, users in active.items():
+        if file_id in files:
+            sessions.append({
+                "file_id": file_id, "file_name": files[file_id].get("original_name"),
+                "active_users": list(users.keys()), "user_count": len(users)
+            })
     return {"team_id": team_id, "team_name": team.get("name"), "active_sessions": sessions}
 
 # Team Invites
@@ -1173,22 +4145,6 @@ async def invite_to_team(team_id: str, data: TeamAddMember, current_user: User =
     await db.team_invites.insert_one(invite_doc)
     return {"message": f"Invite sent to {data.username}"}
 
-@api_router.get("/teams/invites")
-async def get_my_invites(current_user: User = Depends(get_current_user)):
-    """Lista convites pendentes do usuário logado"""
-    invites = await db.team_invites.find(
-        {"invitee_username": current_user.username, "status": "pending"}, 
-        {"_id": 0}
-    ).to_list(100)
-    
-    # Serializar datas para ISO format
-    for invite in invites:
-        if 'created_at' in invite:
-            if isinstance(invite['created_at'], datetime):
-                invite['created_at'] = invite['created_at'].isoformat()
-    
-    return invites
-
 @api_router.post("/teams/invites/{invite_id}/respond")
 async def respond_to_invite(invite_id: str, data: dict, current_user: User = Depends(get_current_user)):
     invite = await db.team_invites.find_one({"id": invite_id}, {"_id": 0})
@@ -1197,6 +4153,7 @@ async def respond_to_invite(invite_id: str, data: dict, current_user: User = Dep
     
     if data.get("action") == "accept":
         await db.teams.update_one({"id": invite["team_id"]}, {"$push": {"members": current_user.username}})
+        team_membership_cache.invalidate(current_user.username)
         await db.team_invites.update_one({"id": invite_id}, {"$set": {"status": "accepted"}})
         return {"message": "Invite accepted"}
     else:
@@ -1215,6 +4172,17 @@ async def respond_to_invite(invite_id: str, data: dict, current_user: User = Dep
 #     allow_headers=["*"],
 # )
 
+# Registrado depois de todas as rotas de api_router (include_router copia as rotas existentes)
+app.include_router(api_router)
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    for task in list(background_tasks):
+        task.cancel()
+    await chat_writer.flush()
+    await live_editor_manager.flush_all()
+    stop_rendition_pool()
+    await pubsub.close()
+    for backend in set(storage_backends.values()):
+        await backend.close()
     client.close()
@@ -0,0 +1,12 @@
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+# server.py lê a configuração do ambiente na importação; o cliente Motor só conecta no primeiro uso
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "biblioteca_test")
+os.environ.setdefault("UPLOAD_DIR", tempfile.mkdtemp(prefix="biblioteca-uploads-"))
+os.environ.setdefault("STORAGE_MODE", "local")
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
@@ -0,0 +1,72 @@
+import random
+
+import pytest
+
+from server import LiveDocument, apply_text_op, transform_text_op
+
+
+def random_op(rng: random.Random, text: str) -> list:
+    pos = rng.randint(0, len(text))
+    delete = rng.randint(0, min(3, len(text) - pos))
+    insert = "".join(rng.choice("xyz") for _ in range(rng.randint(0, 3)))
+    return [pos, delete, insert]
+
+
+def test_transform_converges_tp1():
+    rng = random.Random(1234)
+    for _ in range(2000):
+        text = "".join(rng.choice("abcdef") for _ in range(rng.randint(0, 12)))
+        a, b = random_op(rng, text), random_op(rng, text)
+        left = apply_text_op(apply_text_op(text, a), transform_text_op(b, a, op_first=False))
+        right = apply_text_op(apply_text_op(text, b), transform_text_op(a, b, op_first=True))
+        assert left == right, (text, a, b)
+
+
+def test_transform_tie_break_on_same_insert_point():
+    assert transform_text_op([2, 0, "A"], [2, 0, "B"], op_first=True) == [2, 0, "A"]
+    assert transform_text_op([2, 0, "B"], [2, 0, "A"], op_first=False) == [3, 0, "B"]
+
+
+def test_apply_text_op_rejects_out_of_range():
+    with pytest.raises(ValueError):
+        apply_text_op("abc", [2, 2, ""])
+    with pytest.raises(ValueError):
+        apply_text_op("abc", [-1, 0, "x"])
+
+
+def test_apply_client_op_transforms_stale_base_rev():
+    doc = LiveDocument("hello world")
+    # Dois clientes na revisão 0: o primeiro insere no início, o segundo apaga "world"
+    assert doc.apply_client_op(0, [0, 0, ">> "]) == [0, 0, ">> "]
+    transformed = doc.apply_client_op(0, [6, 5, "there"])
+    assert transformed == [9, 5, "there"]
+    assert doc.content == ">> hello there"
+    assert doc.rev == 2
+    assert list(doc.history) == [[0, 0, ">> "], [9, 5, "there"]]
+
+
+def test_apply_client_op_at_current_rev_is_not_transformed():
+    doc = LiveDocument("abc", rev=5)
+    assert doc.apply_client_op(5, [3, 0, "d"]) == [3, 0, "d"]
+    assert doc.content == "abcd"
+    assert doc.rev == 6
+    assert doc.dirty
+
+
+def test_apply_client_op_rejects_base_rev_ahead_of_server():
+    doc = LiveDocument("abc")
+    with pytest.raises(ValueError):
+        doc.apply_client_op(1, [0, 0, "x"])
+    assert doc.content == "abc" and doc.rev == 0
+
+
+def test_apply_client_op_requires_resync_once_history_is_trimmed():
+    doc = LiveDocument("", history_size=3)
+    for i in range(5):
+        doc.apply_client_op(i, [i, 0, str(i)])
+    assert doc.content == "01234"
+    # Só as revisões 2..5 ainda podem ser transformadas
+    with pytest.raises(ValueError):
+        doc.apply_client_op(1, [0, 0, "x"])
+    assert doc.apply_client_op(2, [0, 0, "x"]) == [0, 0, "x"]
+    assert doc.content == "x01234"
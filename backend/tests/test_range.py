@@ -0,0 +1,43 @@
+import pytest
+from fastapi import HTTPException
+
+from server import parse_range_header
+
+
+def test_closed_range():
+    assert parse_range_header("bytes=0-99", 1000) == (0, 99)
+
+
+def test_end_is_clamped_to_file_size():
+    assert parse_range_header("bytes=900-5000", 1000) == (900, 999)
+
+
+def test_open_ended_range():
+    assert parse_range_header("bytes=500-", 1000) == (500, 999)
+
+
+def test_suffix_range():
+    assert parse_range_header("bytes=-200", 1000) == (800, 999)
+
+
+def test_suffix_larger_than_file_is_whole_file():
+    assert parse_range_header("bytes=-5000", 1000) == (0, 999)
+
+
+@pytest.mark.parametrize("header", ["bytes=1000-", "bytes=1500-1600", "bytes=-0", "bytes=10-5"])
+def test_unsatisfiable_range_raises_416(header):
+    with pytest.raises(HTTPException) as excinfo:
+        parse_range_header(header, 1000)
+    assert excinfo.value.status_code == 416
+    assert excinfo.value.headers["Content-Range"] == "bytes */1000"
+
+
+@pytest.mark.parametrize("header", ["bytes=0-10,20-30", "bytes=-5, 0-1"])
+def test_multi_range_is_ignored(header):
+    # Sem multipart/byteranges: a resposta volta a ser o arquivo inteiro (200)
+    assert parse_range_header(header, 1000) is None
+
+
+@pytest.mark.parametrize("header", ["items=0-10", "bytes=a-b", "bytes=-"])
+def test_malformed_range_is_ignored(header):
+    assert parse_range_header(header, 1000) is None
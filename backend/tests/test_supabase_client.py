@@ -0,0 +1,195 @@
+import asyncio
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from server import (LocalStorageBackend, StorageBackend, StorageError, StorageNotFound,
+                    SupabaseStorageBackend, SupabaseStorageClient, TieredStorageBackend)
+
+BUCKET = "uploads"
+PREFIX = f"/storage/v1/object/{BUCKET}/"
+
+
+class StandInStorage(BaseHTTPRequestHandler):
+    """Imita o endpoint de objetos do Supabase Storage (HTTP/1.1 com keep-alive)"""
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def _key(self):
+        self.server.connections.add(self.client_address)
+        self.server.auth_headers.add(self.headers.get("Authorization"))
+        return self.path[len(PREFIX):] if self.path.startswith(PREFIX) else None
+
+    def _send(self, status, body=b"", headers=None, with_body=True):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if with_body:
+            self.wfile.write(body)
+
+    def _read_body(self):
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            self.server.chunked_uploads += 1
+            body = b""
+            while True:
+                size = int(self.rfile.readline().strip(), 16)
+                if size == 0:
+                    self.rfile.readline()
+                    return body
+                body += self.rfile.read(size)
+                self.rfile.readline()
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def do_POST(self):
+        key = self._key()
+        self.server.objects[key] = self._read_body()
+        self._send(200, b"{}", {"Content-Type": "application/json"})
+
+    def do_GET(self, with_body=True):
+        key = self._key()
+        if key == "broken":
+            return self._send(500, b"boom", with_body=with_body)
+        if key not in self.server.objects:
+            return self._send(404, b"not found", with_body=with_body)
+        data = self.server.objects[key]
+        range_header = self.headers.get("Range")
+        if range_header:
+            start, _, end = range_header.split("=")[1].partition("-")
+            start, end = int(start), int(end) if end else len(data) - 1
+            return self._send(206, data[start:end + 1],
+                              {"Content-Range": f"bytes {start}-{end}/{len(data)}"}, with_body)
+        self._send(200, data, with_body=with_body)
+
+    def do_HEAD(self):
+        self.do_GET(with_body=False)
+
+    def do_DELETE(self):
+        self.server.objects.pop(self._key(), None)
+        self._send(200, b"{}")
+
+
+@pytest.fixture
+def stand_in():
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), StandInStorage)
+    httpd.objects = {}
+    httpd.connections = set()
+    httpd.auth_headers = set()
+    httpd.chunked_uploads = 0
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def make_client(httpd) -> SupabaseStorageClient:
+    host, port = httpd.server_address
+    return SupabaseStorageClient(f"http://{host}:{port}", "service-key", BUCKET, max_connections=2)
+
+
+def test_round_trip_reuses_pooled_connection(stand_in):
+    async def scenario():
+        storage = make_client(stand_in)
+        await storage.start()
+        try:
+            for i in range(5):
+                await storage.upload(f"conteúdo {i}".encode(), f"alice/{i}.txt")
+            assert await storage.exists("alice/3.txt")
+            assert await storage.download("alice/3.txt") == "conteúdo 3".encode()
+            await storage.delete("alice/3.txt")
+            assert not await storage.exists("alice/3.txt")
+        finally:
+            await storage.close()
+        assert storage.client is None
+
+    asyncio.run(scenario())
+    # Requisições sequenciais num cliente de longa duração usam uma só conexão keep-alive
+    assert len(stand_in.connections) == 1
+    assert stand_in.auth_headers == {"Bearer service-key"}
+
+
+def test_streaming_upload_and_ranged_download(stand_in):
+    payload = bytes(range(256)) * 64
+
+    async def chunks():
+        for start in range(0, len(payload), 1000):
+            yield payload[start:start + 1000]
+
+    async def scenario():
+        storage = make_client(stand_in)
+        try:
+            await storage.upload(chunks(), "blobs/abc")
+            response = await storage.open_download("blobs/abc", {"Range": "bytes=100-199"})
+            try:
+                assert response.status_code == 206
+                body = b"".join([chunk async for chunk in response.aiter_bytes()])
+            finally:
+                await response.aclose()
+            return body
+        finally:
+            await storage.close()
+
+    assert asyncio.run(scenario()) == payload[100:200]
+    assert stand_in.objects["blobs/abc"] == payload
+    assert stand_in.chunked_uploads == 1
+
+
+def test_missing_object_raises_storage_not_found(stand_in):
+    async def scenario():
+        storage = make_client(stand_in)
+        try:
+            with pytest.raises(StorageNotFound):
+                await storage.download("nope")
+            with pytest.raises(StorageNotFound):
+                await storage.open_download("nope")
+        finally:
+            await storage.close()
+
+    asyncio.run(scenario())
+
+
+def test_server_error_raises_storage_error(stand_in):
+    async def scenario():
+        storage = make_client(stand_in)
+        try:
+            for call in (storage.download, storage.open_download):
+                with pytest.raises(StorageError, match="Download failed: 500") as excinfo:
+                    await call("broken")
+                assert not isinstance(excinfo.value, StorageNotFound)
+        finally:
+            await storage.close()
+
+    asyncio.run(scenario())
+
+
+def test_backends_report_remote_miss_as_storage_not_found(stand_in, tmp_path):
+    async def scenario():
+        remote = SupabaseStorageBackend(make_client(stand_in))
+        tiered = TieredStorageBackend(remote, tmp_path / "cache", max_bytes=1024 * 1024)
+        await tiered.start()
+        try:
+            with pytest.raises(StorageNotFound):
+                await remote.read("alice/missing.txt")
+            with pytest.raises(StorageNotFound):
+                await remote.open_stream("alice/missing.txt")
+            with pytest.raises(StorageNotFound):
+                await tiered.read("alice/missing.txt")
+        finally:
+            await tiered.close()
+
+    asyncio.run(scenario())
+
+
+def test_incomplete_backend_fails_at_construction(tmp_path):
+    class WriteOnlyBackend(StorageBackend):
+        async def write_stream(self, key, chunks):
+            pass
+
+    with pytest.raises(TypeError):
+        WriteOnlyBackend()
+    LocalStorageBackend(tmp_path)
@@ -15,6 +15,8 @@ const ChatPanel = ({ user, chatEnabled, onChatToggle }) => {
   const [newMessage, setNewMessage] = useState("");
   const [ws, setWs] = useState(null);
   const [connected, setConnected] = useState(false);
+  const [olderCursor, setOlderCursor] = useState(null);
+  const [loadingOlder, setLoadingOlder] = useState(false);
   const scrollRef = useRef(null);
   const messagesEndRef = useRef(null);
   const isAdmin = user?.role === "admin";
@@ -32,9 +34,11 @@ const ChatPanel = ({ user, chatEnabled, onChatToggle }) => {
     };
   }, [chatEnabled]);
 
+  const lastMessageId = messages.length ? messages[messages.length - 1].id : null;
+
   useEffect(() => {
     scrollToBottom();
-  }, [messages]);
+  }, [lastMessageId]);
 
   const scrollToBottom = () => {
     messagesEndRef.current?.scrollIntoView({ behavior: "smooth" });
@@ -44,6 +48,7 @@ const ChatPanel = ({ user, chatEnabled, onChatToggle }) => {
     try {
       const response = await axios.get(`${API}/chat/messages`);
       setMessages(response.data);
+      setOlderCursor(response.headers["x-next-cursor"] || null);
     } catch (error) {
       if (error.response?.status !== 403) {
         toast.error("Erro ao carregar mensagens");
@@ -51,9 +56,24 @@ const ChatPanel = ({ user, chatEnabled, onChatToggle }) => {
     }
   };
 
+  const loadOlderMessages = async () => {
+    if (!olderCursor) return;
+    setLoadingOlder(true);
+    try {
+      const response = await axios.get(`${API}/chat/messages`, { params: { before: olderCursor } });
+      setMessages((prev) => [...response.data, ...prev]);
+      setOlderCursor(response.headers["x-next-cursor"] || null);
+    } catch (error) {
+      toast.error("Erro ao carregar mensagens anteriores");
+    } finally {
+      setLoadingOlder(false);
+    }
+  };
+
   const connectWebSocket = () => {
     const wsUrl = API.replace("https://", "wss://").replace("http://", "ws://");
-    const websocket = new WebSocket(`${wsUrl}/ws/chat`);
+    const token = localStorage.getItem("token");
+    const websocket = new WebSocket(`${wsUrl}/ws/chat?token=${token}`);
 
     websocket.onopen = () => {
       setConnected(true);
@@ -187,13 +207,26 @@ const ChatPanel = ({ user, chatEnabled, onChatToggle }) => {
             </div>
           ) : (
             <div className="space-y-4">
+              {olderCursor && (
+                <div className="flex justify-center">
+                  <Button
+                    size="sm"
+                    variant="ghost"
+                    onClick={loadOlderMessages}
+                    disabled={loadingOlder}
+                    data-testid="load-older-messages"
+                  >
+                    {loadingOlder ? "Carregando..." : "Carregar mensagens anteriores"}
+                  </Button>
+                </div>
+              )}
               {messages.map((msg, index) => {
                 const isOwnMessage = msg.username === user.username;
                 const isAdminMessage = msg.role === "admin";
                 
                 return (
                   <div
-                    key={index}
+                    key={msg.id || index}
                     className={`flex ${isOwnMessage ? "justify-end" : "justify-start"} animate-fade-in group`}
                     data-testid={`chat-message-${index}`}
                   >
@@ -1,4 +1,4 @@
-import { useState, useRef } from "react";
+import { useState, useRef, useEffect } from "react";
 import { Button } from "@/components/ui/button";
 import { Card, CardContent } from "@/components/ui/card";
 import { Input } from "@/components/ui/input";
@@ -11,7 +11,7 @@ import { toast } from "sonner";
 import axios from "axios";
 import FilePreview from "@/components/FilePreview";
 
-const FileLibrary = ({ files, loading, uploading, onUpload, onDelete, isAdmin, teams = [], theme }) => {
+const FileLibrary = ({ files, loading, uploading, onUpload, onDelete, onLoadMore, onSearch, isAdmin, teams = [], theme }) => {
   const [searchQuery, setSearchQuery] = useState("");
   const [uploadFiles, setUploadFiles] = useState([]);
   const [showPasswordModal, setShowPasswordModal] = useState(false);
@@ -22,10 +22,18 @@ const FileLibrary = ({ files, loading, uploading, onUpload, onDelete, isAdmin, t
   const [filePassword, setFilePassword] = useState("");
   const [verifying, setVerifying] = useState(false);
   const fileInputRef = useRef(null);
+  const lastSearch = useRef("");
 
-  const filteredFiles = files.filter((file) =>
-    file.original_name.toLowerCase().includes(searchQuery.toLowerCase())
-  );
+  // A busca vai para o servidor (parâmetro search) com debounce; a lista recebida já vem filtrada
+  useEffect(() => {
+    const timer = setTimeout(() => {
+      const query = searchQuery.trim();
+      if (query === lastSearch.current) return;
+      lastSearch.current = query;
+      onSearch(query);
+    }, 300);
+    return () => clearTimeout(timer);
+  }, [searchQuery]);
 
   const handleFileSelect = (e) => {
     const selectedFiles = Array.from(e.target.files);
@@ -275,7 +283,7 @@ const FileLibrary = ({ files, loading, uploading, onUpload, onDelete, isAdmin, t
           />
         </div>
         <div className="text-sm text-gray-600" data-testid="file-count">
-          {filteredFiles.length} arquivo(s)
+          {files.length} arquivo(s)
         </div>
       </div>
 
@@ -284,7 +292,7 @@ const FileLibrary = ({ files, loading, uploading, onUpload, onDelete, isAdmin, t
         <div className="flex justify-center py-12" data-testid="loading-spinner">
           <div className="animate-spin rounded-full h-12 w-12 border-b-2 border-purple-600"></div>
         </div>
-      ) : filteredFiles.length === 0 ? (
+      ) : files.length === 0 ? (
         <Card className="glass border-0 shadow-lg">
           <CardContent className="p-12 text-center">
             <File className="w-16 h-16 mx-auto mb-4 text-gray-300" />
@@ -295,7 +303,7 @@ const FileLibrary = ({ files, loading, uploading, onUpload, onDelete, isAdmin, t
         </Card>
       ) : (
         <div className="grid grid-cols-1 md:grid-cols-2 lg:grid-cols-3 xl:grid-cols-4 gap-4" data-testid="files-grid">
-          {filteredFiles.map((file) => (
+          {files.map((file) => (
             <Card key={file.id} className="glass border-0 shadow-lg hover:shadow-xl transition-shadow" data-testid={`file-card-${file.id}`}>
               <CardContent className="p-4">
                 <div className="flex flex-col items-center text-center mb-4">
@@ -352,6 +360,14 @@ const FileLibrary = ({ files, loading, uploading, onUpload, onDelete, isAdmin, t
         </div>
       )}
 
+      {onLoadMore && !loading && (
+        <div className="flex justify-center">
+          <Button variant="outline" onClick={onLoadMore} data-testid="load-more-files">
+            Carregar mais arquivos
+          </Button>
+        </div>
+      )}
+
       {/* File Preview Modal */}
       <FilePreview
         file={previewFile}
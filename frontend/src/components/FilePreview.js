@@ -69,16 +69,21 @@ const FilePreview = ({ file, open, onClose }) => {
       return (
         <div className="bg-gray-50 p-6 rounded-lg max-h-96 overflow-y-auto">
           <pre className="text-sm text-gray-800 whitespace-pre-wrap font-mono">{preview.content}</pre>
+          {preview.truncated && (
+            <p className="text-xs text-gray-500 mt-4">Preview parcial — baixe o arquivo para ver o conteúdo completo.</p>
+          )}
         </div>
       );
     }
 
-    // Image preview
-    if (preview.type === "base64" && preview.mime_type?.startsWith("image/")) {
+    const token = localStorage.getItem("token");
+
+    // Image preview (thumbnail gerado no servidor)
+    if (preview.type === "image") {
       return (
         <div className="flex justify-center bg-gray-50 p-4 rounded-lg">
           <img
-            src={`data:${preview.mime_type};base64,${preview.content}`}
+            src={`${API}${preview.url}?token=${token}`}
             alt={file.original_name}
             className="max-w-full max-h-96 object-contain rounded"
           />
@@ -88,9 +93,16 @@ const FilePreview = ({ file, open, onClose }) => {
 
     // PDF/Video stream
     if (preview.type === "stream") {
-      const token = localStorage.getItem("token");
       const streamUrl = `${API}/files/${file.id}/stream?token=${token}`;
 
+      if (file.file_type?.startsWith("image/")) {
+        return (
+          <div className="flex justify-center bg-gray-50 p-4 rounded-lg">
+            <img src={streamUrl} alt={file.original_name} className="max-w-full max-h-96 object-contain rounded" />
+          </div>
+        );
+      }
+
       if (file.file_type?.includes("pdf")) {
         return (
           <iframe
@@ -12,6 +12,7 @@ import {
 import { toast } from 'sonner';
 import axios from 'axios';
 import { API } from '@/App';
+import { applyOp, transformOp, diffOp, transformOffset } from '@/utils/textOps';
 
 // Função para gerar cores únicas para cada usuário
 const getUserColor = (username) => {
@@ -40,7 +41,15 @@ const LiveEditor = ({ file, team, user, onClose }) => {
   const wsRef = useRef(null);
   const textareaRef = useRef(null);
   const reconnectTimeoutRef = useRef(null);
-  const saveTimeoutRef = useRef(null);
+  const ticketRef = useRef(null); // ticket da sessão: reconexões pulam a autorização completa
+
+  // Estado do protocolo de operações (OT): o servidor mantém o documento autoritativo
+  const revRef = useRef(0);
+  const serverTextRef = useRef(null); // texto confirmado pelo servidor na revisão revRef
+  const baseRef = useRef('');         // texto confirmado + operação em trânsito
+  const outstandingRef = useRef(null); // operação enviada aguardando ack
+  const lastCursorRef = useRef(null);
+  const contentRef = useRef('');      // texto local (textarea)
 
   // Carregar conteúdo do arquivo
   useEffect(() => {
@@ -52,36 +61,115 @@ const LiveEditor = ({ file, team, user, onClose }) => {
     connectWebSocket();
     
     return () => {
-      if (wsRef.current) {
-        wsRef.current.close();
-      }
       if (reconnectTimeoutRef.current) {
         clearTimeout(reconnectTimeoutRef.current);
       }
-      if (saveTimeoutRef.current) {
-        clearTimeout(saveTimeoutRef.current);
+      if (wsRef.current) {
+        // Fechamento intencional: sem o onclose não há reconexão depois de desmontar
+        wsRef.current.onclose = null;
+        wsRef.current.close();
       }
+      ticketRef.current = null;
     };
   }, [file.id, team.id, user.username]);
 
-  const loadFileContent = async () => {
-    try {
-      const response = await axios.get(`${API}/files/${file.id}/preview`);
-      
-      if (response.data.type === 'text') {
-        setContent(response.data.content);
-        setOriginalContent(response.data.content);
-      } else if (response.data.type === 'base64') {
-        // Para arquivos não-texto, mostrar preview
-        setContent(`[Arquivo binário - ${file.file_type}]\nTamanho: ${(file.file_size / 1024).toFixed(2)} KB\n\nEdição de arquivos binários não suportada no modo Live.`);
-        setOriginalContent(content);
-      }
-    } catch (error) {
-      console.error('Erro ao carregar arquivo:', error);
-      toast.error('Erro ao carregar conteúdo do arquivo');
+  // O conteúdo chega pelo WebSocket (mensagem "doc"); aqui só o aviso para binários
+  const loadFileContent = () => {
+    if (file.file_type && !file.file_type.startsWith('text/')) {
+      setContent(`[Arquivo binário - ${file.file_type}]\nTamanho: ${(file.file_size / 1024).toFixed(2)} KB\n\nEdição de arquivos binários não suportada no modo Live.`);
+    }
+  };
+
+  const sendMessage = (message) => {
+    if (wsRef.current && wsRef.current.readyState === WebSocket.OPEN) {
+      wsRef.current.send(JSON.stringify(message));
+      return true;
+    }
+    return false;
+  };
+
+  // Envia as alterações locais como uma operação, uma de cada vez (a próxima sai no ack)
+  const flushLocalChanges = () => {
+    if (outstandingRef.current) return;
+    const op = diffOp(baseRef.current, contentRef.current);
+    if (!op) return;
+    if (sendMessage({ type: 'op', rev: revRef.current, op })) {
+      outstandingRef.current = op;
+      baseRef.current = contentRef.current;
+    }
+  };
+
+  const setLocalContent = (text) => {
+    contentRef.current = text;
+    setContent(text);
+  };
+
+  const handleDocument = (data) => {
+    const previousServerText = serverTextRef.current;
+    const pending = previousServerText !== null ? diffOp(previousServerText, contentRef.current) : null;
+    const canRebase = pending && data.content === previousServerText;
+
+    revRef.current = data.rev;
+    serverTextRef.current = data.content;
+    baseRef.current = data.content;
+    outstandingRef.current = null;
+
+    if (canRebase) {
+      // Reconexão sem mudanças no servidor: reenvia as alterações locais
+      flushLocalChanges();
+      return;
+    }
+    if (pending && data.content !== contentRef.current) {
+      toast.warning('O documento mudou no servidor; alterações locais não enviadas foram descartadas');
+    }
+    setLocalContent(data.content);
+    setOriginalContent(data.content);
+  };
+
+  const handleRemoteOperation = (data) => {
+    let remote = data.op;
+    serverTextRef.current = applyOp(serverTextRef.current, remote);
+    if (outstandingRef.current) {
+      const outstanding = outstandingRef.current;
+      outstandingRef.current = transformOp(outstanding, remote, false);
+      remote = transformOp(remote, outstanding, true);
+    }
+    // Alterações locais ainda não enviadas (buffer) relativas a baseRef
+    const buffer = diffOp(baseRef.current, contentRef.current);
+    baseRef.current = applyOp(baseRef.current, remote);
+    const local = buffer ? transformOp(remote, buffer, true) : remote;
+
+    const textarea = textareaRef.current;
+    const before = contentRef.current;
+    const selection = textarea ? [textarea.selectionStart, textarea.selectionEnd] : null;
+    setLocalContent(applyOp(before, local));
+    revRef.current = data.rev;
+
+    if (textarea && selection && document.activeElement === textarea) {
+      const [start, end] = selection.map(offset => transformOffset(before, offset, local));
+      requestAnimationFrame(() => textarea.setSelectionRange(start, end));
+    }
+  };
+
+  // O servidor grava snapshots sozinho (debounce); `rev` é a revisão que foi gravada
+  const markSaved = (rev) => {
+    setLastSaved(new Date());
+    const synced = rev === revRef.current && !outstandingRef.current && baseRef.current === contentRef.current;
+    if (synced) {
+      setOriginalContent(contentRef.current);
+      setUnsavedChanges(false);
     }
   };
 
+  const handleAck = (data) => {
+    if (outstandingRef.current) {
+      serverTextRef.current = applyOp(serverTextRef.current, outstandingRef.current);
+    }
+    revRef.current = data.rev;
+    outstandingRef.current = null;
+    flushLocalChanges();
+  };
+
   const connectWebSocket = () => {
     const wsProtocol = window.location.protocol === 'https:' ? 'wss:' : 'ws:';
     const wsHost = API.replace('http://', '').replace('https://', '');
@@ -95,12 +183,11 @@ const LiveEditor = ({ file, team, user, onClose }) => {
         console.log('WebSocket conectado');
         setConnected(true);
         
-        // Enviar mensagem de entrada
+        // Entrada: o ticket (se ainda válido) evita as consultas; o token é o fallback
         wsRef.current.send(JSON.stringify({
           type: 'join',
-          username: user.username,
-          team_id: team.id,
-          file_id: file.id
+          ticket: ticketRef.current,
+          token: localStorage.getItem('token')
         }));
         
         toast.success('Conectado à sessão Live!');
@@ -121,10 +208,17 @@ const LiveEditor = ({ file, team, user, onClose }) => {
         toast.error('Erro na conexão Live');
       };
 
-      wsRef.current.onclose = () => {
+      wsRef.current.onclose = (event) => {
         console.log('WebSocket desconectado');
         setConnected(false);
         
+        // 1008: acesso negado; reconectar não adianta
+        if (event.code === 1008) {
+          ticketRef.current = null;
+          toast.error('Sem permissão para editar este arquivo');
+          return;
+        }
+        
         // Tentar reconectar após 3 segundos
         reconnectTimeoutRef.current = setTimeout(() => {
           console.log('Tentando reconectar...');
@@ -151,6 +245,10 @@ const LiveEditor = ({ file, team, user, onClose }) => {
         
       case 'user_left':
         setActiveUsers(prev => prev.filter(u => u.username !== data.username));
+        setCursors(prev => {
+          const { [data.username]: _removed, ...rest } = prev;
+          return rest;
+        });
         toast.info(`${data.username} saiu da sessão`, { duration: 2000 });
         break;
         
@@ -161,33 +259,60 @@ const LiveEditor = ({ file, team, user, onClose }) => {
         })));
         break;
         
+      case 'doc':
+      case 'resync':
+        handleDocument(data);
+        break;
+
+      case 'op':
+        handleRemoteOperation(data);
+        break;
+
+      case 'ack':
+        handleAck(data);
+        break;
+
       case 'content_update':
-        if (data.username !== user.username) {
-          setContent(data.content);
-          setUnsavedChanges(false);
-          toast.info(`${data.username} atualizou o conteúdo`, { duration: 2000 });
-        }
+        // Protocolo antigo (documento inteiro): pede o estado autoritativo ao servidor
+        sendMessage({ type: 'resync' });
         break;
         
-      case 'cursor_position':
-        if (data.username !== user.username) {
-          setCursors(prev => ({
-            ...prev,
-            [data.username]: {
-              position: data.position,
-              color: getUserColor(data.username)
-            }
-          }));
-        }
+      case 'cursor_batch':
+        // Últimas posições de cada usuário no tick do servidor (o próprio cursor vem junto e é ignorado)
+        setCursors(prev => {
+          const next = { ...prev };
+          data.cursors.forEach(cursor => {
+            if (cursor.username === user.username) return;
+            next[cursor.username] = {
+              position: cursor.position,
+              selectionEnd: cursor.selection_end,
+              color: getUserColor(cursor.username)
+            };
+          });
+          return next;
+        });
         break;
         
+      case 'session_ticket':
+        ticketRef.current = data.ticket;
+        break;
+
+      case 'snapshot_saved':
+        markSaved(data.rev);
+        break;
+
       case 'file_saved':
-        setLastSaved(new Date());
-        setUnsavedChanges(false);
-        toast.success('Arquivo salvo com sucesso!');
+        markSaved(data.rev);
+        if (data.username === user.username) {
+          setSaving(false);
+          toast.success('Arquivo salvo!');
+        } else {
+          toast.success(`${data.username} salvou o arquivo`);
+        }
         break;
         
       case 'error':
+        setSaving(false);
         toast.error(data.message || 'Erro na sessão Live');
         break;
         
@@ -197,73 +322,33 @@ const LiveEditor = ({ file, team, user, onClose }) => {
   };
 
   const handleContentChange = (e) => {
-    const newContent = e.target.value;
-    setContent(newContent);
+    setLocalContent(e.target.value);
     setUnsavedChanges(true);
     
-    // Enviar atualização via WebSocket
-    if (wsRef.current && wsRef.current.readyState === WebSocket.OPEN) {
-      wsRef.current.send(JSON.stringify({
-        type: 'content_update',
-        username: user.username,
-        content: newContent,
-        team_id: team.id,
-        file_id: file.id
-      }));
-    }
-    
-    // Auto-save após 2 segundos de inatividade
-    if (saveTimeoutRef.current) {
-      clearTimeout(saveTimeoutRef.current);
-    }
-    
-    saveTimeoutRef.current = setTimeout(() => {
-      handleSave();
-    }, 2000);
+    // Enviar só a alteração (operação), não o documento inteiro; o servidor grava sozinho
+    flushLocalChanges();
   };
 
   const handleCursorMove = useCallback((e) => {
-    if (wsRef.current && wsRef.current.readyState === WebSocket.OPEN) {
-      const cursorPosition = e.target.selectionStart;
-      
-      wsRef.current.send(JSON.stringify({
-        type: 'cursor_position',
-        username: user.username,
-        position: cursorPosition,
-        team_id: team.id,
-        file_id: file.id
-      }));
+    const { selectionStart, selectionEnd } = e.target;
+    const last = lastCursorRef.current;
+    // onSelect e onClick disparam juntos: só envia quando a posição muda de fato
+    if (last && last[0] === selectionStart && last[1] === selectionEnd) return;
+    if (sendMessage({ type: 'cursor_position', position: selectionStart, selection_end: selectionEnd })) {
+      lastCursorRef.current = [selectionStart, selectionEnd];
     }
-  }, [user.username, team.id, file.id]);
+  }, []);
 
-  const handleSave = async () => {
+  const handleSave = () => {
     if (!unsavedChanges) return;
     
-    setSaving(true);
-    try {
-      // Aqui você implementaria a lógica de salvar o arquivo
-      // Por enquanto, vamos simular um salvamento
-      await new Promise(resolve => setTimeout(resolve, 500));
-      
-      // Notificar via WebSocket
-      if (wsRef.current && wsRef.current.readyState === WebSocket.OPEN) {
-        wsRef.current.send(JSON.stringify({
-          type: 'file_saved',
-          username: user.username,
-          team_id: team.id,
-          file_id: file.id
-        }));
-      }
-      
-      setOriginalContent(content);
-      setLastSaved(new Date());
-      setUnsavedChanges(false);
-      toast.success('Arquivo salvo!');
-    } catch (error) {
-      console.error('Erro ao salvar:', error);
-      toast.error('Erro ao salvar arquivo');
-    } finally {
-      setSaving(false);
+    // Pede ao servidor para gravar já (sem esperar o debounce); a resposta é "file_saved".
+    // As mensagens de um socket são processadas em ordem, então a operação pendente entra antes.
+    flushLocalChanges();
+    if (sendMessage({ type: 'file_saved' })) {
+      setSaving(true);
+    } else {
+      toast.error('Sem conexão com a sessão Live');
     }
   };
 
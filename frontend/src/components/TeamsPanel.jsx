@@ -58,8 +58,10 @@ const TeamsPanel = ({ user }) => {
         teamsRes.data.map(async (team) => {
           try {
             // Buscar arquivos do time
-            const filesRes = await axios.get(`${API}/files`);
-            const teamFiles = filesRes.data.filter(f => f.team_id === team.id);
+            const filesRes = await axios.get(`${API}/files`, {
+              params: { team_id: team.id, limit: 500 }
+            });
+            const teamFiles = filesRes.data;
             return {
               ...team,
               files: teamFiles,
@@ -1,4 +1,4 @@
-import { useState, useEffect } from "react";
+import { useState, useEffect, useRef } from "react";
 import axios from "axios";
 import { API } from "@/App";
 import FileLibrary from "@/components/FileLibrary";
@@ -14,6 +14,9 @@ import { getSeasonalTheme, themes } from "@/utils/seasonalThemes";
 
 const Dashboard = ({ user, onLogout }) => {
   const [files, setFiles] = useState([]);
+  const [nextCursor, setNextCursor] = useState(null);
+  const [searchQuery, setSearchQuery] = useState("");
+  const filesRequest = useRef(0);
   const [loading, setLoading] = useState(true);
   const [uploading, setUploading] = useState(false);
   const [chatEnabled, setChatEnabled] = useState(false);
@@ -40,10 +43,20 @@ const Dashboard = ({ user, onLogout }) => {
     }
   };
 
-  const loadFiles = async () => {
+  // A API pagina por cursor: a próxima página vem no header X-Next-Cursor.
+  // A busca por nome também é feita no servidor (trecho do nome, sem diferenciar maiúsculas),
+  // sobre a biblioteca inteira.
+  const loadFiles = async (cursor = null, search = searchQuery) => {
+    const requestId = ++filesRequest.current;
     try {
-      const response = await axios.get(`${API}/files`);
-      setFiles(response.data);
+      const params = {};
+      if (cursor) params.cursor = cursor;
+      if (search) params.search = search;
+      const response = await axios.get(`${API}/files`, { params });
+      // Ignora respostas de buscas que já foram substituídas por outra
+      if (requestId !== filesRequest.current) return;
+      setFiles((prev) => (cursor ? [...prev, ...response.data] : response.data));
+      setNextCursor(response.headers["x-next-cursor"] || null);
     } catch (error) {
       toast.error("Erro ao carregar arquivos");
     } finally {
@@ -51,6 +64,11 @@ const Dashboard = ({ user, onLogout }) => {
     }
   };
 
+  const handleSearch = (search) => {
+    setSearchQuery(search);
+    loadFiles(null, search);
+  };
+
   const handleUpload = async (uploadedFiles, passwords, teamId = null) => {
     setUploading(true);
     let successCount = 0;
@@ -202,6 +220,8 @@ const Dashboard = ({ user, onLogout }) => {
               uploading={uploading}
               onUpload={handleUpload}
               onDelete={isAdmin ? handleDeleteFile : null}
+              onLoadMore={nextCursor ? () => loadFiles(nextCursor) : null}
+              onSearch={handleSearch}
               isAdmin={isAdmin}
               teams={teams}
               theme={currentTheme}
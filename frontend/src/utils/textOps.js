@@ -0,0 +1,56 @@
+// src/utils/textOps.js
+// Operações de texto do live-edit: [posição, quantos remover, texto inserido].
+// Posições em code points (como no servidor Python), não em unidades UTF-16.
+// Mesma semântica de apply_text_op / transform_text_op em backend/server.py.
+
+const codePoints = (text) => Array.from(text);
+
+export const applyOp = (text, [pos, del, ins]) => {
+  const chars = codePoints(text);
+  return chars.slice(0, pos).join('') + ins + chars.slice(pos + del).join('');
+};
+
+// Transforma `op` para ser aplicada depois de `other` (ambas geradas sobre o mesmo texto).
+// opFirst: em empates, o texto de `op` fica antes (quem o servidor sequenciou primeiro).
+export const transformOp = (op, other, opFirst) => {
+  const [pos, del, ins] = op;
+  const [otherPos, otherDel, otherIns] = other;
+  const otherInsLength = codePoints(otherIns).length;
+  const shift = otherInsLength - otherDel;
+
+  if (del === 0 && otherDel === 0 && pos === otherPos) {
+    return opFirst ? [pos, 0, ins] : [pos + otherInsLength, 0, ins];
+  }
+  if (pos + del <= otherPos) return [pos, del, ins];
+  if (pos >= otherPos + otherDel) return [pos + shift, del, ins];
+
+  const start = Math.min(pos, otherPos);
+  const end = Math.max(pos + del, otherPos + otherDel) + shift;
+  return [start, end - start, opFirst ? ins + otherIns : otherIns + ins];
+};
+
+// Menor operação que transforma `before` em `after` (prefixo/sufixo comuns)
+export const diffOp = (before, after) => {
+  if (before === after) return null;
+  const a = codePoints(before);
+  const b = codePoints(after);
+  let start = 0;
+  while (start < a.length && start < b.length && a[start] === b[start]) start++;
+  let endA = a.length;
+  let endB = b.length;
+  while (endA > start && endB > start && a[endA - 1] === b[endB - 1]) {
+    endA--;
+    endB--;
+  }
+  return [start, endA - start, b.slice(start, endB).join('')];
+};
+
+// Ajusta um offset UTF-16 (seleção do textarea) depois de aplicar `op` em `text`
+export const transformOffset = (text, offset, [pos, del, ins]) => {
+  const chars = codePoints(text);
+  const start = chars.slice(0, pos).join('').length;
+  const removed = chars.slice(pos, pos + del).join('').length;
+  if (offset <= start) return offset;
+  if (offset >= start + removed) return offset - removed + ins.length;
+  return start + ins.length;
+};